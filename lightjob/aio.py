@@ -0,0 +1,202 @@
+"""
+asyncio facade of the dbs (python 3 only).
+
+    db = DB(backend='Dataset')
+    db.load('.lightjob')
+    adb = AsyncDB(db)
+    j = await adb.get_by_id(summary)
+    await adb.modify_state_of(summary, RUNNING)
+    async for j in adb.jobs_with_state(AVAILABLE):
+        ...
+    await adb.close()
+
+the calls of the wrapped db are run by an executor so that they
+do not block the event loop. by default the executor has a single
+thread, the backends are not thread safe, and the calls are run in
+the order in which they are made.
+
+the small writes (`modify_state_of`, `insert`, `add_job`) are not run
+one by one : the ones made during the same iteration of the event loop
+are grouped and written with one call of `modify_states` or `insert_list`,
+which the backends run in one transaction. when a grouped write fails,
+its values are written again one by one, so that each coroutine gets
+the error of its own value.
+any other method of the wrapped db is available as a coroutine.
+"""
+import asyncio
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import AVAILABLE
+
+
+class AsyncDB(object):
+    """
+    asyncio facade of a db.
+
+    Parameters
+    ----------
+
+    db : GenericDB
+        loaded db to wrap
+    max_workers : int[default=1]
+        number of threads of the executor, only use more than one
+        with a backend which is thread safe.
+    executor : concurrent.futures.Executor, optional
+        executor to use instead of creating one
+    chunk_size : int[default=500]
+        number of jobs read at once by the async iterators
+    """
+
+    def __init__(self, db, max_workers=1, executor=None, chunk_size=500):
+        self.db = db
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.chunk_size = chunk_size
+        self._states = []
+        self._inserts = []
+        self._flush_handle = None
+
+    def _submit(self, fn, *args, **kw):
+        """run fn(*args, **kw) in the executor, after the pending writes"""
+        self._flush()
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(fn, *args, **kw))
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        """send the pending writes to the executor, one call per kind of write"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        loop = asyncio.get_event_loop()
+        # the jobs are inserted before their states are changed
+        for pending, write in ((self._inserts, self.db.insert_list),
+                               (self._states, self.db.modify_states)):
+            if not pending:
+                continue
+            values = [v for v, _ in pending]
+            waiters = [w for _, w in pending]
+            del pending[:]
+            future = loop.run_in_executor(self.executor, _write_each, write, values)
+            future.add_done_callback(partial(_resolve, waiters))
+
+    def _enqueue(self, pending, value):
+        waiter = asyncio.get_event_loop().create_future()
+        pending.append((value, waiter))
+        self._schedule_flush()
+        return waiter
+
+    async def run(self, fn, *args, **kw):
+        """run a blocking callable in the executor of the db"""
+        return await self._submit(fn, *args, **kw)
+
+    async def modify_state_of(self, s, state, dt=None):
+        """change the state of the job with the id `s`, see GenericDB.modify_state_of"""
+        await self._enqueue(self._states, (s, state, dt or datetime.now()))
+
+    async def modify_states(self, l):
+        """change the state of several jobs, see GenericDB.modify_states"""
+        dt = datetime.now()
+        await asyncio.gather(*[
+            self._enqueue(self._states, (s, state, d or dt)) for s, state, d in l])
+
+    async def insert(self, d):
+        """insert a full job dict"""
+        await self._enqueue(self._inserts, d)
+
+    async def insert_list(self, l):
+        """insert a list of full job dicts"""
+        await asyncio.gather(*[self._enqueue(self._inserts, d) for d in l])
+
+    async def add_job(self, d, state=AVAILABLE, **meta):
+        """add a job without checking for duplicates, see GenericDB.add_job"""
+        s = self.db.summarize(d)
+        await self.insert(self.db._new_job(d, s, state, datetime.now(), meta))
+        return s
+
+    async def flush(self):
+        """wait for the pending writes"""
+        await self._submit(lambda: None)
+
+    async def get(self, d):
+        """async iterator of the jobs matching the filter `d`, see GenericDB.get"""
+        it = await self._submit(lambda: iter(self.db.get(d)))
+        while True:
+            chunk = await self._submit(lambda: list(islice(it, self.chunk_size)))
+            if not chunk:
+                return
+            for j in chunk:
+                yield j
+
+    def jobs_with(self, **kw):
+        """async iterator of the jobs matching `kw`"""
+        return self.get(kw)
+
+    def jobs_with_state(self, state):
+        """async iterator of the jobs with the state `state`"""
+        return self.get({self.db.statekey: state})
+
+    def all_jobs(self):
+        """async iterator of all the jobs"""
+        return self.get({})
+
+    async def close(self):
+        """wait for the pending writes, close the db and the executor"""
+        await self._submit(self.db.close)
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        async def method(*args, **kw):
+            return await self._submit(attr, *args, **kw)
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        return method
+
+
+def _write_each(write, values):
+    """
+    write the values with one call of `write`, or one call per value
+    if the grouped call fails. return the error of each value (or None).
+    """
+    try:
+        write(values)
+        return [None] * len(values)
+    except Exception as exc:
+        if len(values) == 1:
+            return [exc]
+    errors = []
+    for v in values:
+        try:
+            write([v])
+            errors.append(None)
+        except Exception as exc:
+            errors.append(exc)
+    return errors
+
+
+def _resolve(waiters, future):
+    """give the result of a grouped write to the coroutines waiting for it"""
+    if future.cancelled():
+        errors = [asyncio.CancelledError()] * len(waiters)
+    elif future.exception() is not None:
+        errors = [future.exception()] * len(waiters)
+    else:
+        errors = future.result()
+    for w, exc in zip(waiters, errors):
+        if w.done():
+            continue
+        if exc is not None:
+            w.set_exception(exc)
+        else:
+            w.set_result(None)
@@ -0,0 +1,243 @@
+"""
+benchmarks of the backends : the same workloads (see `workloads`)
+are run against each backend at several sizes of the db.
+
+    from lightjob.benchmarks import run, compare
+    report = run(backends=['Memory', 'SQLite'], sizes=[1000, 100000])
+
+or from the command line :
+
+    lightjob bench --sizes 1000,100000 --output bench.json
+    lightjob bench --output new.json --compare bench.json
+
+each backend and size is run in a new process, which gives its peak
+RSS, in a new db folder, whose size on disk is measured once the db
+is closed. for each workload, the report gives the number of jobs
+handled per second and the latency of the operations (p50 and p99,
+in ms). the report is written as json with sorted keys, so that the
+reports of two versions can be diffed.
+"""
+import os
+import sys
+import math
+import time
+import shutil
+import logging
+import platform
+import multiprocessing
+from datetime import datetime
+from tempfile import mkdtemp
+
+from ..db import DB
+from ..databases import BACKENDS
+from .workloads import WORKLOADS, Run
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# version of the format of the reports
+FORMAT = 1
+SIZES = (1000, 100000, 1000000)
+# Remote needs a server, it is benchmarked through the backend it serves
+DEFAULT_BACKENDS = tuple(sorted(name for name in BACKENDS if name != 'Remote'))
+
+
+def percentile(values, p):
+    """the `p`-th percentile of sorted `values` (nearest rank)"""
+    if not values:
+        return None
+    k = max(0, int(math.ceil(p / 100. * len(values))) - 1)
+    return values[k]
+
+
+def measure(operations):
+    """time the operations yielded by a workload"""
+    latencies = []
+    items = 0
+    for op, n in operations:
+        start = time.perf_counter()
+        out = op()
+        latencies.append(time.perf_counter() - start)
+        items += out if n is None else n
+    seconds = sum(latencies)
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'items': items,
+        'seconds': round(seconds, 6),
+        'throughput': round(items / seconds, 1) if seconds else None,
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000., 4)
+
+
+def peak_rss():
+    """peak resident memory of the process in bytes (None on windows)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def disk_size(dirname):
+    """size in bytes of the files of a folder"""
+    size = 0
+    for root, dirs, files in os.walk(dirname):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+
+def workload_names(workloads=None):
+    """the names of `workloads` in the order they are run, `insert` first"""
+    unknown = set(workloads or []) - set(WORKLOADS)
+    if unknown:
+        raise ValueError('unknown workloads : {}'.format(', '.join(sorted(unknown))))
+    return [name for name in WORKLOADS if name == 'insert' or workloads is None or name in workloads]
+
+
+def run_one(backend, size, ops=1000, workloads=None, seed=0):
+    """
+    run the workloads against a new db of `backend`.
+
+    Parameters
+    ----------
+
+    backend : str
+        name of the backend (see `lightjob.databases.BACKENDS`)
+    size : int
+        number of jobs of the db
+    ops : int
+        number of operations of the workloads after `insert`
+    workloads : list of str, optional
+        names of the workloads to run (default is all of them),
+        `insert` is always run first.
+    seed : int
+        seed of the random choices of the workloads
+
+    Returns
+    -------
+
+    dict : the result of each workload, the peak RSS of the process
+           and the size on disk of the db
+    """
+    names = workload_names(workloads)
+    dirname = mkdtemp(suffix='lightjob-bench')
+    try:
+        db = DB(backend=backend)
+        db.load(dirname)
+        run = Run(size, ops=ops, seed=seed)
+        results = {}
+        for name in names:
+            results[name] = measure(WORKLOADS[name](db, run))
+        db.close()
+        return {
+            'backend': backend,
+            'size': size,
+            'workloads': results,
+            'peak_rss': peak_rss(),
+            'disk_size': disk_size(dirname),
+        }
+    finally:
+        shutil.rmtree(dirname)
+
+
+def run(backends=None, sizes=SIZES, ops=1000, workloads=None, seed=0, timeout=None, isolate=True):
+    """
+    run the workloads against each backend at each size.
+
+    Parameters
+    ----------
+
+    backends : list of str, optional
+        names of the backends, default is all of them but Remote
+    sizes : list of int
+        numbers of jobs of the dbs
+    ops, workloads, seed :
+        see `run_one`
+    timeout : float, optional
+        seconds given to each backend and size, after which the run
+        is stopped and reported as an error. only with isolate=True.
+    isolate : bool[default=True]
+        run each backend and size in a new process. otherwise, they
+        are run in this process and the peak RSS is the one of the
+        process so far.
+
+    Returns
+    -------
+
+    dict : the report, with the list of the results of `run_one`
+           in 'results', sorted by backend and size.
+    """
+    backends = list(backends or DEFAULT_BACKENDS)
+    for name in backends:
+        if name not in BACKENDS:
+            raise ValueError('unknown backend : {}'.format(name))
+    names = workload_names(workloads)
+    results = []
+    for backend in sorted(backends):
+        for size in sorted(sizes):
+            args = (backend, size, ops, workloads, seed)
+            start = time.time()
+            try:
+                if isolate:
+                    result = _run_isolated(args, timeout)
+                else:
+                    result = run_one(*args)
+            except Exception as ex:
+                result = {'backend': backend, 'size': size, 'error': '{}: {}'.format(type(ex).__name__, ex)}
+            logger.info('{} with {} jobs : {:.1f}s{}'.format(
+                backend, size, time.time() - start, ', ' + result['error'] if 'error' in result else ''))
+            results.append(result)
+    return {
+        'format': FORMAT,
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'ops': ops, 'seed': seed, 'sizes': sorted(sizes),
+                   'workloads': names},
+        'results': results,
+    }
+
+
+def _run_isolated(args, timeout):
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    try:
+        return pool.apply_async(run_one, args).get(timeout)
+    except multiprocessing.TimeoutError:
+        raise RuntimeError('stopped after {}s'.format(timeout))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def compare(old, new):
+    """
+    compare the throughputs of two reports.
+
+    Returns
+    -------
+
+    list of (backend, size, workload, old throughput, new throughput, speedup),
+    for the workloads present in both reports.
+    """
+    def throughputs(report):
+        t = {}
+        for result in report['results']:
+            for name, w in result.get('workloads', {}).items():
+                t[result['backend'], result['size'], name] = w['throughput']
+        return t
+    old, new = throughputs(old), throughputs(new)
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        speedup = new[key] / old[key] if old[key] and new[key] else None
+        rows.append(key + (old[key], new[key], speedup))
+    return rows
@@ -0,0 +1,122 @@
+"""
+the workloads of the benchmarks. a workload is a function of the db
+and of the `Run` which yields the operations to time : pairs
+(callable, number of jobs handled by the call, or None if the call
+returns it). what is computed between two operations (hashing,
+choosing the ids, ...) is not timed.
+
+they are run in the order of `WORKLOADS`, on the same db : `insert`
+fills the db with `run.size` jobs, the others do `run.ops` operations
+on it (`run.queries` for the ones which scan the db).
+"""
+import random
+from collections import OrderedDict
+from datetime import datetime
+
+from ..db import AVAILABLE, SUCCESS
+from ..utils import chunks
+
+BATCH_SIZE = 1000
+SAFE_BATCH_SIZE = 100
+GROUPS = 1000
+
+
+class Run(object):
+    """
+    state of a run of the workloads, shared by the workloads.
+
+    Parameters
+    ----------
+
+    size : int
+        number of jobs inserted by `insert`
+    ops : int
+        number of operations of the other workloads
+    seed : int
+        seed of the random choices, so that two runs do the same operations
+    """
+
+    def __init__(self, size, ops=1000, seed=0):
+        self.size = size
+        self.ops = ops
+        self.queries = max(1, ops // 100)
+        self.random = random.Random(seed)
+        self.ids = []
+        self.claimed = []
+
+
+def content(i):
+    """content of the job `i`, the jobs of a group are selected by `get`"""
+    return {'i': i, 'group': i % GROUPS, 'lr': (i % 97) / 97., 'model': 'model{}'.format(i % 7)}
+
+
+def insert(db, run):
+    """insert the jobs with `insert_list`, one operation per batch"""
+    dt = datetime.now()
+    for batch in chunks(range(run.size), BATCH_SIZE):
+        contents = [content(i) for i in batch]
+        ids = db.summarize_many(contents)
+        jobs = [db._new_job(d, s, AVAILABLE, dt, {}) for d, s in zip(contents, ids)]
+        run.ids.extend(ids)
+        yield (lambda jobs=jobs: db.insert_list(jobs)), len(jobs)
+
+
+def safe_insert(db, run):
+    """`safe_add_jobs` with half of the contents already in the db"""
+    new = run.size
+    for batch in chunks(range(run.ops), SAFE_BATCH_SIZE):
+        contents = []
+        for k in batch:
+            if k % 2:
+                contents.append(content(run.random.randrange(run.size)))
+            else:
+                contents.append(content(new))
+                new += 1
+        yield (lambda contents=contents: db.safe_add_jobs(contents, batch_size=len(contents))), len(contents)
+
+
+def get_by_id(db, run):
+    """`get_by_id` of random jobs"""
+    for _ in range(run.ops):
+        s = run.random.choice(run.ids)
+        yield (lambda s=s: db.get_by_id(s)), 1
+
+
+def get(db, run):
+    """`get` of the jobs of a random group"""
+    for _ in range(run.queries):
+        group = run.random.randrange(GROUPS)
+        yield (lambda group=group: len(list(db.get({'content.group': group})))), None
+
+
+def claim(db, run):
+    """`claim_next` of the available jobs"""
+    def claim_one():
+        j = db.claim_next(worker='bench')
+        if j is not None:
+            run.claimed.append(j[db.idkey])
+    for _ in range(run.ops):
+        yield claim_one, 1
+
+
+def transition(db, run):
+    """`modify_state_of` the claimed jobs to SUCCESS"""
+    for s in run.claimed:
+        yield (lambda s=s: db.modify_state_of(s, SUCCESS)), 1
+
+
+def get_values(db, run):
+    """`get_values` of a content field of the jobs in SUCCESS"""
+    for _ in range(run.queries):
+        yield (lambda: len(list(db.get_values('content.lr', state=SUCCESS)))), None
+
+
+WORKLOADS = OrderedDict([
+    ('insert', insert),
+    ('safe_insert', safe_insert),
+    ('get_by_id', get_by_id),
+    ('get', get),
+    ('claim', claim),
+    ('transition', transition),
+    ('get_values', get_values),
+])
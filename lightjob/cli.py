@@ -4,22 +4,23 @@ import click
 import logging
 import json
 import math
+import heapq
+from collections import deque
+from itertools import islice
 from six.moves import map
 
-from dateutil import parser
 import importlib
 import six
 
 from .db import DB
+from .db import SOCKETFILENAME
 from .utils import mkdir_path
 from .utils import backward_search
 from .utils import dict_format as default_dict_format
+from .utils import compile_field
+from .utils import json_default
+from .expr import parse as parse_expr
 
-try:
-    from tabulate import tabulate
-except ImportError:
-    def tabulate(x):
-        return x
 import pprint
 
 logger = logging.getLogger(__name__)
@@ -29,6 +30,9 @@ logger.setLevel(logging.INFO)
 
 DOTDIR = ".lightjob"
 
+# fields added to the jobs by `show`, computed from their life
+TIME_FIELDS = ('start_time', 'end_time', 'duration', 'readable_start_time', 'readable_end_time')
+
 
 @click.group()
 def main():
@@ -38,8 +42,10 @@ def main():
 @click.command()
 @click.option('--force/--no-force', default=False, help='Force init if exists', required=False)
 @click.option('--purge/--no-purge', default=False, help='Force purge database (WARNING : dangerous!)', required=False)
-@click.option('--backend', default='Blitz', help='Blitz/Dataset/H5py', required=False)
-def init(force, purge, backend):
+@click.option('--backend', default='Blitz', help='Blitz/Dataset/H5py/Memory/SQLite', required=False)
+@click.option('--hash-algorithm', default=None, help='hash of the job contents : md5 (default), sha1, sha256, '
+              'blake2b or xxhash (if installed)', required=False)
+def init(force, purge, backend, hash_algorithm):
     """
     initializes a db in the current directory
     """
@@ -50,10 +56,12 @@ def init(force, purge, backend):
             return
     mkdir_path(folder)
     logger.info("Init on : {}".format(folder))
-    rcfilename = open(os.path.join(folder, '.lightjobrc'), 'w')
-    rcfilename.write('{"backend": "%s"}' % (backend,))
-    rcfilename.close()
-    db = DB(backend=backend)
+    params = {'backend': backend}
+    if hash_algorithm is not None:
+        params['hash_algorithm'] = hash_algorithm
+    with open(os.path.join(folder, '.lightjobrc'), 'w') as fd:
+        json.dump(params, fd)
+    db = DB(**params)
     db.load(folder)
     if purge:
         db.purge()
@@ -61,23 +69,65 @@ def init(force, purge, backend):
 
 @click.command()
 @click.option('--filename', default='db.json', help='json filename where to dump the db', required=False)
-def dump(filename):
+@click.option('--format', 'fmt', default='json', type=click.Choice(['json', 'jsonl']),
+              help='json : a list of jobs, jsonl : one job per line, written one at a time', required=False)
+@click.option('--state', default=None, help='filter jobs by state', required=False)
+@click.option('--where', default=None, help='filter jobs by where', required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+def dump(filename, fmt, state, where, db_folder):
     """
     dump the db into a json file
     """
-    db = load_db()
+    db = load_db(db_folder)
     kw = {}
+    if state is not None:
+        kw['state'] = state
+    if where is not None:
+        kw['where'] = where
     jobs = db.jobs_with(**kw)
-    jobs = list(jobs)
-    with open(filename, 'w') as fd:
-        json.dump(jobs, fd, indent=2)
+    bar = click.progressbar(jobs, length=db.count(**kw), label='dump', file=sys.stderr)
+    with open(filename, 'w') as fd, bar as jobs:
+        if fmt == 'jsonl':
+            for j in jobs:
+                fd.write(json.dumps(j, default=json_default))
+                fd.write('\n')
+        else:
+            json.dump(list(jobs), fd, indent=2, default=json_default)
+
+
+@click.command()
+@click.option('--state', default=None, help='only load the jobs with this state', required=False)
+@click.option('--where', default=None, help='only load the jobs with this where', required=False)
+@click.option('--batch-size', default=1000, help='number of jobs inserted at once', required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+@click.argument('filename', required=True)
+def load(filename, state, where, batch_size, db_folder):
+    """
+    load the jobs of a file written by dump into the db.
+    the jobs that already exist in the db are skipped.
+    """
+    db = load_db(db_folder)
+    with open(filename) as fd:
+        if fd.read(1) == '[':
+            fd.seek(0)
+            jobs = json.load(fd)
+        else:
+            fd.seek(0)
+            jobs = (json.loads(line) for line in fd if line.strip())
+        if state is not None:
+            jobs = (j for j in jobs if j.get('state') == state)
+        if where is not None:
+            jobs = (j for j in jobs if j.get('where') == where)
+        with click.progressbar(jobs, label='load', file=sys.stderr) as jobs:
+            nb = db.safe_insert_list(jobs, batch_size=batch_size)
+    logger.info('{} jobs inserted'.format(nb))
 
 
 @click.command()
 @click.option('--state', default=None, help='filter jobs by state', required=False)
 @click.option('--type', default=None, help='fitler jobs by type', required=False)
 @click.option('--where', default=None, help='filter jobs by where', required=False)
-@click.option('--filter-by', default=None, help='filter jobs by custom python expression, e.g., "field == value"', required=False)
+@click.option('--filter-by', default=None, help='filter jobs by an expression, e.g., \'content.acc > 0.9 and state == "success"\'', required=False)
 @click.option('--details/--no-details', default=False, help='show with details', required=False)
 @click.option('--fields', default='', help='show values of fields separated by comma', required=False)
 @click.option('--summary', default='', help='show a specific job by its id', required=False)
@@ -85,11 +135,18 @@ def dump(filename):
 @click.option('--ascending/--descending', default=True, help='orde of showing the sorted events', required=False)
 @click.option('--show-fields/--no-show-fields', default=True, help='orde of showing the sorted events', required=False)
 @click.option('--dict-format', default='', help='dict format function to use', required=False)
+@click.option('--limit', default=None, type=int, help='show at most this number of jobs', required=False)
+@click.option('--offset', default=0, type=int, help='skip this number of jobs', required=False)
+@click.option('--head', default=None, type=int, help='show the first jobs, same as --limit', required=False)
+@click.option('--tail', default=None, type=int, help='show the last jobs', required=False)
 @click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
-def show(state, type, where, filter_by, details, fields, summary, sort, ascending, show_fields, dict_format, db_folder):
+def show(state, type, where, filter_by, details, fields, summary, sort, ascending, show_fields, dict_format,
+         limit, offset, head, tail, db_folder):
     """
     show the content of the db
     """
+    if tail is not None and (limit is not None or head is not None):
+        raise click.UsageError('--tail cannot be combined with --limit or --head')
     db = load_db(db_folder)
     params = get_db_params()
     if dict_format:
@@ -102,11 +159,13 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
         dict_format = default_dict_format
 
     if fields:
+        getters = [(field, field_getter(field, dict_format, db)) for field in fields.split(',')]
+
         def format_job(j):
             vals = []
-            for field in fields.split(','):
+            for field, getter in getters:
                 try:
-                    val = dict_format(j, field, db=db)
+                    val = getter(j)
                 except ValueError:
                     val = 'not_found'
                 vals.append(val)
@@ -131,7 +190,8 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
         kw["type"] = type
     if where is not None:
         kw['where'] = where
-    jobs = db.jobs_with(**kw)
+    if head is not None:
+        limit = head if limit is None else min(limit, head)
 
     def get_last(filter_func, L, default='none'):
         for el in L[::-1]:
@@ -140,6 +200,8 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
         return default
 
     def parse_time(j, tag='start', default='2000-01-01 00:00:00.00000'):
+        # imported here, most calls of show do not need the times
+        from dateutil import parser
         if 'life' in j and j['life']:
             life = j['life']
             if tag == 'end':
@@ -154,18 +216,15 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
             return dt
         else:
             return parser.parse(default)
-    jobs = list(jobs)
-    if filter_by:
-        space_index = filter_by.index(' ')
-        field, expr = filter_by[0:space_index], filter_by[space_index:]
-        func = lambda j: eval('"{}"{}'.format(dict_format(j, field, db=db), expr))
-        jobs = filter(func, jobs)
-        jobs = list(jobs)
 
-    for j in jobs:
+    def add_times(j):
+        # the times are parsed only for the jobs that need them :
+        # the printed ones, or all of them if they are sorted or filtered by time.
+        if 'duration' in j:
+            return j
         if 'start_time' not in j:
             j['start_time'] = parse_time(j, tag='start')
-        if 'end_time' not in j: 
+        if 'end_time' not in j:
             j['end_time'] = parse_time(j, tag='end')
         j['readable_start_time'] = str(j['start_time'])
         j['readable_end_time'] = str(j['end_time'])
@@ -173,12 +232,38 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
             j['duration'] = j['end_time'] - j['start_time']
         except Exception:
             j['duration'] = 'none'
+        return j
+
+    def with_times(field, getter):
+        if field.split('.')[0].split(':')[0] in TIME_FIELDS:
+            return lambda j: getter(add_times(j))
+        return getter
+
+    if filter_by:
+        expr = parse_expr(filter_by)
+        uses_times = any(f.split('.')[0].split(':')[0] in TIME_FIELDS for f in expr.fields())
+        if dict_format is default_dict_format and not uses_times:
+            # the part of the expression understood by the backend is run by it
+            jobs = db.query(expr, **kw)
+        else:
+            jobs = filter(expr.compile(lambda f: with_times(f, field_getter(f, dict_format, db))),
+                          db.jobs_with(**kw))
+        if not sort and tail is None:
+            jobs = islice(jobs, offset, None if limit is None else offset + limit)
+    elif sort or tail is not None:
+        jobs = db.jobs_with(**kw)
+    else:
+        # nothing has to be read beyond the shown jobs, the backend
+        # applies the offset and the limit.
+        jobs = db.get_slice(kw, offset=offset, limit=limit)
+
     if sort:
         infty = float('inf') if ascending else -float('inf')
+        sort_getter = with_times(sort, field_getter(sort, dict_format, db))
 
         def key(j):
             try:
-                val = dict_format(j, sort, db=db)
+                val = sort_getter(j)
             except Exception:
                 return infty
             else:
@@ -193,7 +278,18 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
 
             def key(j):
                 return -key_(j)
-        jobs = sorted(jobs, key=key)
+        if tail is not None:
+            # the last `tail` jobs of the sorted order, kept in a bounded heap
+            jobs = heapq.nlargest(offset + tail, jobs, key=key)[offset:][::-1]
+        elif limit is not None:
+            # only the `offset + limit` first jobs are kept in a bounded heap
+            jobs = heapq.nsmallest(offset + limit, jobs, key=key)[offset:]
+        else:
+            jobs = sorted(jobs, key=key)[offset:]
+    elif tail is not None:
+        jobs = list(deque(jobs, maxlen=offset + tail))
+        jobs = jobs[:len(jobs) - offset]
+    jobs = [add_times(j) for j in jobs]
     if details:
         logger.info("Number of jobs : {}".format(len(jobs)))
 
@@ -204,6 +300,11 @@ def show(state, type, where, filter_by, details, fields, summary, sort, ascendin
 
     jobs = list(map(format_job, jobs))
     if fields != '' and show_fields:
+        try:
+            from tabulate import tabulate
+        except ImportError:
+            def tabulate(x):
+                return x
         print(tabulate(header + jobs))
     else:
         for j in jobs:
@@ -250,6 +351,192 @@ def delete(force, db_folder, jobs):
             db.delete({'summary': job})
 
 
+@click.command()
+@click.option('--module', 'spec', help='function running a job given its content, e.g. mypkg.train:run',
+              required=True)
+@click.option('--workers', default=1, help='number of workers', required=False)
+@click.option('--in-flight', default=1, type=int,
+              help='number of jobs claimed at the same time per worker',
+              required=False)
+@click.option('--threads/--processes', default=False, help='run the jobs in threads or in processes',
+              required=False)
+@click.option('--state', default='available', help='state of the jobs to run', required=False)
+@click.option('--max-jobs', default=None, type=int, help='stop after this number of jobs', required=False)
+@click.option('--worker', default=None, help='name of the worker recorded in the jobs (default is host-pid)',
+              required=False)
+@click.option('--lease', default=None, type=float,
+              help='claim the jobs for this number of seconds, renewed while they run', required=False)
+@click.option('--reap/--no-reap', default=False,
+              help='make the expired jobs of dead workers available again', required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+def run(spec, workers, in_flight, threads, state, max_jobs, worker, lease, reap, db_folder):
+    """
+    run the available jobs with a pool of workers.
+    a job succeeds if the function returns and fails if it raises.
+    """
+    from .runner import Runner
+    from .runner import load_function
+    db = load_db(db_folder)
+    runner = Runner(db, load_function(spec), workers=workers, in_flight=in_flight,
+                    mode='thread' if threads else 'process', worker=worker,
+                    state=state, max_jobs=max_jobs, lease=lease, reap=reap)
+    counts = runner.run()
+    logger.info(', '.join('{} : {}'.format(k, v) for k, v in sorted(counts.items())))
+
+
+@click.command()
+@click.option('--state', default='running', help='state of the jobs to reap', required=False)
+@click.option('--new-state', default='available', help='new state of the reaped jobs', required=False)
+@click.option('--details/--no-details', default=False, help='show the reaped jobs', required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+def reap(state, new_state, details, db_folder):
+    """
+    make the jobs whose lease has expired (their worker is dead)
+    available again.
+    """
+    db = load_db(db_folder)
+    ids = db.reap(state=state, new_state=new_state)
+    if details:
+        for s in ids:
+            print(s)
+    logger.info('{} jobs moved from {} to {}'.format(len(ids), state, new_state))
+
+
+@click.command()
+@click.option('--address', default=None,
+              help='unix socket or host:port to listen on (default is the socket .sock of the db folder)',
+              required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+def serve(address, db_folder):
+    """
+    keep the db open and serve it to the workers,
+    which use it with DB(backend='Remote').
+    """
+    from .server import serve as serve_db
+    db = load_db(db_folder)
+    if address is None:
+        address = os.path.join(db.dirname, SOCKETFILENAME)
+    serve_db(db, address)
+
+
+@click.command()
+@click.option('--backends', default=None, help='comma separated backends (default is all of them but Remote)',
+              required=False)
+@click.option('--sizes', default='1000,100000,1000000', help='comma separated numbers of jobs', required=False)
+@click.option('--ops', default=1000, type=int, help='number of operations of each workload after the insert',
+              required=False)
+@click.option('--workloads', default=None, help='comma separated workloads (default is all of them)',
+              required=False)
+@click.option('--timeout', default=600., type=float,
+              help='seconds given to each backend and size, after which it is reported as an error',
+              required=False)
+@click.option('--output', default=None, help='json file where to write the report (default is stdout)',
+              required=False)
+@click.option('--compare', 'compare_with', default=None, help='json report of a previous run to compare with',
+              required=False)
+def bench(backends, sizes, ops, workloads, timeout, output, compare_with):
+    """
+    run the benchmarks of the backends and write the json report.
+    """
+    from . import benchmarks
+
+    def split(value):
+        return value.split(',') if value else None
+    # the report can be written on stdout, the progress goes to stderr
+    benchmarks.logger.addHandler(logging.StreamHandler(stream=sys.stderr))
+    benchmarks.logger.setLevel(logging.INFO)
+    report = benchmarks.run(backends=split(backends), sizes=[int(size) for size in split(sizes)],
+                            ops=ops, workloads=split(workloads), timeout=timeout)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as fd:
+            fd.write(text + '\n')
+    if compare_with is not None:
+        with open(compare_with) as fd:
+            old = json.load(fd)
+        for backend, size, workload, before, after, speedup in benchmarks.compare(old, report):
+            benchmarks.logger.info('{} {} {} : {} -> {} jobs/s{}'.format(
+                backend, size, workload, before, after,
+                '' if speedup is None else ' ({:.2f}x)'.format(speedup)))
+
+
+@click.command()
+@click.option('--format', 'fmt', default='table', type=click.Choice(['table', 'json']),
+              help='one line per state, or a json dict', required=False)
+@click.option('--rebuild/--no-rebuild', default=False,
+              help='count the jobs of each state again to repair the counters', required=False)
+@click.option('--served/--direct', default=False,
+              help='ask the db served by `lightjob serve` rather than opening it', required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+def status(fmt, rebuild, served, db_folder):
+    """
+    show the number of jobs of each state, read from
+    the counters maintained by the db.
+    """
+    if served:
+        db = DB(backend='Remote')
+        db.load(db_folder or get_dotfolder())
+    else:
+        db = load_db(db_folder)
+    counts = db.rebuild_state_counts() if rebuild else db.state_counts()
+    db.close()
+    if fmt == 'json':
+        print(json.dumps(counts, sort_keys=True))
+    else:
+        for state, n in sorted(counts.items()):
+            print('{} : {}'.format(state, n))
+        print('total : {}'.format(sum(counts.values())))
+
+
+@click.command()
+@click.option('--format', 'fmt', default='table', type=click.Choice(['table', 'json', 'prometheus']),
+              help='table, json or the text format of prometheus', required=False)
+@click.option('--served/--saved', default=False,
+              help='stats of the db served by `lightjob serve`, or the ones saved by the '
+              'instrumented processes when they closed the db', required=False)
+@click.option('--reset/--no-reset', default=False, help='remove the saved stats', required=False)
+@click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
+def stats(fmt, served, reset, db_folder):
+    """
+    show the stats of the instrumented dbs ("instrument": true in .lightjobrc).
+    """
+    from . import instrument
+    folder = db_folder or get_dotfolder()
+    if reset:
+        instrument.reset(folder)
+        return
+    if served:
+        db = DB(backend='Remote')
+        db.load(folder)
+        values = db.stats()
+        db.close()
+    else:
+        values = instrument.load(folder)
+    if fmt == 'json':
+        print(json.dumps(values, indent=2, sort_keys=True))
+    elif fmt == 'prometheus':
+        sys.stdout.write(instrument.to_prometheus(values))
+    else:
+        header = [['operation', 'count', 'errors', 'seconds', 'mean (ms)', 'p50 (ms)', 'p99 (ms)']]
+        rows = []
+        for name, op in sorted(values['operations'].items()):
+            quantiles = [instrument.quantile(op, q) for q in (0.5, 0.99)]
+            rows.append([name, op['count'], op['errors'], round(op['seconds'], 3),
+                         round(op['seconds'] / op['count'] * 1000., 3) if op['count'] else ''] +
+                        ['<={:g}'.format(b * 1000.) if b is not None else 'slower' for b in quantiles])
+        try:
+            from tabulate import tabulate
+        except ImportError:
+            def tabulate(x):
+                return '\n'.join(' '.join(str(v) for v in row) for row in x)
+        print(tabulate(header + rows))
+        print('serialized : {} bytes in {} calls, {:.3f}s'.format(
+            values['serialized_bytes'], values['serialize_calls'], values['serialize_seconds']))
+        print('commits : {}'.format(values['commits']))
+
+
 @click.command()
 @click.option('--db-folder', default=None, help='database folder (default is .lightjob)', required=False)
 def ipython(db_folder):
@@ -261,6 +548,17 @@ def ipython(db_folder):
     embed()
 
 
+def field_getter(field, dict_format, db):
+    """
+    return a callable getting the value of `field` from a job.
+    with the default dict_format, the field is compiled once
+    (see utils.compile_field).
+    """
+    if dict_format is default_dict_format:
+        return compile_field(field)
+    return lambda j: dict_format(j, field, db=db)
+
+
 def load_db(folder=None):
     """
     Load a db located the folder 'folder'.
@@ -282,11 +580,16 @@ def get_db_params(folder=None):
     db folder.
     the db config is located in /path/DOTDIR/.lightjobrc
     the db config is a json file.
-    it supports two options, 'backend' and 'dict_format'.
+    it supports the options 'backend', 'hash_algorithm' and 'dict_format'.
     - 'backend' is required, it is the name of the backend used by the db.
+    - 'hash_algorithm' is optional, it is the hash of the job contents
+       (see utils.HASHES). it is recorded in the db folder when the db
+       is created and cannot be changed afterwards.
     - 'dict_format' is optional. it is the name of the function to use
        as dict_format in the command 'show' of the cli. dict_format is used
        by the cli to get a field from a job.
+    - the other options are given to the backend,
+      e.g. 'cache_size' or 'instrument' (see GenericDB).
     """
     if folder is None:
         folder = get_dotfolder()
@@ -319,3 +622,10 @@ main.add_command(ipython)
 main.add_command(update)
 main.add_command(delete)
 main.add_command(dump)
+main.add_command(load)
+main.add_command(run)
+main.add_command(reap)
+main.add_command(serve)
+main.add_command(bench)
+main.add_command(stats)
+main.add_command(status)
@@ -1,3 +1,42 @@
-from .blitz import Blitz
-from .datasetdb import Dataset
-from .h5 import H5py
+"""
+the backends of lightjob. each backend is imported the first time
+it is used, so that loading a db only imports the dependencies of
+its backend (blitzdb, dataset/sqlalchemy or h5py/numpy, none for Memory) :
+
+    from lightjob.databases import Blitz
+    backend = get_backend('Blitz')
+"""
+import sys
+import importlib
+
+# name of each backend -> module of the package defining it
+BACKENDS = {
+    'Blitz': '.blitz',
+    'Dataset': '.datasetdb',
+    'H5py': '.h5',
+    'Memory': '.memory',
+    'Remote': '.remote',
+    'SQLite': '.sqlite',
+}
+
+__all__ = sorted(BACKENDS.keys()) + ['get_backend']
+
+
+def get_backend(name):
+    """the class of the backend `name`, imported if needed"""
+    if name not in BACKENDS:
+        raise ValueError('unknown backend : {}, expected one of {}'.format(
+            name, ', '.join(sorted(BACKENDS.keys()))))
+    module = importlib.import_module(BACKENDS[name], __name__)
+    return getattr(module, name)
+
+
+def __getattr__(name):
+    if name in BACKENDS:
+        return get_backend(name)
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+if sys.version_info < (3, 7):  # no module __getattr__, import all of them
+    for _name in BACKENDS:
+        globals()[_name] = get_backend(_name)
@@ -1,8 +1,27 @@
+import os
+import time
+from numbers import Number
 from datetime import datetime
-
-from ..db import IDKEY, CONTENTKEY, STATEKEY, LIFEKEY, AVAILABLE
-from ..utils import summarize
-from ..utils import dict_format
+from functools import partial
+from itertools import islice
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ..db import IDKEY, CONTENTKEY, STATEKEY, LIFEKEY, WORKERKEY, LEASEKEY
+from ..db import DEFAULT_LEASE
+from ..db import AVAILABLE, RUNNING
+from ..db import HASHFILENAME
+from ..utils import summarize as default_summarize
+from ..utils import summarize_many
+from ..utils import DEFAULT_HASH
+from ..utils import dict_format as default_dict_format
+from ..utils import compile_field
+from ..utils import chunks
+from ..utils import copy_job
+from ..utils import LRU
+from ..instrument import Stats
+from ..instrument import instrument as instrument_db
+from .query import match_query
 
 
 class GenericDB(object):
@@ -49,7 +68,14 @@ class GenericDB(object):
 
     summarize: callable, optional
         hash function to use in order to set the value of `idkey` based
-        on the content defined by the value of `contentkey`
+        on the content defined by the value of `contentkey`.
+        by default, utils.summarize with `hash_algorithm`.
+    hash_algorithm: str, optional
+        name of the hash function used by utils.summarize (see utils.HASHES).
+        the algorithm is recorded in the db folder when the db is loaded
+        for the first time, then the recorded one is always used so that
+        the ids of the stored jobs stay valid. by default the recorded one,
+        or 'md5' for a new db.
     idkey: str, optional[default=IDKEY]
         key to use for the id of the jobs
     contentkey: str, optional[default=CONTENTKEY]
@@ -61,28 +87,115 @@ class GenericDB(object):
         the life of the jobs is a list of states
         (labeled by their datetime) that a job passed
         through.
+    workerkey: str, optional[default=WORKERKEY]
+        meta key where `claim_next` records the worker
+        that claimed a job.
+    leasekey: str, optional[default=LEASEKEY]
+        meta key where `claim_next` and `heartbeat` record the time
+        (in seconds since the epoch) when the claim of a job expires.
+    cache_size: int, optional[default=0]
+        number of jobs kept by `get_by_id` in a LRU cache, 0 disables it.
+        the cached jobs are dropped by the writes of this process,
+        so the cache should only be used if no other process
+        writes to the db, unless `cache_revisions` is True.
+    cache_revisions: bool, optional[default=False]
+        if True, each read of a cached job checks that the revision
+        of the job in the db (a counter incremented by each write)
+        is the one of the cached job, which is safe across processes.
+        only the backends which record revisions support it (SQLite).
+    instrument: bool, optional[default=False]
+        if True, the calls of the main operations, the commits and the
+        encoding of the jobs are recorded, see `stats` and lightjob.instrument.
     dict_format : callable, optional[default=utils.dict_format]
         SHOULD REMOVE THIS
     """
 
     def __init__(self,
-                 summarize=summarize,
+                 summarize=None,
+                 hash_algorithm=None,
                  idkey=IDKEY,
                  contentkey=CONTENTKEY,
                  statekey=STATEKEY,
-                 lifekey=LIFEKEY):
-        self.summarize = summarize
+                 lifekey=LIFEKEY,
+                 workerkey=WORKERKEY,
+                 leasekey=LEASEKEY,
+                 cache_size=0,
+                 cache_revisions=False,
+                 instrument=False):
+        self.custom_summarize = summarize is not None and summarize is not default_summarize
+        self.hash_algorithm = hash_algorithm
+        if self.custom_summarize:
+            self.summarize = summarize
+        else:
+            self.summarize = partial(default_summarize, algorithm=hash_algorithm or DEFAULT_HASH)
         self.idkey = idkey
         self.contentkey = contentkey
         self.statekey = statekey
         self.lifekey = lifekey
+        self.workerkey = workerkey
+        self.leasekey = leasekey
+        self.dirname = None
+        self.batch_depth = 0
+        if cache_revisions and type(self)._get_revision is GenericDB._get_revision:
+            raise ValueError('{} does not record the revisions of the jobs'.format(type(self).__name__))
+        self.cache = LRU(maxsize=cache_size) if cache_size else None
+        self.cache_revisions = cache_revisions
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = Stats()
+            instrument_db(self, self.instrumentation)
 
     def load(self, dirname):
         """
         load a db from a `dirname`.
         example of a dirname to use : /path/.lightjob
         """
+        self.dirname = dirname
         self.load_from_dir(dirname)
+        if not self.custom_summarize:
+            self._load_hash_algorithm(dirname)
+
+    def _load_hash_algorithm(self, dirname):
+        """use the hash algorithm recorded in `dirname`, record it for a new db"""
+        filename = os.path.join(dirname, HASHFILENAME)
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                recorded = fd.read().strip()
+        elif next(iter(self.get_slice({}, limit=1)), None) is not None:
+            # the jobs of a db which has not recorded its algorithm are hashed with md5
+            recorded = DEFAULT_HASH
+        else:
+            recorded = None
+        if recorded and self.hash_algorithm and recorded != self.hash_algorithm:
+            raise ValueError(
+                'the jobs of {} are hashed with {}, cannot use {}'.format(
+                    dirname, recorded, self.hash_algorithm))
+        self.hash_algorithm = recorded or self.hash_algorithm or DEFAULT_HASH
+        self.summarize = partial(default_summarize, algorithm=self.hash_algorithm)
+        if not os.path.exists(filename):
+            with open(filename, 'w') as fd:
+                fd.write(self.hash_algorithm)
+
+    def summarize_many(self, contents, processes=None):
+        """
+        ids of a list of contents.
+
+        Parameters
+        ----------
+
+        contents : list of dicts
+        processes : int, optional
+            number of processes used to hash the contents
+            (see utils.summarize_many), only with the default `summarize`.
+
+        Returns
+        -------
+
+        list of str
+        """
+        if self.custom_summarize:
+            return [self.summarize(d) for d in contents]
+        return summarize_many(contents, algorithm=self.hash_algorithm or DEFAULT_HASH, processes=processes)
 
     def load_from_dir(self, dirname):
         """load a job from a dirname"""
@@ -129,9 +242,34 @@ class GenericDB(object):
         """
         raise NotImplementedError()
 
+    def get_slice(self, d, offset=0, limit=None):
+        """
+        like `get`, but skip the `offset` first matching jobs
+        and return at most `limit` jobs.
+        backends that can should apply the offset and the limit
+        themselves instead of reading the skipped jobs.
+
+        Parameters
+        ----------
+
+        d : dict
+            the dictionary that we want to match with
+            the jobs in the db
+        offset : int[default=0]
+        limit : int, optional
+
+        Returns
+        -------
+
+        iterator of dicts
+        """
+        stop = None if limit is None else offset + limit
+        return islice(self.get(d), offset, stop)
+
     def get_by_id(self, id_):
         """
-        get a job based on its id
+        get a job based on its id, from the cache if it is enabled
+        (see `cache_size`).
 
         Parameters
         ----------
@@ -141,10 +279,68 @@ class GenericDB(object):
         Returns
         -------
 
-        dict
+        dict, or None if there is no job with this id
+        """
+        if self.cache is None:
+            return self._get_by_id(id_)
+        cached = self.cache.get(id_)
+        revision = None
+        if self.cache_revisions:
+            # read before the job, so that a job written in the meantime
+            # is cached with an older revision and read again next time
+            revision = self._get_revision(id_)
+            if revision is None:
+                self.cache.pop(id_)
+                return None
+        if cached is not None and cached[1] == revision:
+            return copy_job(cached[0])
+        j = self._get_by_id(id_)
+        if j is not None:
+            self.cache[id_] = (j, revision)
+            j = copy_job(j)
+        return j
+
+    def _get_by_id(self, id_):
+        """
+        read the job with the id `id_` from the db, or return None.
+        backends implement this rather than `get_by_id`.
+        """
+        raise NotImplementedError()
+
+    def _get_revision(self, id_):
+        """
+        revision of the job with the id `id_` (None if there is none),
+        implemented by the backends which support `cache_revisions`.
         """
         raise NotImplementedError()
 
+    def stats(self):
+        """
+        the stats recorded by the instrumentation (see `instrument`),
+        as a dict (see lightjob.instrument.Stats).
+        """
+        if self.instrumentation is None:
+            raise ValueError('the db is not instrumented, use instrument=True')
+        return self.instrumentation.as_dict()
+
+    def _instrument(self, stats):
+        """
+        hook the storage engine of the loaded db so that its commits and
+        the encoding of the jobs are recorded in `stats`. called once the
+        db is loaded, only if it is instrumented.
+        """
+        pass
+
+    def _uncache(self, ids=None):
+        """drop the jobs `ids` from the cache, or all the jobs if `ids` is None"""
+        if self.cache is None:
+            return
+        if ids is None:
+            self.cache.clear()
+        else:
+            for id_ in ids:
+                self.cache.pop(id_)
+
     def update(self, d, id):
         """
         update a job
@@ -176,6 +372,61 @@ class GenericDB(object):
         """
         raise NotImplementedError()
 
+    @contextmanager
+    def batch(self):
+        """
+        group the writes of a block, which are committed once at the end
+        of the block instead of once per write, and rolled back if the
+        block raises an exception :
+
+            with db.batch():
+                for s, tag in tags.items():
+                    db.job_update(s, {'tag': tag})
+
+        the blocks can be nested, only the outermost one commits or
+        rolls back. each backend maps it to its own transactions, see
+        `_begin_batch`. the writes of a block are not seen by the other
+        processes before the end of the block.
+        """
+        outer = self.batch_depth == 0
+        if outer:
+            self._begin_batch()
+        self.batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.batch_depth -= 1
+            if outer:
+                self._rollback_batch()
+                self._uncache()
+            raise
+        self.batch_depth -= 1
+        if outer:
+            self._commit_batch()
+
+    transaction = batch
+
+    @property
+    def in_batch(self):
+        """True inside a `batch` block"""
+        return self.batch_depth > 0
+
+    def _begin_batch(self):
+        """
+        called when the outermost `batch` block starts.
+        by default the writes are not grouped : they are committed
+        as they are done and they are not rolled back.
+        """
+        pass
+
+    def _commit_batch(self):
+        """called when the outermost `batch` block ends"""
+        pass
+
+    def _rollback_batch(self):
+        """called when the outermost `batch` block raises an exception"""
+        pass
+
     def safe_add_job(self, d, **meta):
         """
         insert a job into the db safely.
@@ -203,9 +454,10 @@ class GenericDB(object):
             - 0 if the content has been detected to be duplicate
             - 1 if the content is new
         """
-        if self.job_exists(d):
+        s = self.summarize(d)
+        if self.job_exists_by_summary(s):
             return 0
-        self.add_job(d, **meta)
+        self._add_job(d, s, **meta)
         return 1
 
     def safe_add_or_update_job(self, d, **meta):
@@ -234,20 +486,23 @@ class GenericDB(object):
             - 0 if the content has been detected to be duplicate
             - 1 if the content is new
         """
-        if self.job_exists(d):
+        s = self.summarize(d)
+        if self.job_exists_by_summary(s):
             u = {}
             u.update(meta)
             u[self.contentkey] = d
-            s = self.summarize(d)
             self.job_update(s, u)
             return 0
-        self.add_job(d, **meta)
+        self._add_job(d, s, **meta)
         return 1
 
     def add_job(self, d, state=AVAILABLE, **meta):
         """
         add a job with the RISK of inserting a duplicate job.
         use `safe_add_job` to avoid this behaviour.
+        the backends with a unique index on the id (Dataset and SQLite)
+        do not insert the duplicate and raise the IntegrityError of their
+        driver (sqlalchemy.exc.IntegrityError, sqlite3.IntegrityError).
         `meta` are used to insert meta fields.
         `meta` fields are all fields that do not define
         the content of the job (don't affect the hash of the
@@ -274,13 +529,107 @@ class GenericDB(object):
         meta : kwargs
             meta fields
         """
-        s = self.summarize(d)
-        D = {self.statekey: state, self.contentkey: d, self.idkey: s, self.lifekey: []}
-        D.update(meta)
+        return self._add_job(d, self.summarize(d), state=state, **meta)
+
+    def _add_job(self, d, s, state=AVAILABLE, **meta):
+        """add a job with content `d` whose summary `s` is already computed"""
+        D = self._new_job(d, s, state, datetime.now(), meta)
         self.insert(D)
-        self.modify_state_of(s, state)
         return s
 
+    def _new_job(self, d, s, state, dt, meta):
+        """build the dict of a new job with content `d` and summary `s`"""
+        D = {
+            self.statekey: state,
+            self.contentkey: d,
+            self.idkey: s,
+            self.lifekey: [{self.statekey: state, 'dt': dt}]
+        }
+        D.update(meta)
+        return D
+
+    def safe_add_jobs(self, contents, batch_size=1000, state=AVAILABLE, processes=None, **meta):
+        """
+        insert many jobs into the db safely, like `safe_add_job`,
+        but batch by batch : the contents of a batch are hashed, the
+        existing summaries are found with one lookup and only the new
+        jobs are inserted with one `insert_list`.
+
+        Parameters
+        ----------
+
+        contents : iterable of dicts
+            job contents
+        batch_size : int[default=1000]
+            number of contents handled per batch
+        state: str[default=AVAILABLE]
+            starting state of the jobs
+        processes : int, optional
+            number of processes used to hash the contents
+            of a batch, see `summarize_many`
+        meta : kwargs
+            meta fields, shared by all the jobs
+
+        Returns
+        -------
+
+        int : number of newly inserted jobs
+        """
+        dt = datetime.now()
+
+        def jobs():
+            for batch in chunks(contents, batch_size):
+                for d, s in zip(batch, self.summarize_many(batch, processes=processes)):
+                    yield self._new_job(d, s, state, dt, meta)
+        return self.safe_insert_list(jobs(), batch_size=batch_size)
+
+    def safe_insert_list(self, jobs, batch_size=1000):
+        """
+        insert full job dicts (with their `self.idkey` already set)
+        batch by batch, skipping the jobs whose id already exists
+        in the db or earlier in `jobs`.
+
+        Parameters
+        ----------
+
+        jobs : iterable of dicts
+        batch_size : int[default=1000]
+            number of jobs handled per batch
+
+        Returns
+        -------
+
+        int : number of newly inserted jobs
+        """
+        nb = 0
+        for batch in chunks(jobs, batch_size):
+            new = OrderedDict()
+            for j in batch:
+                new.setdefault(j[self.idkey], j)
+            for id_ in self.existing_ids(list(new.keys())):
+                del new[id_]
+            if new:
+                self.insert_list(list(new.values()))
+                nb += len(new)
+        return nb
+
+    def existing_ids(self, ids):
+        """
+        return the set of ids from `ids` that exist in the db.
+        backends should override it with a single lookup.
+
+        Parameters
+        ----------
+
+        ids : list of str
+
+        Returns
+        -------
+
+        set of str
+        """
+        return set(id_ for id_ in ids if self.get_by_id(id_) is not None)
+
     def all_jobs(self):
         """
         Return all jobs
@@ -325,6 +674,37 @@ class GenericDB(object):
         """
         return filter(fn, self.get(kw))
 
+    def query(self, expr, **kw):
+        """
+        Return all jobs that match the fields defined in
+        the kwargs and the expression `expr` (see lightjob.expr),
+        e.g. db.query('content.acc > 0.9 and content.model == "resnet"').
+        the part of the expression that the backend understands is given
+        to `get`, the rest is evaluated on the jobs returned by `get`.
+
+        Parameters
+        ----------
+        expr : str or lightjob.expr.Expr
+            the expression
+        kw : kwargs
+            fields to match
+
+        Returns
+        -------
+
+        iterable of dicts
+        """
+        from ..expr import parse
+        expr = parse(expr)
+        f, rest = expr.split()
+        if set(f) & set(kw):
+            f, rest = {}, expr
+        kw.update(f)
+        jobs = self.get(kw)
+        if rest is None:
+            return jobs
+        return filter(rest.compile(), jobs)
+
     def jobs_with_state(self, state):
         """
         Return all jobs with self.statekey==state
@@ -341,6 +721,50 @@ class GenericDB(object):
         """
         return self.get({self.statekey: state})
 
+    def count(self, **kw):
+        """
+        Return the number of jobs that match the fields defined in
+        the kwargs
+
+        Returns
+        -------
+
+        int
+        """
+        return sum(1 for _ in self.get(kw))
+
+    def state_counts(self):
+        """
+        number of jobs in each state.
+        the backends maintain counters updated by each write, so this
+        does not read the jobs (see `rebuild_state_counts`), except
+        this default implementation which counts the states of all the jobs.
+
+        Returns
+        -------
+
+        dict : state -> number of jobs, the states without jobs are omitted
+        """
+        counts = {}
+        for j in self.get({}):
+            state = j.get(self.statekey)
+            if state is not None:
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def rebuild_state_counts(self):
+        """
+        count the jobs of each state again and store the counters,
+        to repair counters which do not match the jobs anymore
+        (e.g. after a crash between a write and the update of the counters).
+
+        Returns
+        -------
+
+        dict : the new counts, like `state_counts`
+        """
+        return GenericDB.state_counts(self)
+
     def get_state_of(self, summary):
         """ get the state of a job for which the summary is `summary`. """
         return self.get_job_by_summary(summary)[self.statekey]
@@ -360,16 +784,173 @@ class GenericDB(object):
             datetime to associate with the new state of the job.
             if it is not provided, it uses datetime.now().
         """
-        self.update({self.statekey: state}, summary)
-        if dt is None:
-            dt = datetime.now()
-        j = self.get_job_by_summary(summary)
-        if self.lifekey in j:
-            life = j[self.lifekey]
-        else:
-            life = []
+        self.modify_states([(summary, state, dt)])
+
+    def modify_states(self, transitions):
+        """
+        Modify the state of several jobs at once.
+        Backends apply all the transitions in a single
+        transaction.
+
+        Parameters
+        ----------
+
+        transitions : iterable of tuples (summary, state, dt)
+            id of the job, its new state and the datetime to associate
+            with the new state. if dt is None, datetime.now() is used.
+        """
+        now = datetime.now()
+        l = [(s, state, now if dt is None else dt) for s, state, dt in transitions]
+        if l:
+            self.update_states(l)
+
+    def update_states(self, l):
+        """
+        change the state of a list of jobs and append the
+        new state to their life.
+        backends should override it so that each job is written once
+        and all the jobs are written in one transaction.
+
+        Parameters
+        ----------
+
+        l : list of tuples (id, state, dt)
+        """
+        for id_, state, dt in l:
+            j = self.get_by_id(id_)
+            if j is None:
+                continue
+            self._append_life(j, state, dt)
+            self.update({self.statekey: state, self.lifekey: j[self.lifekey]}, id_)
+
+    def _append_life(self, j, state, dt):
+        """set the state of the job dict `j` and append it to its life"""
+        j[self.statekey] = state
+        life = j.get(self.lifekey) or []
         life.append({self.statekey: state, 'dt': dt})
-        self.update({self.lifekey: life}, summary)
+        j[self.lifekey] = life
+        return j
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        """
+        pick one job with `self.statekey==state` and move it
+        to `new_state`.
+        Backends override this to do the pick and the state change
+        in a single transaction, so that concurrent workers never
+        claim the same job. The default implementation is NOT atomic.
+
+        Parameters
+        ----------
+
+        state : str[default=AVAILABLE]
+            state of the jobs to pick from
+        new_state : str[default=RUNNING]
+            state of the claimed job
+        worker : str, optional
+            name of the worker claiming the job, it is recorded
+            in the meta field `self.workerkey`.
+        lease : float, optional
+            number of seconds the job is claimed for. the expiry
+            is recorded in the meta field `self.leasekey`, the worker
+            extends it with `heartbeat` and `reap` makes the job
+            available again once it is expired.
+
+        Returns
+        -------
+
+        dict : the claimed job, or None if there is no job
+               with `state`.
+        """
+        for j in self.jobs_with_state(state):
+            s = j[self.idkey]
+            meta = self._claim_meta(worker, lease)
+            if meta:
+                self.update(meta, s)
+            self.modify_state_of(s, new_state)
+            return self.get_job_by_summary(s)
+        return None
+
+    def _claim_meta(self, worker, lease):
+        """meta fields set on a job by `claim_next`"""
+        meta = {}
+        if worker is not None:
+            meta[self.workerkey] = worker
+        if lease is not None:
+            meta[self.leasekey] = time.time() + lease
+        return meta
+
+    def heartbeat(self, s, lease=DEFAULT_LEASE, worker=None, state=RUNNING):
+        """
+        extend the claim of the job with id `s` for `lease` seconds from now,
+        if the job is still claimed by the caller : its state is `state`
+        and it was claimed by `worker`.
+        Backends override this to do the check and the update in a single
+        transaction. The default implementation is NOT atomic.
+
+        Parameters
+        ----------
+
+        s : str
+            id of the job
+        lease : float[default=DEFAULT_LEASE]
+            number of seconds
+        worker : str, optional
+            name of the worker which claimed the job, the worker
+            is not checked if it is None.
+        state : str[default=RUNNING]
+            state of the claimed job
+
+        Returns
+        -------
+
+        bool : False if the job does not exist anymore, is not in `state`
+               or was claimed by another worker (e.g. it was reaped and
+               claimed again), then the caller does not own the job anymore.
+        """
+        if not self._is_claimed(self._get_by_id(s), worker, state):
+            return False
+        self.update({self.leasekey: time.time() + lease}, s)
+        return True
+
+    def _is_claimed(self, j, worker, state):
+        """True if the job `j` is in `state` and claimed by `worker` (by anyone if it is None)"""
+        if j is None or j.get(self.statekey) != state:
+            return False
+        return worker is None or j.get(self.workerkey) == worker
+
+    def reap(self, state=RUNNING, new_state=AVAILABLE, now=None):
+        """
+        move the jobs with `state` whose lease has expired to `new_state`,
+        with one call of `modify_states`. the change is recorded
+        in their life like any change of state.
+        the jobs claimed without a lease are never moved.
+        Backends override this so that only the jobs which are still
+        in `state` with an expired lease are moved, in a single
+        transaction (or while holding the lock of the claims), so that
+        a job which finished or got a heartbeat meanwhile is kept.
+        The default implementation is NOT atomic.
+
+        Parameters
+        ----------
+
+        state : str[default=RUNNING]
+        new_state : str[default=AVAILABLE]
+        now : float, optional
+            time in seconds since the epoch, default is time.time()
+
+        Returns
+        -------
+
+        list of str : ids of the moved jobs
+        """
+        now = time.time() if now is None else now
+        q = {self.statekey: state, self.leasekey: {'$lt': now}}
+        # the jobs are matched again, some backends (blitzdb)
+        # can return jobs from stale indexes.
+        ids = [j[self.idkey] for j in self.get(q) if match_query(j, q)]
+        if ids:
+            self.modify_states([(s, new_state, None) for s in ids])
+        return ids
 
     def job_update(self, s, values):
         """
@@ -401,16 +982,54 @@ class GenericDB(object):
             the '.' means going deep in the dict hierarchy.
 
         """
+        accessor = compile_field(field)
         jobs = self.jobs_with(**meta)
         for j in jobs:
             try:
-                value = self.get_value(j, field)
+                value = accessor(j)
             except ValueError:
                 continue
             else:
                 yield {field: value, 'job': j}
 
-    def get_value(self, job, field, dict_format=dict_format, **kw):
+    def get_columns(self, fields, where=None, missing=float('nan')):
+        """
+        get the values of several fields for all the jobs matching
+        `where`, as numpy arrays, in one pass over the jobs.
+
+        Parameters
+        ----------
+
+        fields : list of str
+            fields in the form of field1.field2.field3...etc
+            (see utils.dict_format for the syntax)
+        where : dict, optional
+            filter of the jobs (see `get`), all the jobs if not provided.
+        missing : optional[default=nan]
+            value to use for the jobs where a field does not exist
+
+        Returns
+        -------
+
+        dict : for each field, an array of its values, with a float, int
+               or bool dtype if all the values are numbers, otherwise an
+               array of objects. The key `self.idkey` contains the array of
+               the summaries of the jobs.
+        """
+        import numpy as np
+        accessors = [compile_field(field) for field in fields]
+        values = [[] for _ in fields]
+        ids = []
+        for j in self.get(where or {}):
+            ids.append(j[self.idkey])
+            for accessor, vals in zip(accessors, values):
+                vals.append(accessor(j, if_not_found=missing))
+        columns = {self.idkey: np.array(ids, dtype=object)}
+        for field, vals in zip(fields, values):
+            columns[field] = _to_array(np, vals)
+        return columns
+
+    def get_value(self, job, field, dict_format=default_dict_format, **kw):
         """
         get the value of a field in a job content
 
@@ -425,6 +1044,8 @@ class GenericDB(object):
         dict_format : callable
             dict_format callable to get the field from a dictionary
         """
+        if dict_format is default_dict_format:
+            return compile_field(field)(job, **kw)
         return dict_format(job, field, db=self, **kw)
 
     def job_exists(self, d):
@@ -451,3 +1072,15 @@ class GenericDB(object):
         dict : content of the job
         """
         return self.get_by_id(s)
+
+
+def _to_array(np, values):
+    """1D array of `values`, with a numeric dtype if possible"""
+    if all(isinstance(v, Number) for v in values):
+        a = np.asarray(values)
+        if a.ndim == 1 and a.dtype.kind in 'biuf':
+            return a
+    a = np.empty(len(values), dtype=object)
+    a[:] = values
+    return a
+
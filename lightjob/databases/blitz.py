@@ -1,13 +1,31 @@
 import os
+import json
+import six
+from datetime import datetime
+from itertools import islice
+from contextlib import contextmanager
 
 from blitzdb import Document
 from blitzdb import FileBackend
 
 from ..db import IDKEY
 from ..db import DBFILENAME
+from ..db import LOCKFILENAME
+from ..db import AVAILABLE, RUNNING
+from ..db import DEFAULT_LEASE
 from ..utils import recur_update
+from ..utils import file_lock
+from ..instrument import counted_commits
 
 from .base import GenericDB
+from .query import dotted_query
+from .query import flatten_query
+from .query import compile_query
+
+COUNTSFILENAME = 'state_counts.json'
+COUNTSLOCKFILENAME = 'state_counts.lock'
+
+_replace = getattr(os, 'replace', os.rename)  # python 2
 
 
 class Job(Document):
@@ -17,40 +35,224 @@ class Job(Document):
 
 
 class Blitz(GenericDB):
+    """
+    database stored with the file backend of blitzdb.
+    the number of jobs of each state is kept in the file 'state_counts.json'
+    of the db folder, updated after each commit of a write.
+    """
 
     def load_from_dir(self, dirname):
-        self.db = FileBackend(os.path.join(dirname, DBFILENAME))
+        # FileBackend writes its config when it opens the db,
+        # so concurrent workers must not open it at the same time
+        with file_lock(os.path.join(dirname, LOCKFILENAME)):
+            self.db = FileBackend(os.path.join(dirname, DBFILENAME))
+        # changes of the counters of the states not written yet
+        self.pending_counts = {}
+        if not os.path.exists(os.path.join(dirname, COUNTSFILENAME)):
+            # new db, or db created before the counters
+            self.rebuild_state_counts()
 
     def insert(self, d):
         self.insert_list([d])
 
     def insert_list(self, l):
+        # the jobs inserted again replace the old ones, whose state is uncounted
+        ids = [j[self.idkey] for j in l]
+        states = {j[self.idkey]: j.get(self.statekey)
+                  for j in self.db.filter(Job, {self.idkey: {'$in': ids}})}
         for j in l:
-            Job(j).save(self.db)
-        self.db.commit()
+            if j[self.idkey] in states:
+                self._count_state(states[j[self.idkey]], -1)
+            Job(dict(j)).save(self.db)
+            self._count_state(j.get(self.statekey), 1)
+            states[j[self.idkey]] = j.get(self.statekey)
+        self._commit()
+        self._uncache(j[self.idkey] for j in l)
 
-    def get_by_id(self, id_):
+    def _get_by_id(self, id_):
         try:
             return self.db.get(Job, {self.idkey: id_})
         except Job.DoesNotExist:
             return None
 
+    def existing_ids(self, ids):
+        jobs = self.db.filter(Job, {self.idkey: {'$in': list(ids)}})
+        return set(j[self.idkey] for j in jobs)
+
     def delete(self, d):
+        ids = []
         for el in self.get(d):
+            ids.append(el[self.idkey])
+            self._count_state(el.get(self.statekey), -1)
             self.db.delete(el)
+        self._commit()
+        self._uncache(ids)
 
     def get(self, d):
-        return self.db.filter(Job, d)
+        jobs = self.db.filter(Job, dotted_query(d))
+        if self._exact(d):
+            return jobs
+        # blitzdb only runs a part of the filter (see dotted_query)
+        # and follows mongodb, where e.g. {"tags": "a"} also matches
+        # the lists containing "a", so the jobs are matched again
+        match = compile_query(d)
+        return (j for j in jobs if match(j))
+
+    def _exact(self, d):
+        """True if blitzdb matches the same jobs as `match_query` for the filter `d`"""
+        for path, cond in flatten_query(d):
+            # the id and the state are strings (or null)
+            if path not in ((self.idkey,), (self.statekey,)):
+                return False
+            if not set(cond.keys()) <= set(['$eq', '$in', '$exists']):
+                return False
+        return True
+
+    def get_slice(self, d, offset=0, limit=None):
+        jobs = self.get(d)
+        if not self._exact(d):
+            return islice(jobs, offset, None if limit is None else offset + limit)
+        return jobs[offset:] if limit is None else jobs[offset:offset + limit]
+
+    def count(self, **kw):
+        if list(kw.keys()) == [self.statekey] and isinstance(kw[self.statekey], six.string_types):
+            return self.state_counts().get(kw[self.statekey], 0)
+        if self._exact(kw):
+            return len(self.get(kw))
+        return sum(1 for _ in self.get(kw))
+
+    def _count_state(self, state, n):
+        """add `n` jobs to the counter of `state`, written at the next commit"""
+        if state is not None:
+            self.pending_counts[state] = self.pending_counts.get(state, 0) + n
+
+    def _write_counts(self):
+        """add the pending changes to the counters of the file"""
+        pending, self.pending_counts = self.pending_counts, {}
+        if not any(pending.values()):
+            return
+        with file_lock(os.path.join(self.dirname, COUNTSLOCKFILENAME)):
+            counts = self._read_counts()
+            for state, n in pending.items():
+                counts[state] = counts.get(state, 0) + n
+            self._store_counts(counts)
+
+    def _read_counts(self):
+        try:
+            with open(os.path.join(self.dirname, COUNTSFILENAME)) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def _store_counts(self, counts):
+        filename = os.path.join(self.dirname, COUNTSFILENAME)
+        with open(filename + '.tmp', 'w') as fd:
+            json.dump(counts, fd)
+        _replace(filename + '.tmp', filename)
+
+    def state_counts(self):
+        return {state: n for state, n in self._read_counts().items() if n > 0}
+
+    def rebuild_state_counts(self):
+        counts = {}
+        with file_lock(os.path.join(self.dirname, COUNTSLOCKFILENAME)):
+            for j in self.db.filter(Job, {}):
+                state = j.get(self.statekey)
+                if state is not None:
+                    counts[state] = counts.get(state, 0) + 1
+            self._store_counts(counts)
+        return self.state_counts()
 
     def update(self, d, id_):
-        obj = self.get_by_id(id_)
-        recur_update(obj, d)
+        obj = self._get_by_id(id_)
         if obj is not None:
+            self._count_state(obj.get(self.statekey), -1)
+            recur_update(obj, d)
+            self._count_state(obj.get(self.statekey), 1)
             obj.save(self.db)
-            self.db.commit()
+            self._commit()
+            self._uncache([id_])
             return True
         else:
             return False
 
+    def update_states(self, l):
+        for id_, state, dt in l:
+            obj = self._get_by_id(id_)
+            if obj is None:
+                continue
+            self._count_state(obj.get(self.statekey), -1)
+            self._append_life(obj, state, dt)
+            self._count_state(state, 1)
+            obj.save(self.db)
+        self._commit()
+        self._uncache(id_ for id_, _, _ in l)
+
+    def _instrument(self, stats):
+        # blitzdb encodes the documents itself, only the commits are counted
+        self.db.commit = counted_commits(stats, self.db.commit)
+
+    def _commit(self):
+        """commit the writes, unless they are grouped by `batch`"""
+        if not self.in_batch:
+            self.db.commit()
+            self._write_counts()
+
+    def _commit_batch(self):
+        self.db.commit()
+        self._write_counts()
+
+    def _rollback_batch(self):
+        self.db.rollback()
+        self.db.begin()
+        self.pending_counts = {}
+
+    @contextmanager
+    def _claim_lock(self):
+        """
+        hold the lock of the claims with a fresh view of the db,
+        the writes of the block are committed before it is released.
+        """
+        if self.in_batch:
+            # the claims must be seen by the other processes at once,
+            # so the writes of the batch done so far are committed with them.
+            self.db.commit()
+            self._write_counts()
+        with file_lock(os.path.join(self.dirname, LOCKFILENAME)):
+            # drop our view of the indexes so that the jobs claimed
+            # by other processes since we loaded the db are seen
+            self.db.rollback()
+            self.db.begin()
+            yield
+            self.db.commit()
+            self._write_counts()
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        with self._claim_lock():
+            # blitzdb indexes can lag behind the stored documents,
+            # so the state of each candidate is checked again.
+            for obj in self.db.filter(Job, {self.statekey: state}):
+                if obj[self.statekey] == state:
+                    break
+            else:
+                return None
+            self._count_state(obj[self.statekey], -1)
+            self._append_life(obj, new_state, datetime.now())
+            self._count_state(new_state, 1)
+            for k, v in self._claim_meta(worker, lease).items():
+                obj[k] = v
+            obj.save(self.db)
+        self._uncache([obj[self.idkey]])
+        return obj
+
+    def heartbeat(self, s, lease=DEFAULT_LEASE, worker=None, state=RUNNING):
+        with self._claim_lock():
+            return super(Blitz, self).heartbeat(s, lease=lease, worker=worker, state=state)
+
+    def reap(self, state=RUNNING, new_state=AVAILABLE, now=None):
+        # the jobs are checked and moved while holding the lock of the claims
+        with self._claim_lock():
+            return super(Blitz, self).reap(state=state, new_state=new_state, now=now)
+
     def close(self):
         pass
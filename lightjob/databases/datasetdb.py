@@ -1,18 +1,131 @@
 import dataset
 import json
+import six
+import time
+import logging
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import IntegrityError
 
 from .base import GenericDB
+from .query import to_sql
+from .query import match_query
+from .query import NotPushable
+from .sqlite import state_counts_sql
+from .sqlite import rebuild_state_counts_sql
+from .sqlite import check_sqlite_version
+
+from ..db import AVAILABLE, RUNNING
+from ..db import DEFAULT_LEASE
+from ..utils import chunks
+from ..instrument import timed_serializer
+
+logger = logging.getLogger(__name__)
 
 
 class Dataset(GenericDB):
+    """
+    sqlite database (through the `dataset` library).
+    the jobs are stored in the table 'table', dict and list values
+    are stored as json.
+    the life of the jobs is not stored with them but in the table
+    'table_life', one row per state change, so that changing the state
+    of a job only appends a row.
+    the number of jobs of each state is kept in the table
+    'table_state_counts' by triggers (see sqlite.state_counts_sql).
+    like SQLite, the db needs sqlite 3.35 or later.
+    """
 
     def load_from_dir(self, dirname):
+        check_sqlite_version()
         filename = 'sqlite:///{}/db'.format(dirname)
         self.db = dataset.connect(filename)
         self.table = self.db['table']
+        self.life = self.db['table_life']
+        if not self.table.exists:
+            self.table.create_column(self.idkey, self.db.types.string)
+            self.table.create_column(self.statekey, self.db.types.string)
+        self._create_indexes()
+        if not self.life.exists:
+            self.life.create_column(self.idkey, self.db.types.string)
+            self.life.create_column(self.statekey, self.db.types.string)
+            self.life.create_column('dt', self.db.types.string)
+            self.life.create_index([self.idkey])
+        self._migrate_life()
+        self._create_state_counts()
+
+    def _create_indexes(self):
+        """
+        index the id and the state of the jobs.
+        the index on the id is unique, unless the db (created by an older
+        version) already contains duplicates.
+        """
+        query = 'CREATE {unique}INDEX IF NOT EXISTS "{name}" ON "{t}" ("{col}")'
+        t = self.table.name
+        try:
+            with self.db:
+                self.db.query(query.format(
+                    unique='UNIQUE ', name='ix_{}_{}'.format(t, self.idkey), t=t, col=self.idkey))
+        except IntegrityError:
+            logger.warning('duplicate ids in {}, the index on {} is not unique'.format(
+                self.dirname, self.idkey))
+            with self.db:
+                self.db.query(query.format(
+                    unique='', name='ix_{}_{}'.format(t, self.idkey), t=t, col=self.idkey))
+        with self.db:
+            self.db.query(query.format(
+                unique='', name='ix_{}_{}'.format(t, self.statekey), t=t, col=self.statekey))
+
+    def _create_state_counts(self):
+        """create the counters of the states, counting the jobs of a db created before them"""
+        self.counts = '{}_state_counts'.format(self.table.name)
+        with self.db:
+            exists = self.counts in self.db.tables
+            for sql in state_counts_sql(self.table.name, self.counts, self.statekey):
+                self.db.query(sql)
+            if not exists:
+                for sql in rebuild_state_counts_sql(self.table.name, self.counts, self.statekey):
+                    self.db.query(sql)
+
+    def _migrate_life(self):
+        """move the life lists stored by older versions in 'table' to 'table_life'"""
+        if not self.table.exists or not self.table.has_column(self.lifekey):
+            return
+        column = self.table.table.c[self.lifekey]
+        with self.db:
+            for row in list(self.table.find(column.isnot(None))):
+                life = self._deprocess_element(row[self.lifekey]) or []
+                self.life.insert_many(self._life_rows(row[self.idkey], life))
+            self.table.update({self.lifekey: None}, [])
+
+    def _life_rows(self, id_, life):
+        return [
+            {self.idkey: id_, self.statekey: l[self.statekey], 'dt': date_handler(l['dt'])}
+            for l in life]
+
+    def _attach_life(self, jobs):
+        """fill the life of the jobs from 'table_life', with one query per chunk of jobs"""
+        lives = {j[self.idkey]: [] for j in jobs}
+        if not lives:
+            return jobs
+        column = self.life.table.c[self.idkey]
+        for chunk in chunks(list(lives.keys()), 500):
+            rows = self.life.find(column.in_(chunk), order_by='id')
+            for row in rows:
+                lives[row[self.idkey]].append({self.statekey: row[self.statekey], 'dt': row['dt']})
+        for j in jobs:
+            j[self.lifekey] = lives[j[self.idkey]]
+        return jobs
 
     def insert(self, d):
-        self.table.insert(self._preprocess(d))
+        self.insert_list([d])
+
+    def _instrument(self, stats):
+        self._preprocess = timed_serializer(stats, self._preprocess)
+        event.listen(self.db.engine, 'commit', stats.committed)
 
     def _preprocess(self, d):
         return {k: self._preprocess_element(v) for k, v in d.items()}
@@ -32,31 +145,200 @@ class Dataset(GenericDB):
         except Exception:
             return d
 
+    def _split_life(self, d):
+        """return `d` without its life, and the rows of its life"""
+        d = dict(d)
+        # 'id' is the primary key of the table, a job read from another
+        # Dataset db (e.g. loaded from a dump) must get a new one.
+        d.pop('id', None)
+        life = d.pop(self.lifekey, None) or []
+        return d, self._life_rows(d[self.idkey], life)
+
     def insert_list(self, l):
-        self.db.begin()
+        jobs, life = [], []
         for d in l:
-            self.table.insert(self._preprocess(d))
-        self.db.commit()
+            d, rows = self._split_life(d)
+            jobs.append(self._preprocess(d))
+            life.extend(rows)
+        with self.db:
+            self.table.insert_many(jobs)
+            self.life.insert_many(life)
+        self._uncache(j[self.idkey] for j in jobs)
 
-    def get_by_id(self, id_):
-        j = self.table.find_one(summary=id_)
+    def existing_ids(self, ids):
+        if not self.table.exists:
+            return set()
+        column = self.table.table.c[self.idkey]
+        found = set()
+        # stay below the sqlite limit of host parameters
+        for chunk in chunks(ids, 500):
+            query = select(column).where(column.in_(chunk))
+            found.update(row[self.idkey] for row in self.db.query(query))
+        return found
+
+    def _get_by_id(self, id_):
+        if not self.table.exists:
+            return None
+        j = self.table.find_one(**{self.idkey: id_})
         if j is None:
             return None
         else:
-            return self._deprocess(j)
+            return self._attach_life([self._deprocess(j)])[0]
+
+    def _find(self, d, offset=0, limit=None):
+        """
+        iterator of the jobs (without their life) matching the filter `d`.
+        the filter is run by sqlite, if it cannot be translated
+        the jobs are matched in python.
+        """
+        try:
+            where, params = to_sql(d, set(self.table.columns), encode=self._preprocess_element)
+        except NotPushable:
+            rows = map(self._deprocess, self.table.find(order_by='id'))
+            rows = (j for j in rows if match_query(j, d))
+            return islice(rows, offset, None if limit is None else offset + limit)
+        query = 'SELECT * FROM "{}" WHERE {} ORDER BY "id"'.format(self.table.name, where)
+        if limit is not None or offset:
+            query += ' LIMIT {:d} OFFSET {:d}'.format(-1 if limit is None else limit, offset)
+        return map(self._deprocess, self.db.query(query, **params))
+
+    def count(self, **kw):
+        if list(kw.keys()) == [self.statekey] and isinstance(kw[self.statekey], six.string_types):
+            return self.state_counts().get(kw[self.statekey], 0)
+        try:
+            where, params = to_sql(kw, set(self.table.columns), encode=self._preprocess_element)
+        except NotPushable:
+            return super(Dataset, self).count(**kw)
+        query = 'SELECT COUNT(*) AS nb FROM "{}" WHERE {}'.format(self.table.name, where)
+        return list(self.db.query(query, **params))[0]['nb']
+
+    def state_counts(self):
+        query = 'SELECT state, n FROM "{}" WHERE n > 0'.format(self.counts)
+        return {row['state']: row['n'] for row in self.db.query(query)}
+
+    def rebuild_state_counts(self):
+        with self.db:
+            for sql in rebuild_state_counts_sql(self.table.name, self.counts, self.statekey):
+                self.db.query(sql)
+        return self.state_counts()
 
     def delete(self, d):
-        d = self._preprocess(d)
-        self.table.delete(**d)
+        ids = [j[self.idkey] for j in self._find(d)]
+        with self.db:
+            for chunk in chunks(ids, 500):
+                self.table.delete(self.table.table.c[self.idkey].in_(chunk))
+                self.life.delete(self.life.table.c[self.idkey].in_(chunk))
+        self._uncache(ids)
 
     def get(self, d):
-        d = self._preprocess(d)
-        return map(self._deprocess, self.table.find(**d))
+        return self.get_slice(d)
+
+    def get_slice(self, d, offset=0, limit=None):
+        for chunk in chunks(self._find(d, offset=offset, limit=limit), 500):
+            for j in self._attach_life(chunk):
+                yield j
 
     def update(self, d, id_):
-        d = self._preprocess(d)
-        d[self.idkey] = id_
-        self.table.update(d, [self.idkey])
+        d = dict(d)
+        life = d.pop(self.lifekey, None)
+        with self.db:
+            if d:
+                d = self._preprocess(d)
+                d[self.idkey] = id_
+                self.table.update(d, [self.idkey])
+            if life is not None:
+                self.life.delete(**{self.idkey: id_})
+                self.life.insert_many(self._life_rows(id_, life))
+        self._uncache([id_])
+
+    def update_states(self, l):
+        with self.db:
+            for id_, state, dt in l:
+                if self.table.update({self.idkey: id_, self.statekey: state}, [self.idkey]):
+                    self.life.insert(self._life_rows(id_, [{self.statekey: state, 'dt': dt}])[0])
+        self._uncache(id_ for id_, _, _ in l)
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        if not self.table.exists:
+            return None
+        meta = self._claim_meta(worker, lease)
+        self._create_columns(meta)
+        # the pick and the state change are done by a single UPDATE
+        # statement, sqlite takes the write lock before selecting the
+        # row, so two workers can never get the same job.
+        params = {'state': state, 'new_state': new_state}
+        sets = ['"{s}" = :new_state'.format(s=self.statekey)]
+        for i, (k, v) in enumerate(meta.items()):
+            sets.append('"{}" = :m{}'.format(k, i))
+            params['m{}'.format(i)] = v
+        query = (
+            'UPDATE "{t}" SET {sets} WHERE "id" = '
+            '(SELECT "id" FROM "{t}" WHERE "{s}" = :state LIMIT 1) '
+            'RETURNING *'.format(t=self.table.name, s=self.statekey, sets=', '.join(sets)))
+        with self.db:
+            rows = list(self.db.query(query, **params))
+            if len(rows) == 0:
+                return None
+            j = self._deprocess(rows[0])
+            life = [{self.statekey: new_state, 'dt': datetime.now()}]
+            self.life.insert_many(self._life_rows(j[self.idkey], life))
+        self._uncache([j[self.idkey]])
+        return self._attach_life([j])[0]
+
+    def _create_columns(self, values):
+        """create the columns of the fields of `values` which do not exist yet"""
+        for k, v in values.items():
+            if not self.table.has_column(k):
+                try:
+                    self.table.create_column_by_example(k, v)
+                except OperationalError:
+                    # created in the meantime by another worker
+                    self.db._flush_tables()
+
+    def heartbeat(self, s, lease=DEFAULT_LEASE, worker=None, state=RUNNING):
+        if not self.table.exists:
+            return False
+        if worker is not None and not self.table.has_column(self.workerkey):
+            return False
+        params = {'id': s, 'state': state, 'lease': time.time() + lease, 'worker': worker}
+        self._create_columns({self.leasekey: params['lease']})
+        where = '"{i}" = :id AND "{s}" = :state'
+        if worker is not None:
+            where += ' AND "{w}" = :worker'
+        query = ('UPDATE "{t}" SET "{l}" = :lease WHERE ' + where + ' RETURNING "id"').format(
+            t=self.table.name, l=self.leasekey, i=self.idkey, s=self.statekey, w=self.workerkey)
+        with self.db:
+            found = len(list(self.db.query(query, **params))) > 0
+        self._uncache([s])
+        return found
+
+    def reap(self, state=RUNNING, new_state=AVAILABLE, now=None):
+        if not self.table.exists or not self.table.has_column(self.leasekey):
+            # no job has been claimed with a lease
+            return []
+        now = time.time() if now is None else now
+        # the expired jobs are checked and moved by one UPDATE statement,
+        # a job which finished or got a heartbeat before it is kept.
+        query = (
+            'UPDATE "{t}" SET "{s}" = :new_state WHERE "{s}" = :state AND "{l}" < :now '
+            'RETURNING "{i}"'.format(t=self.table.name, s=self.statekey, l=self.leasekey, i=self.idkey))
+        life = [{self.statekey: new_state, 'dt': datetime.now()}]
+        with self.db:
+            ids = [row[self.idkey] for row in self.db.query(query, new_state=new_state, state=state, now=now)]
+            self.life.insert_many([row for s in ids for row in self._life_rows(s, life)])
+        self._uncache(ids)
+        return ids
+
+    def _begin_batch(self):
+        # the `with self.db` blocks of the writes are nested in this
+        # transaction, dataset only commits the outermost one.
+        self.db.begin()
+
+    def _commit_batch(self):
+        self.db.commit()
+
+    def _rollback_batch(self):
+        self.db.rollback()
 
     def close(self):
         pass
@@ -65,5 +347,7 @@ class Dataset(GenericDB):
 def date_handler(obj):
     if hasattr(obj, 'isoformat'):
         return obj.isoformat()
+    elif isinstance(obj, six.string_types):
+        return obj
     else:
         raise TypeError
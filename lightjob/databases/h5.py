@@ -1,51 +1,315 @@
 import os
 import json
+import six
+from datetime import datetime
 
+import numpy as np
 import h5py
 
 from .base import GenericDB
+from .query import match_query
+from .query import flatten_query
 
+from ..db import AVAILABLE, RUNNING
 from ..utils import recur_update
-from ..utils import match
+from ..utils import chunks
+from ..instrument import timed_serializer
+from ..instrument import counted_commits
 
 
 class H5py(GenericDB):
+    """
+    hdf5 database.
+    the jobs are the rows of three resizable, chunked datasets of the
+    group 'jobs' :
+
+    - 'summary' : the id of the job, empty for deleted jobs.
+      it is read once when the db is loaded to build the index
+      from ids to rows.
+    - 'state' : the state of the job, so that the jobs with a given state
+      are found and counted without decoding them.
+    - 'doc' : the other fields of the job, encoded in json.
+
+    the life of each job is stored apart, in a resizable dataset
+    of the group 'life' named after the job id, so that changing the
+    state of a job only writes its state and appends to its life.
+
+    the number of jobs of each state is kept in the attributes of the
+    group 'state_counts', updated by each write of the states.
+
+    the db can only be used by one process at a time : hdf5 locks the
+    file while it is open, and the index from ids to rows is built once
+    when the db is loaded. use `lightjob serve` to share it between
+    processes (e.g. several runners).
+    """
 
     def load_from_dir(self, dirname):
-        self.db = h5py.File(os.path.join(dirname, 'db.hdf5'))
+        self.db = h5py.File(os.path.join(dirname, 'db.hdf5'), 'a')
+        new_counts = 'state_counts' not in self.db
+        self.counts = self.db.require_group('state_counts')
+        if 'life' not in self.db:
+            self.life = self.db.create_group('life')
+            self._migrate_life()
+        else:
+            self.life = self.db['life']
+        if 'jobs' not in self.db:
+            self.jobs = self.db.create_group('jobs')
+            for name in ('summary', 'state', 'doc'):
+                self.jobs.create_dataset(
+                    name, shape=(0,), maxshape=(None,), chunks=(1024,),
+                    dtype=h5py.string_dtype())
+            self.rows = {}
+            self._migrate_attrs()
+        else:
+            self.jobs = self.db['jobs']
+            self.rows = {
+                id_: row for row, id_ in enumerate(self.jobs['summary'].asstr()[:]) if id_}
+        if new_counts:
+            # new db, or db created before the counters
+            self.rebuild_state_counts()
+
+    def _migrate_life(self):
+        """move the life lists stored by older versions in the attributes to 'life'"""
+        for id_, v in list(self.db.attrs.items()):
+            j = json.loads(v)
+            if self.lifekey in j:
+                self._write_life(id_, j.pop(self.lifekey))
+                self.db.attrs[id_] = json.dumps(j, default=date_handler)
+        self.db.flush()
+
+    def _migrate_attrs(self):
+        """move the jobs stored by older versions in the attributes to 'jobs'"""
+        jobs = [json.loads(v) for v in self.db.attrs.values()]
+        if jobs:
+            self._write_jobs(jobs)
+            for id_ in list(self.db.attrs.keys()):
+                del self.db.attrs[id_]
+        self.db.flush()
+
+    def _write_jobs(self, l):
+        """write the jobs of `l` (without their life), in place for existing ids"""
+        columns = {}
+        for j in l:
+            j = dict(j)
+            j.pop(self.lifekey, None)
+            state = j.pop(self.statekey, None)
+            columns[j[self.idkey]] = (
+                j[self.idkey],
+                state if state is not None else '',
+                self._dumps(j))
+        new = [id_ for id_ in columns.keys() if id_ not in self.rows]
+        counts = {}
+        for id_, values in columns.items():
+            if id_ in self.rows:
+                _add_count(counts, self.jobs['state'].asstr()[self.rows[id_]], -1)
+            _add_count(counts, values[1], 1)
+        self._count_states(counts)
+        for id_, values in columns.items():
+            if id_ in self.rows:
+                for name, value in zip(('summary', 'state', 'doc'), values):
+                    self.jobs[name][self.rows[id_]] = value
+        if new:
+            # the new jobs are appended with one write per column
+            n = self.jobs['summary'].shape[0]
+            for i, name in enumerate(('summary', 'state', 'doc')):
+                self.jobs[name].resize((n + len(new),))
+                self.jobs[name][n:] = [columns[id_][i] for id_ in new]
+            for row, id_ in enumerate(new, n):
+                self.rows[id_] = row
+        self._uncache(columns.keys())
+
+    def _dumps(self, obj):
+        return json.dumps(obj, default=date_handler)
+
+    def _instrument(self, stats):
+        self._dumps = timed_serializer(stats, self._dumps)
+        self.db.flush = counted_commits(stats, self.db.flush)
+
+    def _read_job(self, row, life=True):
+        j = json.loads(self.jobs['doc'].asstr()[row])
+        state = self.jobs['state'].asstr()[row]
+        if state:
+            j[self.statekey] = state
+        if life:
+            j[self.lifekey] = self._read_life(j[self.idkey])
+        return j
+
+    def _read_life(self, id_):
+        if id_ not in self.life:
+            return []
+        return [json.loads(l) for l in self.life[id_].asstr()[:]]
+
+    def _write_life(self, id_, life):
+        if id_ in self.life:
+            del self.life[id_]
+        self._append_life_entries(id_, life)
+
+    def _append_life_entries(self, id_, entries):
+        if id_ not in self.life:
+            self.life.create_dataset(
+                id_, shape=(0,), maxshape=(None,), chunks=(16,),
+                dtype=h5py.string_dtype())
+        ds = self.life[id_]
+        n = ds.shape[0]
+        ds.resize((n + len(entries),))
+        if entries:
+            ds[n:] = [self._dumps(l) for l in entries]
+
+    def _count_states(self, counts):
+        """add `counts` (state -> number of jobs) to the counters of the states"""
+        attrs = self.counts.attrs
+        for state, n in counts.items():
+            if n:
+                attrs[state] = int(attrs.get(state, 0)) + n
+
+    def state_counts(self):
+        return {state: int(n) for state, n in self.counts.attrs.items() if n > 0}
+
+    def rebuild_state_counts(self):
+        states, counts = np.unique(self.jobs['state'].asstr()[:], return_counts=True)
+        attrs = self.counts.attrs
+        for state in list(attrs.keys()):
+            del attrs[state]
+        for state, n in zip(states, counts):
+            if state:
+                attrs[str(state)] = int(n)
+        self._flush()
+        return self.state_counts()
+
+    def _rows_with_state(self, state):
+        states = self.jobs['state'].asstr()[:]
+        return np.flatnonzero(states == state)
+
+    def _candidate_rows(self, d):
+        """rows that can match the filter `d`, using the id and the state columns"""
+        for path, cond in flatten_query(d):
+            if list(cond.keys()) != ['$eq'] or len(path) != 1:
+                continue
+            if path[0] == self.idkey:
+                row = self.rows.get(cond['$eq'])
+                return [] if row is None else [row]
+            if path[0] == self.statekey and cond['$eq'] is not None:
+                return self._rows_with_state(cond['$eq'])
+        return sorted(self.rows.values())
 
     def insert(self, d):
-        self.db.attrs[d[self.idkey]] = json.dumps(d, default=date_handler)
+        self.insert_list([d])
 
     def insert_list(self, l):
+        self._write_jobs(l)
         for j in l:
-            self.insert(j)
+            self._write_life(j[self.idkey], j.get(self.lifekey, []))
+        self._flush()
+
+    def _get_by_id(self, id_):
+        row = self.rows.get(id_)
+        return self._read_job(row) if row is not None else None
 
-    def get_by_id(self, id_):
-        d = self.db.attrs.get(id_, None)
-        return json.loads(d) if d else None
+    def existing_ids(self, ids):
+        return set(id_ for id_ in ids if id_ in self.rows)
 
     def delete(self, d):
-        del self.db.attrs[d[self.idkey]]
+        ids = [j[self.idkey] for j in self.get(d)]
+        counts = {}
+        for id_ in ids:
+            row = self.rows.pop(id_)
+            _add_count(counts, self.jobs['state'].asstr()[row], -1)
+            self.jobs['summary'][row] = ''
+            self.jobs['state'][row] = ''
+            self.jobs['doc'][row] = ''
+            if id_ in self.life:
+                del self.life[id_]
+        self._count_states(counts)
+        self._flush()
+        self._uncache(ids)
+
+    def _read_jobs(self, rows):
+        """decode the jobs (without their life) of the sorted `rows`, reading blocks of rows"""
+        for block in chunks(rows, 1024):
+            block = list(block)
+            docs = self.jobs['doc'].asstr()[block]
+            states = self.jobs['state'].asstr()[block]
+            for doc, state in zip(docs, states):
+                j = json.loads(doc)
+                if state:
+                    j[self.statekey] = state
+                yield j
 
     def get(self, d):
-        o = map(json.loads, self.db.attrs.values())
-        o = filter(lambda v: match(v, d), o)
-        return o
+        for j in self._read_jobs(self._candidate_rows(d)):
+            if match_query(j, d):
+                j[self.lifekey] = self._read_life(j[self.idkey])
+                yield j
+
+    def count(self, **kw):
+        if list(kw.keys()) == [self.statekey] and isinstance(kw[self.statekey], six.string_types):
+            return self.state_counts().get(kw[self.statekey], 0)
+        if not kw:
+            return len(self.rows)
+        return super(H5py, self).count(**kw)
 
     def update(self, d, id_):
-        obj = self.get_by_id(id_)
-        recur_update(obj, d)
-        if obj is not None:
-            self.db.attrs[id_] = json.dumps(obj, default=date_handler)
-            return True
-        else:
+        row = self.rows.get(id_)
+        if row is None:
             return False
+        d = dict(d)
+        if self.lifekey in d:
+            self._write_life(id_, d.pop(self.lifekey))
+        obj = recur_update(self._read_job(row, life=False), d)
+        self._write_jobs([obj])
+        return True
+
+    def update_states(self, l):
+        for id_, state, dt in l:
+            row = self.rows.get(id_)
+            if row is None:
+                continue
+            counts = {}
+            _add_count(counts, self.jobs['state'].asstr()[row], -1)
+            _add_count(counts, state, 1)
+            self._count_states(counts)
+            self.jobs['state'][row] = state
+            self._append_life_entries(id_, [{self.statekey: state, 'dt': dt}])
+        self._flush()
+        self._uncache(id_ for id_, _, _ in l)
+
+    def _flush(self):
+        """flush the writes to the file, unless they are grouped by `batch`"""
+        if not self.in_batch:
+            self.db.flush()
+
+    def _commit_batch(self):
+        self.db.flush()
+
+    def _rollback_batch(self):
+        # hdf5 has no transactions, the writes of the batch are kept
+        self.db.flush()
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        # the file is opened by one process at a time, so the pick
+        # and the state change cannot be interleaved with another claim
+        rows = self._rows_with_state(state)
+        if len(rows) == 0:
+            return None
+        j = self._read_job(rows[0], life=False)
+        j[self.statekey] = new_state
+        j.update(self._claim_meta(worker, lease))
+        self._write_jobs([j])
+        self._append_life_entries(
+            j[self.idkey], [{self.statekey: new_state, 'dt': datetime.now()}])
+        self._flush()
+        return self._get_by_id(j[self.idkey])
 
     def close(self):
         self.db.close()
 
 
+def _add_count(counts, state, n):
+    # the deleted rows and the jobs without state have an empty state
+    if state:
+        counts[state] = counts.get(state, 0) + n
+
+
 def date_handler(obj):
     if hasattr(obj, 'isoformat'):
         return obj.isoformat()
@@ -0,0 +1,472 @@
+"""
+in-memory database persisted with a write-ahead log.
+
+the jobs are kept in a dict from ids to jobs, with secondary indexes
+from the values of some top-level fields (the state, the worker, ...)
+to the ids of the jobs, so that the jobs with a given state are found,
+counted and claimed without looking at the others.
+
+each write is appended as one json line to the log 'memory.wal' of the
+db folder before it is applied in memory, and the log is replayed when
+the db is loaded. once the log has `snapshot_every` records, all the
+jobs are written to the snapshot 'memory.snapshot' and a new log is
+started. both files start with a header holding their generation, a
+log is only replayed on the snapshot of the same generation, so a crash
+between writing a snapshot and starting the new log is harmless.
+
+the db is meant to be opened by one process at a time (it is locked),
+use `lightjob serve` to share it between processes.
+"""
+import os
+import json
+import time
+from datetime import datetime
+from collections import OrderedDict
+
+from .base import GenericDB
+from .query import flatten_query
+from .query import compile_query
+from .query import MISSING
+
+from ..db import AVAILABLE, RUNNING
+from ..utils import recur_update
+from ..utils import json_default
+from ..utils import copy_job
+from ..instrument import timed_serializer
+from ..instrument import counted_commits
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+SNAPSHOTFILENAME = 'memory.snapshot'
+WALFILENAME = 'memory.wal'
+MEMORYLOCKFILENAME = 'memory.lock'
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+_replace = getattr(os, 'replace', os.rename)  # python 2
+
+
+class Memory(GenericDB):
+    """
+    in-memory database persisted with a write-ahead log
+    and snapshots, see the module docstring.
+
+    Parameters
+    ----------
+
+    fsync : 'always', 'interval' or 'never'[default='interval']
+        when the log is synced to the disk. each record is written
+        to the os when it is appended, so it survives a crash of the
+        process, but only the synced records survive a crash of the machine.
+        - 'always' : after each record
+        - 'interval' : at most every `fsync_interval` seconds
+        - 'never' : left to the os, also when the db is closed
+          (the snapshots are always synced)
+    fsync_interval : float[default=1.]
+        seconds between two syncs with fsync='interval'
+    snapshot_every : int[default=100000]
+        number of records of the log after which a snapshot is written,
+        0 to only write snapshots when `snapshot` is called.
+    indexes : list of str, optional
+        top-level fields indexed in addition to the state,
+        by default the worker field.
+    """
+
+    def __init__(self, fsync='interval', fsync_interval=1., snapshot_every=100000, indexes=None, **kw):
+        super(Memory, self).__init__(**kw)
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync should be one of {}, got {}'.format(', '.join(FSYNC_POLICIES), fsync))
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        if indexes is None:
+            indexes = [self.workerkey]
+        self.indexed = [self.statekey] + [f for f in indexes if f != self.statekey]
+        self.jobs = OrderedDict()
+        self.indexes = {}
+        self.wal = None
+        # lines of the log not written yet, during a batch
+        self.pending = []
+        self.lockfile = None
+        self.generation = 0
+        self.records = 0
+        self.last_sync = time.time()
+
+    def load_from_dir(self, dirname):
+        self._lock(dirname)
+        self._read(dirname)
+
+    def _read(self, dirname):
+        """read the jobs from the snapshot and the log of `dirname`"""
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+        self.jobs = OrderedDict()
+        # field -> value -> ids of the jobs, in the order they got the value
+        self.indexes = {field: {} for field in self.indexed}
+        self.generation = 0
+        filename = os.path.join(dirname, SNAPSHOTFILENAME)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as fd:
+                self.generation = json.loads(fd.readline().decode('utf-8'))['generation']
+                for line in fd:
+                    j = json.loads(line.decode('utf-8'))
+                    self.jobs[j[self.idkey]] = j
+                    self._index_job(j)
+        filename = os.path.join(dirname, WALFILENAME)
+        records = self._replay(filename)
+        if records is None:
+            self._new_wal(self.generation)
+        else:
+            self.wal = open(filename, 'ab')
+            self.records = records
+            if self.snapshot_every and records >= self.snapshot_every:
+                self.snapshot()
+
+    def _lock(self, dirname):
+        self.lockfile = open(os.path.join(dirname, MEMORYLOCKFILENAME), 'a')
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self.lockfile.close()
+            self.lockfile = None
+            raise IOError('{} is opened by another process, '
+                          'use `lightjob serve` to share it'.format(dirname))
+
+    def _replay(self, filename):
+        """
+        apply the records of the log `filename`, a record cut by
+        a crash is removed from the log.
+        return the number of records, or None if there is no log
+        for the current snapshot.
+        """
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as fd:
+            try:
+                generation = json.loads(fd.readline().decode('utf-8'))['generation']
+            except ValueError:  # the header was not written
+                return None
+            if generation < self.generation:  # already in the snapshot
+                return None
+            if generation > self.generation:
+                raise ValueError('the log of {} is more recent than its snapshot'.format(filename))
+            end = fd.tell()
+            records = 0
+            for line in fd:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    rec = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self._apply(rec)
+                records += 1
+                end += len(line)
+        if end < os.path.getsize(filename):
+            with open(filename, 'r+b') as fd:
+                fd.truncate(end)
+        return records
+
+    def _new_wal(self, generation):
+        """replace the log by an empty log of `generation`"""
+        if self.wal is not None:
+            self.wal.close()
+        filename = os.path.join(self.dirname, WALFILENAME)
+        _write_file(filename + '.tmp', [{'generation': generation}])
+        _replace(filename + '.tmp', filename)
+        self.wal = open(filename, 'ab')
+        self.records = 0
+
+    def snapshot(self):
+        """write all the jobs to a new snapshot and start a new log"""
+        if self.in_batch:
+            raise RuntimeError('a snapshot cannot be written during a batch')
+        generation = self.generation + 1
+        filename = os.path.join(self.dirname, SNAPSHOTFILENAME)
+        header = {'generation': generation, 'jobs': len(self.jobs)}
+        _write_file(filename + '.tmp', [header], self.jobs.values())
+        _replace(filename + '.tmp', filename)
+        self.generation = generation
+        self._new_wal(generation)
+
+    def _write(self, rec, native=False):
+        """
+        append the record `rec` to the log and apply it.
+        unless the record is `native` (only made of strings, numbers,
+        lists and dicts), the decoded json is applied, so that the jobs
+        in memory are the ones read from the log after a restart
+        and share nothing with the objects of the caller.
+        """
+        line = self._dumps(rec)
+        if not native:
+            rec = json.loads(line)
+        self.pending.append(line)
+        if self.in_batch:
+            # written at the end of the batch
+            self._apply(rec)
+            return
+        self._write_pending()
+        self._apply(rec)
+        if self.snapshot_every and self.records >= self.snapshot_every:
+            self.snapshot()
+
+    def _dumps(self, rec):
+        return json.dumps(rec, default=json_default)
+
+    def _instrument(self, stats):
+        self._dumps = timed_serializer(stats, self._dumps)
+        write_pending = counted_commits(stats, self._write_pending)
+
+        def instrumented_write_pending():
+            # a call with nothing to write is not a commit
+            if self.pending:
+                write_pending()
+        self._write_pending = instrumented_write_pending
+
+    def _write_pending(self):
+        """append the pending lines to the log, with one write and at most one fsync"""
+        if not self.pending:
+            return
+        self.wal.write(b''.join(line.encode('utf-8') + b'\n' for line in self.pending))
+        self.wal.flush()
+        if self.fsync == 'always' or (
+                self.fsync == 'interval' and time.time() - self.last_sync >= self.fsync_interval):
+            os.fsync(self.wal.fileno())
+            self.last_sync = time.time()
+        self.records += len(self.pending)
+        del self.pending[:]
+
+    def _commit_batch(self):
+        self._write_pending()
+        if self.snapshot_every and self.records >= self.snapshot_every:
+            self.snapshot()
+
+    def _rollback_batch(self):
+        # the records of the batch were applied but not written,
+        # the jobs are read again from the disk.
+        del self.pending[:]
+        self._read(self.dirname)
+
+    def _apply(self, rec):
+        op = rec['op']
+        if op == 'insert':
+            self._uncache(j[self.idkey] for j in rec['jobs'])
+            for j in rec['jobs']:
+                old = self.jobs.get(j[self.idkey])
+                if old is not None:
+                    self._unindex_job(old)
+                self.jobs[j[self.idkey]] = j
+                self._index_job(j)
+        elif op == 'delete':
+            self._uncache(rec['ids'])
+            for id_ in rec['ids']:
+                j = self.jobs.pop(id_, None)
+                if j is not None:
+                    self._unindex_job(j)
+        elif op in ('update', 'states', 'claim'):
+            if op == 'states':
+                changes = rec['states']
+            else:
+                changes = [(rec['id'], rec.get('state'), rec.get('dt'))]
+            self._uncache(id_ for id_, _, _ in changes)
+            for id_, state, dt in changes:
+                j = self.jobs.get(id_)
+                if j is None:
+                    continue
+                keys = self._index_keys(j)
+                if op == 'update':
+                    recur_update(j, rec['values'])
+                elif op == 'claim':
+                    j.update(rec['meta'])
+                if state is not None:
+                    self._append_life(j, state, dt)
+                self._reindex_job(j, keys)
+        else:
+            raise ValueError('unknown record : {}'.format(op))
+
+    def _index_keys(self, j):
+        return [j.get(field, MISSING) for field in self.indexed]
+
+    def _index_job(self, j, fields=None):
+        id_ = j[self.idkey]
+        for field in fields or self.indexed:
+            index = self.indexes[field]
+            key = j.get(field, MISSING)
+            try:
+                ids = index.get(key)
+                if ids is None:
+                    ids = index[key] = OrderedDict()
+            except TypeError:  # unhashable values are not indexed
+                continue
+            ids[id_] = None
+
+    def _unindex_job(self, j):
+        for field, key in zip(self.indexed, self._index_keys(j)):
+            self._remove_from_index(field, key, j[self.idkey])
+
+    def _remove_from_index(self, field, key, id_):
+        index = self.indexes[field]
+        try:
+            ids = index.get(key)
+        except TypeError:
+            return
+        if ids is not None:
+            ids.pop(id_, None)
+            if not ids:
+                del index[key]
+
+    def _reindex_job(self, j, keys):
+        """
+        move `j` in the indexes of the fields which changed, `keys` are its
+        values before the change. the other indexes keep the order of the jobs.
+        """
+        new = self._index_keys(j)
+        changed = [i for i, (a, b) in enumerate(zip(keys, new)) if a is not b and a != b]
+        for i in changed:
+            self._remove_from_index(self.indexed[i], keys[i], j[self.idkey])
+        if changed:
+            self._index_job(j, [self.indexed[i] for i in changed])
+
+    def _ids_with(self, field, values):
+        """ids of the jobs whose indexed `field` is one of `values` (not a copy)"""
+        index = self.indexes[field]
+        if len(values) == 1 and values[0] is not None:
+            return index.get(values[0], ())
+        ids = OrderedDict()
+        for v in values:
+            ids.update(index.get(v, ()))
+            if v is None:  # null matches the missing fields
+                ids.update(index.get(MISSING, ()))
+        return ids
+
+    def _candidates(self, d):
+        """ids of the jobs which can match the filter `d`, using the indexes"""
+        for path, cond in flatten_query(d):
+            if len(path) != 1 or len(cond) != 1:
+                continue
+            (op, ref), = cond.items()
+            try:
+                if path[0] == self.idkey and op == '$eq':
+                    return [ref] if ref in self.jobs else []
+                if path[0] in self.indexes and op in ('$eq', '$in'):
+                    return list(self._ids_with(path[0], [ref] if op == '$eq' else list(ref)))
+            except TypeError:  # unhashable values
+                continue
+        return list(self.jobs.keys())
+
+    def _matching(self, d):
+        match = compile_query(d)
+        for id_ in self._candidates(d):
+            j = self.jobs.get(id_)
+            if j is not None and match(j):
+                yield j
+
+    def insert(self, d):
+        self.insert_list([d])
+
+    def insert_list(self, l):
+        l = list(l)
+        if l:
+            self._write({'op': 'insert', 'jobs': l})
+
+    def get(self, d):
+        for j in self._matching(d):
+            yield copy_job(j)
+
+    def _get_by_id(self, id_):
+        j = self.jobs.get(id_)
+        return copy_job(j) if j is not None else None
+
+    def existing_ids(self, ids):
+        return set(id_ for id_ in ids if id_ in self.jobs)
+
+    def job_exists_by_summary(self, s):
+        return s in self.jobs
+
+    def get_state_of(self, summary):
+        return self.jobs[summary][self.statekey]
+
+    def count(self, **kw):
+        if not kw:
+            return len(self.jobs)
+        if list(kw.keys()) == [self.statekey]:
+            try:
+                return len(self._ids_with(self.statekey, [kw[self.statekey]]))
+            except TypeError:
+                pass
+        return sum(1 for _ in self._matching(kw))
+
+    def state_counts(self):
+        # the counters are the sizes of the buckets of the index of the states
+        return {state: len(ids) for state, ids in self.indexes[self.statekey].items()
+                if state is not MISSING and state is not None}
+
+    def rebuild_state_counts(self):
+        self.indexes[self.statekey] = {}
+        for j in self.jobs.values():
+            self._index_job(j, [self.statekey])
+        return self.state_counts()
+
+    def delete(self, d):
+        ids = [j[self.idkey] for j in self._matching(d)]
+        if ids:
+            self._write({'op': 'delete', 'ids': ids}, native=True)
+
+    def update(self, d, id_):
+        if id_ not in self.jobs:
+            return False
+        self._write({'op': 'update', 'id': id_, 'values': d})
+        return True
+
+    def update_states(self, l):
+        states = [(id_, state, _isoformat(dt)) for id_, state, dt in l if id_ in self.jobs]
+        if states:
+            self._write({'op': 'states', 'states': states}, native=True)
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        try:
+            ids = self.indexes[self.statekey].get(state)
+        except TypeError:
+            return None
+        if not ids:
+            return None
+        id_ = next(iter(ids))
+        self._write({
+            'op': 'claim',
+            'id': id_,
+            'state': new_state,
+            'dt': _isoformat(datetime.now()),
+            'meta': self._claim_meta(worker, lease),
+        })
+        return self._get_by_id(id_)
+
+    def close(self):
+        if self.wal is not None:
+            self._write_pending()
+            self.wal.flush()
+            if self.fsync != 'never':
+                os.fsync(self.wal.fileno())
+            self.wal.close()
+            self.wal = None
+        if self.lockfile is not None:
+            self.lockfile.close()
+            self.lockfile = None
+
+
+def _isoformat(dt):
+    return dt.isoformat() if hasattr(dt, 'isoformat') else dt
+
+
+def _write_file(filename, *parts):
+    """write the objects of `parts` as json lines in `filename` and sync it"""
+    with open(filename, 'wb') as fd:
+        for part in parts:
+            for obj in part:
+                fd.write(json.dumps(obj, default=json_default).encode('utf-8') + b'\n')
+        fd.flush()
+        os.fsync(fd.fileno())
@@ -0,0 +1,358 @@
+"""
+compile the filter dicts given to `GenericDB.get` into
+something a backend can run.
+
+a filter is a dict like the following:
+
+    {
+        "state": "available",
+        "content": {"lr": 0.1, "model": {"depth": {"$gt": 3}}},
+        "content.batch_size": {"$in": [32, 64]}
+    }
+
+- a key is a field of the job, nested fields are given either
+  with nested dicts or with a dotted key.
+- a value is either the value that the field must be equal to,
+  or a dict of operators : $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists.
+- all the conditions must hold for a job to match.
+
+the operators are the ones of mongodb, which are also understood by
+blitzdb. `to_sql` turns a filter into a sqlite WHERE clause using the
+JSON1 extension for nested fields, `match_query` evaluates a filter
+in python for the backends that cannot push it down.
+"""
+import json
+import operator
+from numbers import Number
+
+import six
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+OPERATORS = ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists')
+COMPARISONS = ('$gt', '$gte', '$lt', '$lte')
+
+
+class NotPushable(Exception):
+    """raised when a filter cannot be translated for a backend"""
+    pass
+
+
+def is_operator_dict(v):
+    return isinstance(v, Mapping) and len(v) > 0 and all(
+        isinstance(k, six.string_types) and k.startswith('$') for k in v.keys())
+
+
+def flatten_query(query, prefix=()):
+    """
+    flatten a filter into a list of (path, condition), where
+    path is a tuple of keys and condition is a dict of operators.
+
+    Parameters
+    ----------
+
+    query : dict
+        the filter
+
+    Returns
+    -------
+
+    list of (tuple of str, dict)
+    """
+    conds = []
+    for k, v in query.items():
+        path = prefix + tuple(k.split('.'))
+        if is_operator_dict(v):
+            for op in v.keys():
+                if op not in OPERATORS:
+                    raise ValueError('unknown operator : {}'.format(op))
+            conds.append((path, dict(v)))
+        elif isinstance(v, Mapping) and len(v) > 0:
+            conds.extend(flatten_query(v, prefix=path))
+        else:
+            conds.append((path, {'$eq': v}))
+    return conds
+
+
+def dotted_query(query):
+    """
+    rewrite a filter with nested dicts into a flat filter with
+    dotted keys, e.g. {"content": {"lr": 0.1}} becomes {"content.lr": 0.1},
+    which is the syntax of blitzdb and mongodb.
+    blitzdb only takes one operator per key, so the conditions
+    are combined with $and.
+    blitzdb never matches a missing field, the condition $eq null
+    is completed with $exists.
+    blitzdb only runs the conditions which match a superset of the
+    jobs matched by `match_query`, so the jobs it returns must be
+    matched again with `match_query` :
+
+    - the comparisons ($gt, $gte, $lt, $lte) are left out, blitzdb
+      raises a TypeError on the values which cannot be compared
+      (e.g. null or a string with a number).
+    - $ne and $nin are left out, like mongodb they do not match
+      the lists containing the value.
+    - $eq and $in also match the lists containing the value.
+    """
+    conds = []
+    for path, cond in flatten_query(query):
+        key = '.'.join(path)
+        for op, ref in cond.items():
+            if op in COMPARISONS or op in ('$ne', '$nin'):
+                continue
+            c = {key: ref if op == '$eq' else {op: ref}}
+            if op == '$eq' and ref is None:
+                c = {'$or': [c, {key: {'$exists': False}}]}
+            conds.append(c)
+    if len(conds) == 1:
+        return conds[0]
+    return {'$and': conds} if conds else {}
+
+
+MISSING = object()
+
+
+def get_path(d, path):
+    """value of `path` in the dict `d` (or a blitzdb document), or MISSING"""
+    for k in path:
+        if isinstance(d, (six.string_types, list, tuple)):
+            return MISSING
+        try:
+            d = d[k]
+        except (KeyError, TypeError, AttributeError):
+            return MISSING
+    return d
+
+
+def _compare(op):
+    def f(a, b):
+        if a is MISSING or a is None or b is None:
+            return False
+        try:
+            return op(a, b)
+        except TypeError:
+            return False
+    return f
+
+
+def _eq(a, b):
+    if a is MISSING:
+        return b is None
+    return a == b
+
+
+def _in(a, b):
+    return any(_eq(a, v) for v in b)
+
+
+def _exists(a, b):
+    return (a is not MISSING) == bool(b)
+
+
+MATCHERS = {
+    '$eq': _eq,
+    '$ne': lambda a, b: not _eq(a, b),
+    '$gt': _compare(operator.gt),
+    '$gte': _compare(operator.ge),
+    '$lt': _compare(operator.lt),
+    '$lte': _compare(operator.le),
+    '$in': _in,
+    '$nin': lambda a, b: not _in(a, b),
+    '$exists': _exists,
+}
+
+
+def compile_query(query):
+    """
+    predicate returning True for the jobs which match the filter `query`,
+    the filter is flattened once instead of once per job.
+
+    Parameters
+    ----------
+
+    query : dict
+        filter, see the module docstring
+    """
+    conds = [(path, [(MATCHERS[op], ref) for op, ref in cond.items()])
+             for path, cond in flatten_query(query)]
+
+    def match(d):
+        for path, matchers in conds:
+            value = get_path(d, path)
+            for matcher, ref in matchers:
+                if not matcher(value, ref):
+                    return False
+        return True
+    return match
+
+
+def match_query(d, query):
+    """
+    return True if the job `d` matches the filter `query`.
+
+    Parameters
+    ----------
+
+    d : dict
+        job
+    query : dict
+        filter, see the module docstring
+    """
+    return compile_query(query)(d)
+
+
+SQL_OPERATORS = {
+    '$gt': '>',
+    '$gte': '>=',
+    '$lt': '<',
+    '$lte': '<=',
+}
+
+
+def json_path(keys):
+    """sqlite JSON1 path of a list of keys, e.g. $."a"."b" """
+    for k in keys:
+        if '"' in k:
+            raise NotPushable('cannot quote the key {}'.format(k))
+    return '$' + ''.join('."{}"'.format(k) for k in keys)
+
+
+def _encode(v):
+    return json.dumps(v) if isinstance(v, (list, dict)) else v
+
+
+def to_sql(query, columns, encode=None, rest=None):
+    """
+    translate a filter into a sqlite WHERE clause.
+    the first key of each path is a column of the table, the
+    other keys are looked up inside the column, which is expected to
+    contain json, with `json_extract`.
+
+    Parameters
+    ----------
+
+    query : dict
+        filter, see the module docstring
+    columns : set of str
+        columns of the table, the conditions on other columns
+        are evaluated on NULL.
+    encode : callable, optional
+        function used to encode the values compared to whole
+        columns, by default lists and dicts are encoded with json.dumps
+    rest : str, optional
+        column holding the json dict of the fields which are not
+        columns, the conditions on these fields are looked up in it.
+
+    Returns
+    -------
+
+    (str, dict) : the clause with named parameters and the parameters.
+                  the clause is '1' if the filter is empty.
+    """
+    encode = encode or _encode
+    clauses = []
+    params = {}
+
+    def param(v):
+        name = 'p{}'.format(len(params))
+        params[name] = v
+        return ':' + name
+
+    if rest is not None:
+        columns = set(columns) | {rest}
+    for path, cond in flatten_query(query):
+        if rest is not None and (path[0] not in columns or path[0] == rest):
+            path = (rest,) + path
+        column = path[0]
+        if ':' in column:
+            raise NotPushable('cannot quote the column {}'.format(column))
+        col = '"{}"'.format(column.replace('"', '""'))
+        nested = len(path) > 1
+        if nested:
+            # non-json values of the column are seen as NULL
+            doc = 'CASE WHEN json_valid({c}) THEN {c} END'.format(c=col)
+            jpath = param(json_path(path[1:]))
+        if column not in columns:
+            expr = 'NULL'
+        elif nested:
+            expr = 'json_extract({}, {})'.format(doc, jpath)
+        else:
+            expr = col
+        # type of the value, sqlite orders the values of different types
+        # (e.g. text after numbers) where python does not compare them
+        if nested and column in columns:
+            vtype = 'json_type({}, {})'.format(doc, jpath)
+            numeric = "('integer', 'real', 'true', 'false')"
+        else:
+            vtype = 'typeof({})'.format(expr)
+            numeric = "('integer', 'real')"
+
+        def same_type(v):
+            """condition that the value has the type of `v`, comparable with it in python"""
+            if isinstance(v, Number):
+                return '{} IN {}'.format(vtype, numeric)
+            if isinstance(v, six.string_types):
+                return "{} = 'text'".format(vtype)
+            raise NotPushable('cannot compare with {!r}'.format(v))
+
+        def value(v):
+            if isinstance(v, (list, dict)):
+                if nested:
+                    return 'json({})'.format(param(json.dumps(v)))
+                return param(encode(v))
+            if isinstance(v, bool) and nested:
+                return param(int(v))
+            return param(encode(v))
+
+        for op, ref in cond.items():
+            if op == '$eq':
+                if ref is None:
+                    clauses.append('{} IS NULL'.format(expr))
+                elif nested and isinstance(ref, six.string_types):
+                    # json_extract returns lists and dicts as json text
+                    clauses.append('({} AND {} = {})'.format(same_type(ref), expr, value(ref)))
+                else:
+                    clauses.append('{} = {}'.format(expr, value(ref)))
+            elif op == '$ne':
+                if ref is None:
+                    clauses.append('{} IS NOT NULL'.format(expr))
+                elif nested and isinstance(ref, six.string_types):
+                    clauses.append('({e} IS NULL OR NOT {t} OR {e} != {v})'.format(
+                        e=expr, t=same_type(ref), v=value(ref)))
+                else:
+                    clauses.append('({e} IS NULL OR {e} != {v})'.format(e=expr, v=value(ref)))
+            elif op in SQL_OPERATORS:
+                if ref is None:
+                    # nothing is compared with null
+                    clauses.append('0')
+                else:
+                    clauses.append('({} AND {} {} {})'.format(
+                        same_type(ref), expr, SQL_OPERATORS[op], value(ref)))
+            elif op in ('$in', '$nin'):
+                ref = list(ref)
+                if any(v is None or isinstance(v, (list, dict)) for v in ref):
+                    raise NotPushable('{} with null or structured values'.format(op))
+                values = ', '.join(value(v) for v in ref)
+                if op == '$in':
+                    clauses.append('{} IN ({})'.format(expr, values) if ref else '0')
+                else:
+                    clauses.append('({e} IS NULL OR {e} NOT IN ({v}))'.format(e=expr, v=values)
+                                   if ref else '1')
+            elif op == '$exists':
+                if nested and column in columns:
+                    # json_type is NULL only when the path does not exist
+                    clauses.append('json_type({}, {}) IS {}NULL'.format(
+                        doc, jpath, 'NOT ' if ref else ''))
+                elif column in columns:
+                    # a missing field of a job is a NULL column
+                    clauses.append('{} IS {}NULL'.format(expr, 'NOT ' if ref else ''))
+                else:
+                    clauses.append('1' if not ref else '0')
+            else:
+                raise NotPushable(op)
+    if not clauses:
+        return '1', params
+    return ' AND '.join(clauses), params
@@ -0,0 +1,182 @@
+import os
+import json
+import socket
+from functools import partial
+
+from six.moves import builtins
+
+from .base import GenericDB
+
+from ..db import SOCKETFILENAME
+from ..db import AVAILABLE, RUNNING
+from ..db import DEFAULT_LEASE
+from ..utils import json_default
+from ..utils import summarize
+from ..utils import parse_address
+
+
+class RemoteError(Exception):
+    """error raised by the server which is not a python builtin exception"""
+    pass
+
+
+class Remote(GenericDB):
+    """
+    client of a db served by `lightjob serve` (see lightjob.server).
+    the db is loaded with the folder of the served db, and the
+    server is reached through the unix socket of the folder,
+    or through `address` if it is given.
+    the keys and the hash algorithm of the served db are used.
+
+    Parameters
+    ----------
+
+    address : str, optional
+        path of a unix socket or host:port
+    timeout : float, optional
+        timeout of the socket in seconds
+    chunk_size : int[default=500]
+        number of jobs received at once by `get`
+    """
+
+    def __init__(self, address=None, timeout=None, chunk_size=500, **kw):
+        super(Remote, self).__init__(**kw)
+        self.address = address
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.sock = None
+        self.ids = 0
+
+    def load(self, dirname):
+        # the hash algorithm is the one of the served db,
+        # nothing is written in the folder.
+        self.dirname = dirname
+        self.load_from_dir(dirname)
+
+    def load_from_dir(self, dirname):
+        address = self.address or os.path.join(dirname, SOCKETFILENAME)
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address, timeout=self.timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(address)
+        self.rfile = self.sock.makefile('rb')
+        info = self.call('info')
+        for key in ('idkey', 'contentkey', 'statekey', 'lifekey', 'workerkey', 'leasekey'):
+            setattr(self, key, info[key])
+        if not self.custom_summarize:
+            self.hash_algorithm = info['hash_algorithm']
+            self.summarize = partial(summarize, algorithm=self.hash_algorithm)
+
+    def call(self, method, *args, **kwargs):
+        """call `method` of the served db and return its result"""
+        self.ids += 1
+        req = {'id': self.ids, 'method': method, 'args': args, 'kwargs': kwargs}
+        self.sock.sendall(json.dumps(req, default=json_default).encode('utf-8') + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise RemoteError('the server closed the connection')
+        resp = json.loads(line.decode('utf-8'))
+        error = resp.get('error')
+        if error is not None:
+            exc = getattr(builtins, error['type'], None)
+            if not (isinstance(exc, type) and issubclass(exc, Exception)):
+                exc = RemoteError
+            raise exc(error['message'])
+        return resp['result']
+
+    def insert(self, d):
+        self.insert_list([d])
+
+    def insert_list(self, l):
+        l = list(l)
+        self.call('insert_list', l)
+        self._uncache(j[self.idkey] for j in l)
+
+    def get(self, d):
+        cid = self.call('open_cursor', d)
+        # the server drops the cursor once it is exhausted, it is
+        # closed here if the iteration is stopped before.
+        exhausted = False
+        try:
+            while True:
+                chunk = self.call('next', cid, self.chunk_size)
+                exhausted = len(chunk) < self.chunk_size
+                for j in chunk:
+                    yield j
+                if exhausted:
+                    return
+        finally:
+            if not exhausted and self.sock is not None:
+                try:
+                    self.call('close_cursor', cid)
+                except (socket.error, RemoteError):
+                    pass
+
+    def get_slice(self, d, offset=0, limit=None):
+        return self.call('get_slice', d, offset=offset, limit=limit)
+
+    def _get_by_id(self, id_):
+        return self.call('get_by_id', id_)
+
+    def existing_ids(self, ids):
+        return set(self.call('existing_ids', list(ids)))
+
+    def job_exists_by_summary(self, s):
+        return self.call('job_exists_by_summary', s)
+
+    def get_state_of(self, summary):
+        return self.call('get_state_of', summary)
+
+    def count(self, **kw):
+        return self.call('count', **kw)
+
+    def state_counts(self):
+        return self.call('state_counts')
+
+    def rebuild_state_counts(self):
+        return self.call('rebuild_state_counts')
+
+    def delete(self, d):
+        self.call('delete', d)
+        self._uncache()
+
+    def update(self, d, id_):
+        self._uncache([id_])
+        return self.call('update', d, id_)
+
+    def update_states(self, l):
+        self.call('modify_states', l)
+        self._uncache(id_ for id_, _, _ in l)
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        j = self.call('claim_next', state=state, new_state=new_state, worker=worker, lease=lease)
+        if j is not None:
+            self._uncache([j[self.idkey]])
+        return j
+
+    def heartbeat(self, s, lease=DEFAULT_LEASE, worker=None, state=RUNNING):
+        self._uncache([s])
+        return self.call('heartbeat', s, lease=lease, worker=worker, state=state)
+
+    def reap(self, state=RUNNING, new_state=AVAILABLE, now=None):
+        ids = self.call('reap', state=state, new_state=new_state, now=now)
+        self._uncache(ids)
+        return ids
+
+    def stats(self):
+        """
+        the stats of this client if it is instrumented,
+        otherwise the ones of the served db.
+        """
+        if self.instrumentation is not None:
+            return super(Remote, self).stats()
+        return self.call('stats')
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
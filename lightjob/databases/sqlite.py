@@ -0,0 +1,466 @@
+"""
+sqlite database built on the sqlite3 module of the standard library.
+
+the jobs are stored in the table 'jobs' with a fixed schema :
+
+- id : integer primary key, the order of insertion
+- summary : the id of the job (unique)
+- state : the state of the job (indexed)
+- content : the content of the job, in canonical json
+- worker, lease_expiry : the meta fields set by `claim_next`
+- meta : the other fields of the job, in json
+- revision : incremented by each write of the job, see `cache_revisions`.
+  a job starts with the time of its insertion in nanoseconds, so that
+  a job deleted and inserted again never has a revision seen before.
+
+the names of the columns are the keys of the db (idkey, statekey, ...).
+the number of jobs of each state is kept in the table 'state_counts'
+by triggers on 'jobs' (see `state_counts_sql`), so that `state_counts`
+and `count(state=...)` do not read the jobs.
+the life of the jobs is stored in the table 'life', one row per change
+of state. the filters are translated to sql by `query.to_sql`, the
+fields which are not columns are looked up in `meta` with json_extract.
+
+the db uses the WAL journal of sqlite, so that readers do not block the
+writer, and each write is one transaction started with BEGIN IMMEDIATE
+which waits up to `timeout` seconds for the other writers : many
+processes can share the same db. the sql of each statement is built once,
+so it is prepared once by the statement cache of the connection.
+
+the db needs sqlite 3.35 or later (the version of the library used by
+the sqlite3 module, `sqlite3.sqlite_version`) : `claim_next` and `reap`
+use UPDATE ... RETURNING (3.35) and the triggers of the counters use
+upserts (3.24).
+"""
+import os
+import json
+import time
+import sqlite3
+import six
+from datetime import datetime
+from contextlib import contextmanager
+
+from .base import GenericDB
+from .query import to_sql
+from .query import compile_query
+from .query import NotPushable
+
+from ..db import AVAILABLE, RUNNING
+from ..db import DEFAULT_LEASE
+from ..utils import canonical_json
+from ..utils import json_default
+from ..utils import recur_update
+from ..utils import chunks
+from ..instrument import timed_serializer
+
+SQLITEFILENAME = 'db.sqlite3'
+METACOLUMN = 'meta'
+COUNTSTABLE = 'state_counts'
+REVISIONCOLUMN = 'revision'
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+class SQLite(GenericDB):
+    """
+    sqlite database with a fixed schema, see the module docstring.
+    a db must be used by one thread at a time.
+
+    Parameters
+    ----------
+
+    timeout : float[default=30.]
+        number of seconds a write waits for the other writers
+    synchronous : str[default='NORMAL']
+        'OFF', 'NORMAL' or 'FULL', see the pragma synchronous of sqlite.
+        with the WAL journal, NORMAL can only lose the last transactions
+        on a crash of the machine.
+    """
+
+    def __init__(self, timeout=30., synchronous='NORMAL', **kw):
+        super(SQLite, self).__init__(**kw)
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL'):
+            raise ValueError('synchronous should be OFF, NORMAL or FULL, got {}'.format(synchronous))
+        self.timeout = timeout
+        self.synchronous = synchronous.upper()
+        self.conn = None
+        # the columns of the table 'jobs', in the order of the selects
+        self.columns = [self.idkey, self.statekey, self.contentkey, self.workerkey, self.leasekey]
+        cols = ', '.join(_quote(c) for c in self.columns + [METACOLUMN])
+        params = ', '.join('?' for _ in self.columns + [METACOLUMN, REVISIONCOLUMN])
+        # each write of a job increments its revision
+        bump = '{r} = {r} + 1'.format(r=REVISIONCOLUMN)
+        self.sql = {
+            'insert': 'INSERT INTO jobs ({}, {}) VALUES ({})'.format(cols, REVISIONCOLUMN, params),
+            'insert_life': 'INSERT INTO life (summary, state, dt) VALUES (?, ?, ?)',
+            'select': 'SELECT {} FROM jobs'.format(cols),
+            'select_id': 'SELECT {} FROM jobs WHERE {} = ?'.format(cols, _quote(self.idkey)),
+            'update': 'UPDATE jobs SET {}, {} WHERE {} = ?'.format(
+                ', '.join('{} = ?'.format(_quote(c)) for c in self.columns[1:] + [METACOLUMN]),
+                bump, _quote(self.idkey)),
+            'update_state': 'UPDATE jobs SET {} = ?, {} WHERE {} = ?'.format(
+                _quote(self.statekey), bump, _quote(self.idkey)),
+            'append_life': (
+                'INSERT INTO life (summary, state, dt) SELECT ?, ?, ? '
+                'WHERE EXISTS (SELECT 1 FROM jobs WHERE {} = ?)'.format(_quote(self.idkey))),
+            'claim': (
+                'UPDATE jobs SET {s} = ?, {w} = coalesce(?, {w}), {l} = coalesce(?, {l}), {b} '
+                'WHERE id = (SELECT id FROM jobs WHERE {s} = ? ORDER BY id LIMIT 1) '
+                'RETURNING {cols}'.format(
+                    s=_quote(self.statekey), w=_quote(self.workerkey),
+                    l=_quote(self.leasekey), b=bump, cols=cols)),
+            'heartbeat': (
+                'UPDATE jobs SET {l} = ?, {b} WHERE {i} = ? AND {s} = ? AND (? IS NULL OR {w} = ?)'.format(
+                    l=_quote(self.leasekey), b=bump, i=_quote(self.idkey),
+                    s=_quote(self.statekey), w=_quote(self.workerkey))),
+            'reap': 'UPDATE jobs SET {s} = ?, {b} WHERE {s} = ? AND {l} < ? RETURNING {i}'.format(
+                s=_quote(self.statekey), b=bump, l=_quote(self.leasekey), i=_quote(self.idkey)),
+            'revision_of': 'SELECT {} FROM jobs WHERE {} = ?'.format(
+                REVISIONCOLUMN, _quote(self.idkey)),
+            'state_of': 'SELECT {} FROM jobs WHERE {} = ?'.format(
+                _quote(self.statekey), _quote(self.idkey)),
+        }
+
+    def load_from_dir(self, dirname):
+        check_sqlite_version()
+        self.conn = sqlite3.connect(
+            os.path.join(dirname, SQLITEFILENAME),
+            timeout=self.timeout,
+            isolation_level=None,  # the transactions are started explicitly
+            check_same_thread=False,  # e.g. used by the thread of an AsyncDB
+            cached_statements=256)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        with self._transaction() as c:
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, '
+                '{} TEXT NOT NULL UNIQUE, {} TEXT, {} TEXT, {} TEXT, {} REAL, {} TEXT, '
+                '{} INTEGER NOT NULL DEFAULT 0)'.format(
+                    *(_quote(col) for col in self.columns + [METACOLUMN, REVISIONCOLUMN])))
+            if REVISIONCOLUMN not in [row[1] for row in c.execute('PRAGMA table_info(jobs)')]:
+                # db created before the revisions
+                c.execute('ALTER TABLE jobs ADD COLUMN {} INTEGER NOT NULL DEFAULT 0'.format(REVISIONCOLUMN))
+            c.execute('CREATE INDEX IF NOT EXISTS ix_jobs_state ON jobs ({})'.format(_quote(self.statekey)))
+            c.execute(
+                'CREATE TABLE IF NOT EXISTS life (id INTEGER PRIMARY KEY, '
+                'summary TEXT NOT NULL, state TEXT, dt TEXT)')
+            c.execute('CREATE INDEX IF NOT EXISTS ix_life_summary ON life (summary)')
+            exists = c.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (COUNTSTABLE,)).fetchone()
+            for sql in state_counts_sql('jobs', COUNTSTABLE, self.statekey):
+                c.execute(sql)
+            if not exists:
+                # db created before the counters
+                for sql in rebuild_state_counts_sql('jobs', COUNTSTABLE, self.statekey):
+                    c.execute(sql)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        cursor of a write transaction, committed at the end of the block,
+        or of the transaction of the current `batch`.
+        """
+        c = self.conn.cursor()
+        if self.in_batch:
+            try:
+                yield c
+            finally:
+                c.close()
+            return
+        # take the write lock now rather than at the first write,
+        # so that the busy timeout applies instead of a deadlock error
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            yield c
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            c.close()
+
+    def _begin_batch(self):
+        # the write lock is held until the end of the batch
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def _commit_batch(self):
+        self.conn.commit()
+
+    def _rollback_batch(self):
+        self.conn.rollback()
+
+    def _instrument(self, stats):
+        self._encode = timed_serializer(stats, self._encode)
+        self.conn.set_trace_callback(lambda sql: sql == 'COMMIT' and stats.committed())
+
+    def _encode(self, j):
+        """row of the table 'jobs' and rows of the table 'life' of the job `j`"""
+        j = dict(j)
+        # 'id' is the primary key of the table, a job read from another
+        # db (e.g. loaded from a dump) must get a new one.
+        j.pop('id', None)
+        life = j.pop(self.lifekey, None) or []
+        values = [j.pop(col, None) for col in self.columns]
+        if values[2] is not None:
+            values[2] = canonical_json(values[2])
+        values.append(json.dumps(j, default=json_default) if j else None)
+        id_ = values[0]
+        return values, [(id_, l[self.statekey], _isoformat(l['dt'])) for l in life]
+
+    def _decode(self, row):
+        """job (without its life) of a row of the table 'jobs'"""
+        id_, state, content, worker, lease, meta = row
+        j = json.loads(meta) if meta is not None else {}
+        j[self.idkey] = id_
+        if state is not None:
+            j[self.statekey] = state
+        if content is not None:
+            j[self.contentkey] = json.loads(content)
+        if worker is not None:
+            j[self.workerkey] = worker
+        if lease is not None:
+            j[self.leasekey] = lease
+        return j
+
+    def _encode_value(self, v):
+        # values compared to whole columns, the content is in canonical json
+        return canonical_json(v) if isinstance(v, (list, dict)) else v
+
+    def _attach_life(self, jobs):
+        """fill the life of the jobs, with one query per chunk of jobs"""
+        lives = {j[self.idkey]: [] for j in jobs}
+        for chunk in chunks(list(lives.keys()), 500):
+            query = 'SELECT summary, state, dt FROM life WHERE summary IN ({}) ORDER BY id'.format(
+                ', '.join('?' for _ in chunk))
+            for id_, state, dt in self.conn.execute(query, chunk):
+                lives[id_].append({self.statekey: state, 'dt': dt})
+        for j in jobs:
+            j[self.lifekey] = lives[j[self.idkey]]
+        return jobs
+
+    def insert(self, d):
+        self.insert_list([d])
+
+    def insert_list(self, l):
+        jobs, life = [], []
+        revision = _new_revision()
+        for j in l:
+            row, rows = self._encode(j)
+            jobs.append(row + [revision])
+            life.extend(rows)
+        with self._transaction() as c:
+            c.executemany(self.sql['insert'], jobs)
+            c.executemany(self.sql['insert_life'], life)
+        self._uncache(row[0] for row in jobs)
+
+    def _find(self, d, offset=0, limit=None):
+        """
+        iterator of the jobs (without their life) matching the filter `d`.
+        the filter is run by sqlite, if it cannot be translated
+        the jobs are matched in python.
+        """
+        try:
+            where, params = to_sql(d, set(self.columns), encode=self._encode_value, rest=METACOLUMN)
+        except NotPushable:
+            match = compile_query(d)
+            rows = self._rows(self.sql['select'] + ' ORDER BY id')
+            jobs = (j for j in (self._decode(row) for row in rows) if match(j))
+            for i, j in enumerate(jobs):
+                if limit is not None and i >= offset + limit:
+                    return
+                if i >= offset:
+                    yield j
+            return
+        query = '{} WHERE {} ORDER BY id'.format(self.sql['select'], where)
+        if limit is not None or offset:
+            query += ' LIMIT {:d} OFFSET {:d}'.format(-1 if limit is None else limit, offset)
+        for row in self._rows(query, params):
+            yield self._decode(row)
+
+    def _rows(self, query, params=()):
+        c = self.conn.execute(query, params)
+        try:
+            while True:
+                rows = c.fetchmany(500)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
+
+    def get(self, d):
+        return self.get_slice(d)
+
+    def get_slice(self, d, offset=0, limit=None):
+        for chunk in chunks(self._find(d, offset=offset, limit=limit), 500):
+            for j in self._attach_life(list(chunk)):
+                yield j
+
+    def _get_by_id(self, id_):
+        row = self.conn.execute(self.sql['select_id'], (id_,)).fetchone()
+        if row is None:
+            return None
+        return self._attach_life([self._decode(row)])[0]
+
+    def _get_revision(self, id_):
+        row = self.conn.execute(self.sql['revision_of'], (id_,)).fetchone()
+        return row[0] if row is not None else None
+
+    def existing_ids(self, ids):
+        found = set()
+        # stay below the sqlite limit of host parameters
+        for chunk in chunks(ids, 500):
+            chunk = list(chunk)
+            query = 'SELECT {c} FROM jobs WHERE {c} IN ({p})'.format(
+                c=_quote(self.idkey), p=', '.join('?' for _ in chunk))
+            found.update(row[0] for row in self.conn.execute(query, chunk))
+        return found
+
+    def job_exists_by_summary(self, s):
+        return self.conn.execute(self.sql['state_of'], (s,)).fetchone() is not None
+
+    def get_state_of(self, summary):
+        row = self.conn.execute(self.sql['state_of'], (summary,)).fetchone()
+        if row is None:
+            raise KeyError(summary)
+        return row[0]
+
+    def count(self, **kw):
+        if list(kw.keys()) == [self.statekey] and isinstance(kw[self.statekey], six.string_types):
+            return self.state_counts().get(kw[self.statekey], 0)
+        try:
+            where, params = to_sql(kw, set(self.columns), encode=self._encode_value, rest=METACOLUMN)
+        except NotPushable:
+            return super(SQLite, self).count(**kw)
+        return self.conn.execute('SELECT COUNT(*) FROM jobs WHERE {}'.format(where), params).fetchone()[0]
+
+    def state_counts(self):
+        return dict(self.conn.execute('SELECT state, n FROM {} WHERE n > 0'.format(COUNTSTABLE)))
+
+    def rebuild_state_counts(self):
+        with self._transaction() as c:
+            for sql in rebuild_state_counts_sql('jobs', COUNTSTABLE, self.statekey):
+                c.execute(sql)
+        return self.state_counts()
+
+    def delete(self, d):
+        ids = [(j[self.idkey],) for j in self._find(d)]
+        with self._transaction() as c:
+            c.executemany('DELETE FROM jobs WHERE {} = ?'.format(_quote(self.idkey)), ids)
+            c.executemany('DELETE FROM life WHERE summary = ?', ids)
+        self._uncache(id_ for id_, in ids)
+
+    def update(self, d, id_):
+        d = dict(d)
+        life = d.pop(self.lifekey, None)
+        with self._transaction() as c:
+            row = c.execute(self.sql['select_id'], (id_,)).fetchone()
+            if row is None:
+                return False
+            j = recur_update(self._decode(row), d)
+            values, _ = self._encode(j)
+            c.execute(self.sql['update'], values[1:] + [id_])
+            if life is not None:
+                _, rows = self._encode({self.idkey: id_, self.lifekey: life})
+                c.execute('DELETE FROM life WHERE summary = ?', (id_,))
+                c.executemany(self.sql['insert_life'], rows)
+        self._uncache([id_])
+        return True
+
+    def update_states(self, l):
+        with self._transaction() as c:
+            c.executemany(self.sql['update_state'], [(state, id_) for id_, state, _ in l])
+            c.executemany(self.sql['append_life'], [(id_, state, _isoformat(dt), id_) for id_, state, dt in l])
+        self._uncache(id_ for id_, _, _ in l)
+
+    def claim_next(self, state=AVAILABLE, new_state=RUNNING, worker=None, lease=None):
+        meta = self._claim_meta(worker, lease)
+        # the pick and the state change are one UPDATE statement
+        # run while holding the write lock, two workers can never
+        # get the same job.
+        with self._transaction() as c:
+            row = c.execute(self.sql['claim'], (
+                new_state, meta.get(self.workerkey), meta.get(self.leasekey), state)).fetchone()
+            if row is None:
+                return None
+            j = self._decode(row)
+            c.execute(self.sql['insert_life'], (j[self.idkey], new_state, _isoformat(datetime.now())))
+        self._uncache([j[self.idkey]])
+        return self._attach_life([j])[0]
+
+    def heartbeat(self, s, lease=DEFAULT_LEASE, worker=None, state=RUNNING):
+        with self._transaction() as c:
+            c.execute(self.sql['heartbeat'], (time.time() + lease, s, state, worker, worker))
+            found = c.rowcount > 0
+        self._uncache([s])
+        return found
+
+    def reap(self, state=RUNNING, new_state=AVAILABLE, now=None):
+        now = time.time() if now is None else now
+        dt = _isoformat(datetime.now())
+        # the expired jobs are checked and moved by one UPDATE statement,
+        # a job which finished or got a heartbeat before it is kept.
+        with self._transaction() as c:
+            ids = [row[0] for row in c.execute(self.sql['reap'], (new_state, state, now))]
+            c.executemany(self.sql['insert_life'], [(s, new_state, dt) for s in ids])
+        self._uncache(ids)
+        return ids
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def check_sqlite_version():
+    """raise a RuntimeError if the sqlite library is older than MIN_SQLITE_VERSION"""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            'sqlite {} or later is required, the sqlite3 module uses sqlite {}'.format(
+                '.'.join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version))
+
+
+def state_counts_sql(table, counts, state):
+    """
+    statements creating the table `counts` of the number of jobs of each
+    state, and the triggers on the table of the jobs `table` which keep
+    it up to date, `state` is the column of the states. the counters are
+    updated in the transaction of the write, so they are exact.
+    """
+    t, c, s = _quote(table), _quote(counts), _quote(state)
+    incr = ('INSERT INTO {c} (state, n) SELECT NEW.{s}, 1 WHERE NEW.{s} IS NOT NULL '
+            'ON CONFLICT (state) DO UPDATE SET n = n + 1;')
+    decr = 'UPDATE {c} SET n = n - 1 WHERE state = OLD.{s};'
+    triggers = [
+        ('insert', 'AFTER INSERT ON {t}', incr),
+        ('delete', 'AFTER DELETE ON {t}', decr),
+        ('update', 'AFTER UPDATE OF {s} ON {t} WHEN OLD.{s} IS NOT NEW.{s}', decr + ' ' + incr),
+    ]
+    sql = ['CREATE TABLE IF NOT EXISTS {c} (state TEXT PRIMARY KEY, n INTEGER NOT NULL)'.format(c=c)]
+    for name, when, body in triggers:
+        sql.append('CREATE TRIGGER IF NOT EXISTS {} {} BEGIN {} END'.format(
+            _quote('{}_{}'.format(counts, name)), when, body).format(t=t, c=c, s=s))
+    return sql
+
+
+def rebuild_state_counts_sql(table, counts, state):
+    """statements counting again the jobs of each state, see `state_counts_sql`"""
+    return [
+        'DELETE FROM {}'.format(_quote(counts)),
+        'INSERT INTO {c} (state, n) SELECT {s}, COUNT(*) FROM {t} WHERE {s} IS NOT NULL GROUP BY {s}'.format(
+            c=_quote(counts), s=_quote(state), t=_quote(table)),
+    ]
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _new_revision():
+    return int(time.time() * 1e9)
+
+
+def _isoformat(dt):
+    return dt.isoformat() if hasattr(dt, 'isoformat') else dt
+
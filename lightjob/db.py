@@ -1,17 +1,24 @@
 import six
-import importlib
 
 DBFILENAME = 'db.json'
+LOCKFILENAME = '.lock'
+HASHFILENAME = '.hash'
+SOCKETFILENAME = '.sock'
 STATES = AVAILABLE, RUNNING, SUCCESS, ERROR, PENDING, DELETED = (
     'available', 'running', 'success', 'error', 'pending', 'deleted')
 IDKEY = 'summary'
 CONTENTKEY = 'content'
 STATEKEY = 'state'
 LIFEKEY = 'life'
+WORKERKEY = 'worker'
+LEASEKEY = 'lease_expiry'
+# seconds a claimed job stays owned by its worker without a heartbeat
+DEFAULT_LEASE = 600
 
 
 def DB(backend='Blitz', **kw):
     if isinstance(backend, six.string_types):
-        module = importlib.import_module('.databases', 'lightjob')
-        backend = getattr(module, backend)
+        # only the module of the backend is imported
+        from .databases import get_backend
+        backend = get_backend(backend)
     return backend(**kw)
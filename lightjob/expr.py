@@ -0,0 +1,399 @@
+"""
+a small language for the filters of the jobs, e.g.:
+
+    content.acc > 0.9 and content.model == "resnet"
+    state in ["error", "running"] or not (content.depth <= 3)
+
+an expression is parsed once into a tree of predicates which is
+then evaluated on the jobs with compiled field accessors
+(see utils.compile_field), nothing is ever passed to `eval`.
+
+- fields are paths in the jobs with the syntax of `dict_format`,
+  e.g. content.model, content.layers[0], content.layers:len
+- literals are numbers, strings (with single or double quotes),
+  true, false, null (or True, False, None) and lists of literals.
+- the comparisons are ==, !=, <, <=, >, >=, in, not in.
+  a missing field is only equal to null, and never
+  lower or greater than anything.
+- the comparisons are combined with and, or, not and parentheses.
+
+the comparisons follow the semantics of the filter dicts of
+databases.query, so that the part of an expression which is
+a conjunction of comparisons on plain fields is given to the
+backend as a filter dict (see `Expr.split`).
+"""
+import re
+
+import six
+
+from .utils import compile_field
+from .databases.query import MATCHERS
+from .databases.query import MISSING
+
+COMPARISONS = {
+    '==': '$eq',
+    '!=': '$ne',
+    '<': '$lt',
+    '<=': '$lte',
+    '>': '$gt',
+    '>=': '$gte',
+    'in': '$in',
+    'not in': '$nin',
+}
+# comparison obtained when the two sides are swapped, e.g. 3 < x is x > 3
+FLIPPED = {'$eq': '$eq', '$ne': '$ne', '$lt': '$gt', '$lte': '$gte', '$gt': '$lt', '$gte': '$lte'}
+
+KEYWORDS = {'and', 'or', 'not', 'in'}
+CONSTANTS = {
+    'true': True, 'True': True,
+    'false': False, 'False': False,
+    'null': None, 'None': None,
+}
+
+TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<number>-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<op>==|!=|<=|>=|<|>)
+  | (?P<name>[A-Za-z_][\w-]*(?:\.[\w-]+|\[\d+\]|:\w+)*)
+  | (?P<punct>[()\[\],])
+''', re.VERBOSE)
+
+ESCAPE = re.compile(r'\\(.)')
+
+
+class ExprError(ValueError):
+    """raised when an expression cannot be parsed"""
+    pass
+
+
+def tokenize(text):
+    """list of (kind, value) of the expression `text`"""
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        if m is None:
+            raise ExprError('unexpected character at {} : {}'.format(pos, text[pos:]))
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'space':
+            continue
+        if kind == 'number':
+            value = float(value) if any(c in value for c in '.eE') else int(value)
+        elif kind == 'string':
+            value = ESCAPE.sub(r'\1', value[1:-1])
+        elif kind == 'name' and value in KEYWORDS:
+            kind = 'keyword'
+        elif kind == 'name' and value in CONSTANTS:
+            kind, value = 'constant', CONSTANTS[value]
+        tokens.append((kind, value))
+    return tokens
+
+
+class Expr(object):
+    """node of the tree of predicates of an expression"""
+
+    def compile(self, getter=compile_field):
+        """
+        return a function of a job returning True if the job
+        matches the expression.
+
+        Parameters
+        ----------
+
+        getter : callable
+            function taking a field and returning a function which
+            gets the value of the field from a job, raising
+            an exception if it does not exist.
+        """
+        raise NotImplementedError()
+
+    def fields(self):
+        """set of the fields used by the expression"""
+        return set()
+
+    def to_filter(self):
+        """
+        the filter dict (see databases.query) equivalent to the expression,
+        or None if there is none.
+        """
+        return None
+
+    def split(self):
+        """
+        split the expression into a filter dict that a backend can
+        run and the rest of the expression, which is None
+        if the filter is equivalent to the whole expression.
+
+        Returns
+        -------
+
+        (dict, Expr or None)
+        """
+        f = self.to_filter()
+        if f is not None:
+            return f, None
+        return {}, self
+
+
+class Compare(Expr):
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def compile(self, getter=compile_field):
+        get = getter(self.field)
+        match = MATCHERS[self.op]
+        ref = self.value
+
+        def predicate(j):
+            try:
+                value = get(j)
+            except Exception:
+                value = MISSING
+            return match(value, ref)
+        return predicate
+
+    def fields(self):
+        return {self.field}
+
+    def to_filter(self):
+        # only the plain paths are understood by the backends
+        if not re.match(r'^[\w-]+(\.[\w-]+)*$', self.field):
+            return None
+        return {self.field: {self.op: self.value}}
+
+    def __repr__(self):
+        return 'Compare({!r}, {!r}, {!r})'.format(self.field, self.op, self.value)
+
+
+class Truth(Expr):
+    """a field alone, true when the field exists and its value is true"""
+
+    def __init__(self, field):
+        self.field = field
+
+    def compile(self, getter=compile_field):
+        get = getter(self.field)
+
+        def predicate(j):
+            try:
+                return bool(get(j))
+            except Exception:
+                return False
+        return predicate
+
+    def fields(self):
+        return {self.field}
+
+    def __repr__(self):
+        return 'Truth({!r})'.format(self.field)
+
+
+class And(Expr):
+
+    def __init__(self, children):
+        self.children = children
+
+    def compile(self, getter=compile_field):
+        preds = [c.compile(getter) for c in self.children]
+        return lambda j: all(p(j) for p in preds)
+
+    def split(self):
+        f, rest = {}, []
+        for c in self.children:
+            cf, crest = c.split()
+            # the conditions on the same field are merged,
+            # unless they use the same operator
+            for k, ops in cf.items():
+                if k in f and set(f[k]) & set(ops):
+                    crest = c
+                    break
+            else:
+                for k, ops in cf.items():
+                    f.setdefault(k, {}).update(ops)
+            if crest is not None:
+                rest.append(crest)
+        if not rest:
+            return f, None
+        return f, rest[0] if len(rest) == 1 else And(rest)
+
+    def to_filter(self):
+        f, rest = self.split()
+        return f if rest is None else None
+
+    def fields(self):
+        return set().union(*(c.fields() for c in self.children))
+
+    def __repr__(self):
+        return 'And({!r})'.format(self.children)
+
+
+class Or(Expr):
+
+    def __init__(self, children):
+        self.children = children
+
+    def compile(self, getter=compile_field):
+        preds = [c.compile(getter) for c in self.children]
+        return lambda j: any(p(j) for p in preds)
+
+    def fields(self):
+        return set().union(*(c.fields() for c in self.children))
+
+    def __repr__(self):
+        return 'Or({!r})'.format(self.children)
+
+
+class Not(Expr):
+
+    def __init__(self, child):
+        self.child = child
+
+    def compile(self, getter=compile_field):
+        pred = self.child.compile(getter)
+        return lambda j: not pred(j)
+
+    def fields(self):
+        return self.child.fields()
+
+    def __repr__(self):
+        return 'Not({!r})'.format(self.child)
+
+
+class Parser(object):
+    """recursive descent parser of the expressions"""
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def next(self):
+        tok = self.peek()
+        if tok[0] is None:
+            raise ExprError('unexpected end of expression : {}'.format(self.text))
+        self.pos += 1
+        return tok
+
+    def accept(self, kind, value=None):
+        tok = self.peek()
+        if tok[0] == kind and (value is None or tok[1] == value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        if not self.accept(kind, value):
+            raise ExprError('expected {} at token {} of : {}'.format(
+                value or kind, self.pos, self.text))
+
+    def parse(self):
+        expr = self.parse_or()
+        if self.peek()[0] is not None:
+            raise ExprError('unexpected {!r} in : {}'.format(self.peek()[1], self.text))
+        return expr
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.accept('keyword', 'or'):
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.accept('keyword', 'and'):
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return Not(self.parse_not())
+        if self.accept('punct', '('):
+            expr = self.parse_or()
+            self.expect('punct', ')')
+            return expr
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        kind, value = self.peek()
+        if kind == 'name':
+            self.next()
+            field = value
+            op = self.parse_operator()
+            if op is None:
+                return Truth(field)
+            return Compare(field, op, self.parse_value(op))
+        # a literal on the left side, e.g. 3 < content.depth
+        left = self.parse_literal()
+        op = self.parse_operator()
+        if op not in FLIPPED:
+            raise ExprError('expected a comparison after {!r} in : {}'.format(left, self.text))
+        kind, field = self.next()
+        if kind != 'name':
+            raise ExprError('expected a field after {!r} in : {}'.format(left, self.text))
+        return Compare(field, FLIPPED[op], left)
+
+    def parse_operator(self):
+        kind, value = self.peek()
+        if kind == 'op':
+            self.next()
+            return COMPARISONS[value]
+        if self.accept('keyword', 'in'):
+            return '$in'
+        if kind == 'keyword' and value == 'not' and self.peek(1) == ('keyword', 'in'):
+            self.pos += 2
+            return '$nin'
+        return None
+
+    def parse_value(self, op):
+        value = self.parse_literal()
+        if op in ('$in', '$nin') and not isinstance(value, list):
+            raise ExprError('expected a list after in : {}'.format(self.text))
+        return value
+
+    def parse_literal(self):
+        kind, value = self.next()
+        if kind in ('number', 'string', 'constant'):
+            return value
+        if kind == 'punct' and value == '[':
+            values = []
+            if self.accept('punct', ']'):
+                return values
+            while True:
+                values.append(self.parse_literal())
+                if self.accept('punct', ']'):
+                    return values
+                self.expect('punct', ',')
+        raise ExprError('expected a value instead of {!r} in : {}'.format(value, self.text))
+
+
+def parse(expr):
+    """
+    parse an expression into a tree of predicates.
+
+    Parameters
+    ----------
+
+    expr : str or Expr
+        the expression, see the module docstring
+
+    Returns
+    -------
+
+    Expr
+    """
+    if isinstance(expr, Expr):
+        return expr
+    if not isinstance(expr, six.string_types):
+        raise TypeError('expected an expression, got {!r}'.format(expr))
+    return Parser(expr).parse()
@@ -0,0 +1,330 @@
+"""
+instrumentation of the dbs, enabled with DB(..., instrument=True)
+or with "instrument": true in the .lightjobrc of the db folder.
+
+the operations of `OPERATIONS` are wrapped on the db object, so that
+each call records its latency in a histogram, and each backend hooks
+its storage engine to count its commits and the bytes (and the time)
+of the json it writes (see `GenericDB._instrument`). the hashing of
+the contents is recorded as the operations `summarize` and
+`summarize_many`, so that the time spent hashing, encoding and in the
+storage engine can be told apart. the time of an operation includes
+the time of the operations it calls.
+
+nothing is wrapped when the instrumentation is disabled, so it costs
+nothing then.
+
+    db = DB(backend='SQLite', instrument=True)
+    db.load('.lightjob')
+    ...
+    db.stats()
+
+an instrumented db loaded from a folder writes its stats in the
+folder 'stats' of the db when it is closed, `lightjob stats` shows
+the sum of the stats of these processes.
+"""
+import os
+import copy
+import json
+import time
+import socket
+import types
+from functools import wraps
+
+import six
+
+# operations of the dbs whose calls are recorded
+OPERATIONS = ('insert', 'insert_list', 'get', 'get_by_id', 'update', 'delete',
+              'modify_state_of', 'modify_states', 'update_states',
+              'summarize', 'summarize_many')
+
+# upper bounds in seconds of the buckets of the latency histograms,
+# the last bucket of a histogram counts the calls slower than BUCKETS[-1]
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+STATSDIRNAME = 'stats'
+
+
+class Stats(object):
+    """
+    the counters of an instrumented db.
+
+    - for each operation : the number of calls, of calls which raised
+      an exception, their total time in seconds and the histogram of
+      their latencies (number of calls per bucket of `BUCKETS`).
+    - 'serialized_bytes', 'serialize_seconds' and 'serialize_calls' :
+      the json encoded by the backend to write the jobs.
+    - 'commits' : the commits of the storage engine (transactions of
+      sqlite, appends to the log of Memory, flushes of hdf5, ...).
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.serialized_bytes = 0
+        self.serialize_seconds = 0.
+        self.serialize_calls = 0
+        self.commits = 0
+
+    def record(self, name, seconds, error=False):
+        """record a call of the operation `name` which took `seconds`"""
+        op = self.operations.get(name)
+        if op is None:
+            op = self.operations[name] = {
+                'count': 0, 'errors': 0, 'seconds': 0.,
+                'histogram': [0] * (len(BUCKETS) + 1)}
+        op['count'] += 1
+        op['seconds'] += seconds
+        if error:
+            op['errors'] += 1
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        op['histogram'][i] += 1
+
+    def serialized(self, nbytes, seconds):
+        """record an encoding of `nbytes` bytes of json which took `seconds`"""
+        self.serialized_bytes += nbytes
+        self.serialize_seconds += seconds
+        self.serialize_calls += 1
+
+    def committed(self, *args):
+        """record a commit, the arguments are ignored so it can be used as a callback"""
+        self.commits += 1
+
+    def as_dict(self):
+        return {
+            'operations': copy.deepcopy(self.operations),
+            'serialized_bytes': self.serialized_bytes,
+            'serialize_seconds': self.serialize_seconds,
+            'serialize_calls': self.serialize_calls,
+            'commits': self.commits,
+        }
+
+
+def instrument(db, stats):
+    """
+    wrap the operations of `db` so that their calls are recorded
+    in `stats`, and hook the storage engine of its backend
+    once it is loaded.
+    """
+    for name in OPERATIONS:
+        fn = getattr(db, name)
+        if name == 'get':
+            setattr(db, name, timed_iter(stats, name, fn))
+        else:
+            setattr(db, name, timed(stats, name, fn))
+    load, close = db.load, db.close
+
+    @wraps(load)
+    def instrumented_load(dirname):
+        load(dirname)
+        # the hash function is set again by the loading
+        if not getattr(db.summarize, 'instrumented', False):
+            db.summarize = timed(stats, 'summarize', db.summarize)
+        db._instrument(stats)
+
+    @wraps(close)
+    def instrumented_close():
+        close()
+        if db.dirname is not None:
+            save(stats, db.dirname)
+    db.load = instrumented_load
+    db.close = instrumented_close
+
+
+def timed(stats, name, fn):
+    """`fn`, recording its calls in `stats` as the operation `name`"""
+    record = stats.record
+    clock = time.perf_counter
+
+    @wraps(fn)
+    def timed_fn(*args, **kwargs):
+        start = clock()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            record(name, clock() - start, error=True)
+            raise
+        record(name, clock() - start)
+        return result
+    timed_fn.instrumented = True
+    return timed_fn
+
+
+def timed_iter(stats, name, fn):
+    """
+    like `timed` for a function returning an iterator (e.g. `get`),
+    the time spent iterating over the result is included if it is
+    a generator. other results (e.g. the query sets of blitzdb,
+    which can be sliced) are returned as they are.
+    """
+    record = stats.record
+    clock = time.perf_counter
+
+    @wraps(fn)
+    def timed_fn(*args, **kwargs):
+        start = clock()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            record(name, clock() - start, error=True)
+            raise
+        if not isinstance(result, types.GeneratorType):
+            record(name, clock() - start)
+            return result
+        return _timed_iteration(result, name, record, clock, clock() - start)
+    return timed_fn
+
+
+def _timed_iteration(it, name, record, clock, seconds):
+    error = False
+    try:
+        while True:
+            start = clock()
+            try:
+                j = next(it)
+            except StopIteration:
+                seconds += clock() - start
+                return
+            except Exception:
+                seconds += clock() - start
+                error = True
+                raise
+            seconds += clock() - start
+            yield j
+    finally:
+        # also when the iteration is stopped early
+        record(name, seconds, error=error)
+
+
+def timed_serializer(stats, fn):
+    """
+    `fn`, a function encoding the jobs, recording the time of its calls
+    and the size of their results in `stats`. the size is the number
+    of bytes of the strings of the result encoded in utf-8, the result
+    can be a string, or a list, tuple or dict of them (at any depth).
+    """
+    clock = time.perf_counter
+
+    @wraps(fn)
+    def timed_fn(*args, **kwargs):
+        start = clock()
+        result = fn(*args, **kwargs)
+        stats.serialized(_size(result), clock() - start)
+        return result
+    return timed_fn
+
+
+def _size(obj):
+    if isinstance(obj, bytes):
+        return len(obj)
+    if isinstance(obj, six.text_type):
+        return len(obj.encode('utf-8'))
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (list, tuple)):
+        return 0
+    return sum(_size(v) for v in obj)
+
+
+def counted_commits(stats, fn):
+    """`fn`, a function committing the writes, counting its calls in `stats`"""
+    @wraps(fn)
+    def commit(*args, **kwargs):
+        result = fn(*args, **kwargs)
+        stats.committed()
+        return result
+    return commit
+
+
+def save(stats, dirname):
+    """write `stats` in the stats folder of the db folder `dirname`, one file per process"""
+    folder = os.path.join(dirname, STATSDIRNAME)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    filename = os.path.join(folder, '{}-{}.json'.format(socket.gethostname(), os.getpid()))
+    with open(filename, 'w') as fd:
+        json.dump(stats.as_dict(), fd)
+
+
+def load(dirname):
+    """the stats written in the db folder `dirname`, summed over the processes"""
+    folder = os.path.join(dirname, STATSDIRNAME)
+    filenames = sorted(os.listdir(folder)) if os.path.exists(folder) else []
+    stats = []
+    for filename in filenames:
+        with open(os.path.join(folder, filename)) as fd:
+            stats.append(json.load(fd))
+    return merge(stats)
+
+
+def reset(dirname):
+    """remove the stats written in the db folder `dirname`"""
+    folder = os.path.join(dirname, STATSDIRNAME)
+    if os.path.exists(folder):
+        for filename in os.listdir(folder):
+            os.remove(os.path.join(folder, filename))
+
+
+def merge(stats):
+    """sum of a list of stats (dicts returned by `db.stats()`)"""
+    total = Stats().as_dict()
+    for s in stats:
+        for key in ('serialized_bytes', 'serialize_seconds', 'serialize_calls', 'commits'):
+            total[key] += s[key]
+        for name, op in s['operations'].items():
+            t = total['operations'].setdefault(
+                name, {'count': 0, 'errors': 0, 'seconds': 0., 'histogram': [0] * len(op['histogram'])})
+            for key in ('count', 'errors', 'seconds'):
+                t[key] += op[key]
+            t['histogram'] = [a + b for a, b in zip(t['histogram'], op['histogram'])]
+    return total
+
+
+def quantile(op, q):
+    """
+    upper bound of the bucket of the histogram of the operation `op`
+    where the quantile `q` (between 0 and 1) of its latencies is,
+    None if it is above the last bucket.
+    """
+    rank = q * op['count']
+    seen = 0
+    for bound, n in zip(BUCKETS, op['histogram']):
+        seen += n
+        if seen >= rank:
+            return bound
+    return None
+
+
+def to_prometheus(stats, prefix='lightjob'):
+    """
+    the stats (a dict returned by `db.stats()`) in the text format
+    of prometheus, the latencies are histograms.
+    """
+    lines = []
+
+    def header(name, kind, doc):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, doc))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+
+    header('operation_seconds', 'histogram', 'latency of the operations of the db')
+    for name, op in sorted(stats['operations'].items()):
+        cumulative = 0
+        bounds = [repr(float(b)) for b in BUCKETS] + ['+Inf']
+        for bound, n in zip(bounds, op['histogram']):
+            cumulative += n
+            lines.append('{}_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                prefix, name, bound, cumulative))
+        lines.append('{}_operation_seconds_sum{{operation="{}"}} {!r}'.format(prefix, name, op['seconds']))
+        lines.append('{}_operation_seconds_count{{operation="{}"}} {}'.format(prefix, name, op['count']))
+    header('operation_errors_total', 'counter', 'calls of the operations of the db which raised an exception')
+    for name, op in sorted(stats['operations'].items()):
+        lines.append('{}_operation_errors_total{{operation="{}"}} {}'.format(prefix, name, op['errors']))
+    for key, doc in (('serialized_bytes', 'bytes of json encoded to write the jobs'),
+                     ('serialize_seconds', 'seconds spent encoding the jobs in json'),
+                     ('serialize_calls', 'encodings of jobs in json'),
+                     ('commits', 'commits of the storage engine')):
+        header(key + '_total', 'counter', doc)
+        lines.append('{}_{}_total {!r}'.format(prefix, key, stats[key]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,222 @@
+"""
+run the available jobs of a db with a pool of workers.
+
+    from lightjob.runner import Runner
+
+    def train(content):
+        # code to run a job, an exception means that it failed
+        ...
+
+    db = load_db()
+    Runner(db, train, workers=8).run()
+
+or from the command line :
+
+    lightjob run --module mypkg.train:train --workers 8
+
+the jobs are claimed with `claim_next`, so several runners (e.g. one
+per node of a cluster) can share the same db. the H5py and Memory
+backends are opened by one process at a time, their db is shared
+between runners through `lightjob serve`. a claimed job is RUNNING,
+it becomes SUCCESS if the function returns and ERROR if it raises.
+the states of the jobs which finish together are written with one
+call of `modify_states`.
+
+with a lease, the jobs are claimed for `lease` seconds and the runner
+renews the leases of its running jobs with `heartbeat`, so that
+if the runner dies, its jobs are made available again by `reap`
+(run by `lightjob reap`, or by the runners started with reap=True).
+a job whose lease could not be renewed (it expired and was reaped)
+is not owned by the runner anymore, its final state is not written.
+the heartbeats and the reaping are done by the loop of the runner,
+between two completions of jobs, since the backends are not thread safe.
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import importlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+
+from .db import AVAILABLE, RUNNING, SUCCESS, ERROR
+
+logger = logging.getLogger(__name__)
+
+
+def load_function(spec):
+    """
+    import a function given by 'module:name', e.g. 'mypkg.train:run'.
+    the current directory is searched for the module.
+    """
+    if ':' not in spec:
+        raise ValueError('expected module:function, got {}'.format(spec))
+    module, name = spec.split(':', 1)
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    return getattr(importlib.import_module(module), name)
+
+
+def default_worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _call(func, content):
+    return func(content)
+
+
+class Runner(object):
+    """
+    run the jobs of a db with a pool of processes or threads.
+
+    Parameters
+    ----------
+
+    db : GenericDB
+        loaded db
+    func : callable
+        function called with the content of each job, it must be
+        picklable (e.g. defined at the top level of a module) to be
+        run by processes.
+    workers : int[default=1]
+        number of processes or threads
+    in_flight : int[default=1]
+        number of claimed jobs at the same time per worker, at most
+        `workers * in_flight` jobs are claimed. more jobs than workers
+        keep the workers busy while the states are written.
+    mode : 'process' or 'thread'[default='process']
+        kind of pool
+    worker : str, optional
+        name recorded in the claimed jobs, by default hostname-pid
+    state : str[default=AVAILABLE]
+        state of the jobs to run
+    max_jobs : int, optional
+        stop after claiming this number of jobs
+    lease : float, optional
+        number of seconds the jobs are claimed for, see `GenericDB.claim_next`.
+        by default the jobs are claimed without a lease.
+    heartbeat : float, optional
+        number of seconds between two renewals of the leases,
+        by default a third of `lease`, or a minute to only reap.
+    reap : bool[default=False]
+        if True, the jobs of other workers whose lease has expired
+        are made available again at each heartbeat.
+    """
+
+    def __init__(self, db, func, workers=1, in_flight=1, mode='process',
+                 worker=None, state=AVAILABLE, max_jobs=None,
+                 lease=None, heartbeat=None, reap=False):
+        if mode not in ('process', 'thread'):
+            raise ValueError('mode should be process or thread, got {}'.format(mode))
+        self.db = db
+        self.func = func
+        self.workers = workers
+        self.in_flight = in_flight
+        self.mode = mode
+        self.worker = worker or default_worker_name()
+        self.state = state
+        self.max_jobs = max_jobs
+        self.lease = lease
+        if heartbeat is None and lease:
+            heartbeat = lease / 3.
+        elif heartbeat is None and reap:
+            heartbeat = 60.
+        self.heartbeat = heartbeat
+        self.reap = reap
+
+    def _executor(self):
+        if self.mode == 'process':
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def _beat(self, ids):
+        """
+        renew the leases of the running jobs, reap the expired ones of the others.
+        return the ids of the jobs whose lease could not be renewed.
+        """
+        lost = []
+        if self.lease:
+            for s in ids:
+                if not self.db.heartbeat(s, lease=self.lease, worker=self.worker):
+                    lost.append(s)
+        if self.reap:
+            reaped = self.db.reap()
+            if reaped:
+                logger.info('{} expired jobs made available again'.format(len(reaped)))
+        return lost
+
+    def run(self):
+        """
+        run jobs until there are no more jobs with the state `state`
+        (or `max_jobs` jobs have been claimed).
+
+        Returns
+        -------
+
+        dict : number of jobs per final state
+        """
+        counts = {SUCCESS: 0, ERROR: 0}
+        running = {}
+        # futures of the jobs which were reaped (and maybe claimed again) while they ran
+        lost = set()
+        states = []
+        claimed = 0
+        exhausted = False
+        executor = self._executor()
+        last_beat = time.time()
+        if self.reap:
+            self.db.reap()
+        try:
+            while True:
+                while not exhausted and len(running) < self.workers * self.in_flight:
+                    if self.max_jobs is not None and claimed >= self.max_jobs:
+                        exhausted = True
+                        break
+                    j = self.db.claim_next(self.state, RUNNING, worker=self.worker, lease=self.lease)
+                    if j is None:
+                        exhausted = True
+                        break
+                    claimed += 1
+                    future = executor.submit(_call, self.func, j[self.db.contentkey])
+                    running[future] = j[self.db.idkey]
+                if not running:
+                    break
+                done, _ = wait(list(running.keys()), timeout=self.heartbeat,
+                               return_when=FIRST_COMPLETED)
+                if self.heartbeat and time.time() - last_beat >= self.heartbeat:
+                    last_beat = time.time()
+                    beating = {s: f for f, s in running.items() if f not in done and f not in lost}
+                    lost.update(beating[s] for s in self._beat(list(beating.keys())))
+                dt = datetime.now()
+                for future in done:
+                    s = running.pop(future)
+                    exc = future.exception()
+                    if future in lost:
+                        # the job is not ours anymore, its state is not written
+                        lost.discard(future)
+                        logger.warning('job {} was reaped while it ran, its result is dropped'.format(s))
+                        continue
+                    if exc is None:
+                        state = SUCCESS
+                    else:
+                        state = ERROR
+                        logger.error('job {} failed : {!r}'.format(s, exc))
+                    counts[state] += 1
+                    states.append((s, state, dt))
+                if states:
+                    self.db.modify_states(states)
+                    del states[:]
+        finally:
+            if states:
+                self.db.modify_states(states)
+            executor.shutdown(wait=True)
+        return counts
+
+
+def run(db, func, **kw):
+    """shortcut for Runner(db, func, **kw).run()"""
+    return Runner(db, func, **kw).run()
@@ -0,0 +1,346 @@
+"""
+daemon keeping a db open and serving it to many processes
+(python 3 only).
+
+    lightjob serve
+
+opens the db of the current folder and listens on the unix socket
+.lightjob/.sock (or on host:port with --address), then the workers
+use the backend `Remote` instead of opening the db themselves :
+
+    db = DB(backend='Remote')
+    db.load('.lightjob')
+
+the protocol is one json object per line. a request is
+{"id": 1, "method": "get_by_id", "args": [...], "kwargs": {...}}
+and its response {"id": 1, "result": ...} or
+{"id": 1, "error": {"type": "ValueError", "message": "..."}}.
+
+the calls are run by an `AsyncDB`, so the state changes and the
+inserts of all the clients which arrive together are written with
+one call of the backend. the server also keeps the state of each job
+in memory, with the number of jobs of each state, which answers
+`job_exists_by_summary`, `existing_ids`, `get_state_of`, `state_counts`
+and the counts by state without reading the db.
+the index assumes that the db is only written through the server
+while it runs.
+"""
+import os
+import json
+import time
+import asyncio
+import signal
+import logging
+from itertools import count as counter
+from collections import OrderedDict
+
+import six
+
+from .db import AVAILABLE, RUNNING
+from .aio import AsyncDB
+from .utils import json_default
+from .utils import parse_address
+
+logger = logging.getLogger(__name__)
+
+# methods of the db which are called as they are
+PASSTHROUGH = {
+    'get_by_id', 'get_job_by_summary', 'get_slice', 'get_values',
+    'heartbeat', 'update', 'job_update', 'stats',
+}
+# methods which can change the state of the job whose id is their
+# first argument (`update` gets it second), which is read again after them
+REINDEX = {'update': 1, 'job_update': 0}
+
+
+def _materialize(result):
+    """list of the jobs of an iterator, so that it can be sent"""
+    # jobs are dicts or blitzdb documents (encoded by json_default)
+    if result is None or isinstance(result, (dict,) + six.string_types) or hasattr(result, 'attributes'):
+        return result
+    if type(result) in (list, tuple):
+        return result
+    try:
+        return list(iter(result))
+    except TypeError:
+        return result
+
+
+class Server(object):
+    """
+    serve a db on a unix socket or on tcp.
+
+    Parameters
+    ----------
+
+    db : GenericDB
+        loaded db
+    address : str
+        path of a unix socket or host:port
+    max_workers : int[default=1]
+        number of threads running the calls of the db, see `AsyncDB`
+    max_cursors : int[default=100]
+        number of cursors opened by `get` kept at once, the least
+        recently used one is dropped to open a new one beyond.
+    cursor_timeout : float[default=600.]
+        number of seconds after which an unused cursor is dropped
+        (e.g. the one of a client which died while iterating).
+    """
+
+    def __init__(self, db, address, max_workers=1, max_cursors=100, cursor_timeout=600.):
+        self.db = db
+        self.address = address
+        self.adb = AsyncDB(db, max_workers=max_workers)
+        self.max_cursors = max_cursors
+        self.cursor_timeout = cursor_timeout
+        # id of the cursor -> (iterator, time of its last use),
+        # from the least recently used to the most recently used
+        self.cursors = OrderedDict()
+        self.cursor_ids = counter()
+        self.index = None
+        # number of jobs of each state of the index
+        self.counts = {}
+        self.server = None
+        self.loop = None
+        self.stopped = None
+
+    async def serve(self, ready=None):
+        """
+        serve until `stop` is called.
+
+        Parameters
+        ----------
+
+        ready : threading.Event, optional
+            set once the server listens
+        """
+        self.loop = asyncio.get_event_loop()
+        self.stopped = asyncio.Event()
+        address = parse_address(self.address)
+        if isinstance(address, tuple):
+            self.server = await asyncio.start_server(self.handle, address[0], address[1])
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = await asyncio.start_unix_server(self.handle, address)
+        logger.info('serving {} on {}'.format(self.db.dirname, self.address))
+        if ready is not None:
+            ready.set()
+        try:
+            await self.stopped.wait()
+        finally:
+            self.server.close()
+            await self.server.wait_closed()
+            await self.adb.close()
+            if not isinstance(address, tuple) and os.path.exists(address):
+                os.remove(address)
+
+    def stop(self):
+        """stop the server, can be called from any thread"""
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                req = json.loads(line.decode('utf-8'))
+                try:
+                    result = await self.call(req['method'], req.get('args', []), req.get('kwargs', {}))
+                    resp = json.dumps({'id': req.get('id'), 'result': result}, default=json_default)
+                except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+                    raise
+                except BaseException as e:
+                    # blitzdb raises some errors which are not Exceptions
+                    resp = json.dumps({'id': req.get('id'), 'error': {'type': type(e).__name__, 'message': str(e)}})
+                writer.write(resp.encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, method, args, kwargs):
+        handler = getattr(self, 'rpc_' + method, None)
+        if handler is not None:
+            return await handler(*args, **kwargs)
+        if method not in PASSTHROUGH:
+            raise ValueError('unknown method : {}'.format(method))
+        func = getattr(self.db, method)
+        result = await self.adb.run(lambda: _materialize(func(*args, **kwargs)))
+        if method in REINDEX and self.index is not None:
+            if len(args) > REINDEX[method]:
+                await self._reindex(args[REINDEX[method]])
+            else:
+                # the id is a keyword argument, the index is rebuilt
+                self.index = None
+        return result
+
+    async def _reindex(self, s):
+        """read again the state of the job `s` in the index"""
+        db = self.db
+        j = await self.adb.run(db.get_by_id, s)
+        if j is not None:
+            self._set_state(self.index, s, j.get(db.statekey))
+
+    async def _index(self):
+        """the state of each job, read from the db the first time"""
+        if self.index is None:
+            db = self.db
+            self.index = await self.adb.run(
+                lambda: {j[db.idkey]: j[db.statekey] for j in db.get({})})
+            self.counts = {}
+            for state in self.index.values():
+                self._count(state, 1)
+        return self.index
+
+    def _count(self, state, n):
+        if state is not None:
+            self.counts[state] = self.counts.get(state, 0) + n
+
+    def _set_state(self, index, s, state):
+        if s in index:
+            self._count(index[s], -1)
+        index[s] = state
+        self._count(state, 1)
+
+    async def _set_states(self, pairs):
+        index = await self._index()
+        for s, state in pairs:
+            if s in index:
+                self._set_state(index, s, state)
+
+    async def rpc_info(self):
+        db = self.db
+        return {
+            'backend': type(db).__name__,
+            'hash_algorithm': db.hash_algorithm,
+            'idkey': db.idkey,
+            'contentkey': db.contentkey,
+            'statekey': db.statekey,
+            'lifekey': db.lifekey,
+            'workerkey': db.workerkey,
+            'leasekey': db.leasekey,
+        }
+
+    async def rpc_insert_list(self, l):
+        index = await self._index()
+        await self.adb.insert_list(l)
+        for j in l:
+            self._set_state(index, j[self.db.idkey], j.get(self.db.statekey))
+
+    async def rpc_modify_states(self, l):
+        await self.adb.modify_states(l)
+        await self._set_states((s, state) for s, state, _ in l)
+
+    async def rpc_claim_next(self, *args, **kwargs):
+        j = await self.adb.claim_next(*args, **kwargs)
+        if j is not None:
+            await self._set_states([(j[self.db.idkey], j[self.db.statekey])])
+        return j
+
+    async def rpc_reap(self, state=RUNNING, new_state=AVAILABLE, now=None):
+        ids = await self.adb.reap(state=state, new_state=new_state, now=now)
+        await self._set_states((s, new_state) for s in ids)
+        return ids
+
+    async def rpc_delete(self, d):
+        db = self.db
+
+        def delete():
+            if list(d.keys()) == [db.idkey] and isinstance(d[db.idkey], six.string_types):
+                ids = [d[db.idkey]]
+            else:
+                ids = [j[db.idkey] for j in db.get(d)]
+            db.delete(d)
+            return ids
+        ids = await self.adb.run(delete)
+        if self.index is not None:
+            for s in ids:
+                if s in self.index:
+                    self._count(self.index.pop(s), -1)
+
+    async def rpc_existing_ids(self, ids):
+        index = await self._index()
+        return [s for s in ids if s in index]
+
+    async def rpc_job_exists_by_summary(self, s):
+        return s in await self._index()
+
+    async def rpc_get_state_of(self, s):
+        index = await self._index()
+        if s not in index:
+            raise KeyError(s)
+        return index[s]
+
+    async def rpc_count(self, **kw):
+        if not kw:
+            return len(await self._index())
+        state = kw.get(self.db.statekey)
+        if list(kw.keys()) == [self.db.statekey] and isinstance(state, six.string_types):
+            await self._index()
+            return self.counts.get(state, 0)
+        return await self.adb.count(**kw)
+
+    async def rpc_state_counts(self):
+        await self._index()
+        return {state: n for state, n in self.counts.items() if n > 0}
+
+    async def rpc_rebuild_state_counts(self):
+        await self.adb.flush()
+        counts = await self.adb.run(self.db.rebuild_state_counts)
+        self.index = None
+        return counts
+
+    async def rpc_open_cursor(self, d):
+        db = self.db
+        await self._drop_cursors()
+        cid = next(self.cursor_ids)
+        it = await self.adb.run(lambda: iter(db.get(d)))
+        self.cursors[cid] = (it, time.time())
+        return cid
+
+    async def rpc_next(self, cid, n):
+        if cid not in self.cursors:
+            raise KeyError('unknown cursor {}, it was closed or has expired'.format(cid))
+        it, _ = self.cursors.pop(cid)
+        chunk = await self.adb.run(lambda: [j for _, j in zip(range(n), it)])
+        if len(chunk) < n:
+            await self._close_iterator(it)
+        else:
+            self.cursors[cid] = (it, time.time())
+        return chunk
+
+    async def rpc_close_cursor(self, cid):
+        if cid in self.cursors:
+            it, _ = self.cursors.pop(cid)
+            await self._close_iterator(it)
+
+    async def _drop_cursors(self):
+        """drop the expired cursors, and the least recently used ones beyond `max_cursors` - 1"""
+        expired = time.time() - self.cursor_timeout
+        while self.cursors:
+            cid, (it, used) = next(iter(self.cursors.items()))
+            if used >= expired and len(self.cursors) < self.max_cursors:
+                break
+            del self.cursors[cid]
+            logger.info('cursor {} dropped'.format(cid))
+            await self._close_iterator(it)
+
+    async def _close_iterator(self, it):
+        # e.g. closes the cursor of the backend held by a generator
+        if hasattr(it, 'close'):
+            await self.adb.run(it.close)
+
+
+def serve(db, address, **kw):
+    """serve `db` on `address` until SIGINT or SIGTERM"""
+    server = Server(db, address, **kw)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, server.stop)
+        await server.serve()
+    asyncio.run(main())
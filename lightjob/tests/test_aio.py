@@ -0,0 +1,75 @@
+import shutil
+import asyncio
+from tempfile import mkdtemp
+
+from lightjob.db import DB
+from lightjob.db import AVAILABLE, RUNNING, SUCCESS
+from lightjob.databases import Blitz, Dataset, H5py, Memory, SQLite
+from lightjob.aio import AsyncDB
+from lightjob.tests.test_common import with_backend
+
+
+class BaseAsyncTest(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+        db = DB(backend=self.backend)
+        db.load(self.testdir)
+        self.db = db
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_batched_writes(self):
+        calls = []
+        modify_states = self.db.modify_states
+
+        def spy(l):
+            calls.append(len(l))
+            return modify_states(l)
+        self.db.modify_states = spy
+
+        async def main():
+            adb = AsyncDB(self.db)
+            ids = await asyncio.gather(*[adb.add_job({'a': i}) for i in range(20)])
+            await asyncio.gather(*[adb.modify_state_of(s, RUNNING) for s in ids])
+            await adb.modify_state_of(ids[0], SUCCESS)
+            assert await adb.get_state_of(ids[0]) == SUCCESS
+            assert await adb.count(state=RUNNING) == 19
+            running = [j async for j in adb.jobs_with_state(RUNNING)]
+            life = (await adb.get_job_by_summary(ids[0]))['life']
+            await adb.close()
+            return running, life
+        running, life = asyncio.run(main())
+        assert calls == [20, 1]
+        assert len(running) == 19
+        assert [l['state'] for l in life] == [AVAILABLE, RUNNING, SUCCESS]
+
+    def test_failed_write(self):
+        insert_list = self.db.insert_list
+
+        def check(l):
+            if any(j['content'].get('bad') for j in l):
+                raise ValueError('bad job')
+            return insert_list(l)
+        self.db.insert_list = check
+
+        async def main():
+            adb = AsyncDB(self.db)
+            results = await asyncio.gather(
+                *[adb.add_job({'a': i, 'bad': i == 3}) for i in range(5)],
+                return_exceptions=True)
+            count = await adb.count()
+            await adb.close()
+            return results, count
+        results, count = asyncio.run(main())
+        assert isinstance(results[3], ValueError)
+        assert all(isinstance(s, str) for i, s in enumerate(results) if i != 3)
+        assert count == 4
+
+
+TestAsyncBlitz = with_backend(BaseAsyncTest, backend=Blitz)
+TestAsyncDataset = with_backend(BaseAsyncTest, backend=Dataset)
+TestAsyncH5py = with_backend(BaseAsyncTest, backend=H5py)
+TestAsyncMemory = with_backend(BaseAsyncTest, backend=Memory)
+TestAsyncSQLite = with_backend(BaseAsyncTest, backend=SQLite)
@@ -0,0 +1,36 @@
+from lightjob.benchmarks import run, compare, percentile
+from lightjob.benchmarks.workloads import WORKLOADS
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) is None
+
+
+def test_run():
+    report = run(backends=['Memory', 'SQLite'], sizes=[50], ops=20, isolate=False)
+    assert [(r['backend'], r['size']) for r in report['results']] == [('Memory', 50), ('SQLite', 50)]
+    for result in report['results']:
+        assert set(result['workloads']) == set(WORKLOADS)
+        assert result['workloads']['insert']['items'] == 50
+        assert result['workloads']['claim']['items'] == 20
+        assert result['workloads']['transition']['items'] == 20
+        assert result['disk_size'] > 0
+    rows = compare(report, report)
+    assert len(rows) == 2 * len(WORKLOADS)
+    assert all(speedup == 1 for _, _, _, _, _, speedup in rows if speedup is not None)
+
+
+def test_errors():
+    report = run(backends=['Memory'], sizes=[10], ops=5, workloads=['claim'], isolate=False)
+    assert set(report['results'][0]['workloads']) == {'insert', 'claim'}
+    for kw in ({'backends': ['Nope']}, {'workloads': ['nope']}):
+        try:
+            run(sizes=[10], isolate=False, **kw)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('expected a ValueError')
@@ -0,0 +1,125 @@
+import shutil
+import threading
+from tempfile import mkdtemp
+from multiprocessing.pool import ThreadPool
+
+from lightjob.db import DB
+from lightjob.db import RUNNING, SUCCESS
+from lightjob.databases import Blitz, Dataset, H5py, Memory, SQLite
+from lightjob.utils import LRU, compile_field
+from lightjob.tests.test_common import with_backend
+
+
+class BaseCacheTest(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+        self.db = self.load()
+        self.reads = []
+        get_by_id = self.db._get_by_id
+
+        def counted(id_):
+            self.reads.append(id_)
+            return get_by_id(id_)
+        self.db._get_by_id = counted
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def load(self, **kw):
+        db = DB(backend=self.backend, cache_size=2, **kw)
+        db.load(self.testdir)
+        return db
+
+    def test_cache(self):
+        db = self.db
+        s = db.add_job({'a': 1})
+        assert db.get_by_id(s)['content'] == {'a': 1}
+        db.get_by_id(s)['content']['a'] = 2  # a copy
+        assert db.get_job_by_summary(s)['content'] == {'a': 1}
+        assert len(self.reads) == 1
+        # the writes drop the job from the cache
+        db.job_update(s, {'tag': 'x'})
+        assert db.get_by_id(s)['tag'] == 'x'
+        db.modify_state_of(s, RUNNING)
+        assert db.get_by_id(s)['state'] == RUNNING
+        db.delete({'summary': s})
+        assert db.get_by_id(s) is None
+        # at most cache_size jobs are cached
+        ids = [db.add_job({'a': i}) for i in range(3)]
+        del self.reads[:]
+        for id_ in ids + ids:
+            db.get_by_id(id_)
+        assert len(self.reads) == 6
+        s = db.claim_next()['summary']
+        assert db.get_by_id(s)['state'] == RUNNING
+
+
+TestCacheBlitz = with_backend(BaseCacheTest, backend=Blitz)
+TestCacheDataset = with_backend(BaseCacheTest, backend=Dataset)
+TestCacheH5py = with_backend(BaseCacheTest, backend=H5py)
+TestCacheMemory = with_backend(BaseCacheTest, backend=Memory)
+TestCacheSQLite = with_backend(BaseCacheTest, backend=SQLite)
+
+
+class TestCacheRevisions(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_revisions(self):
+        reader = DB(backend='SQLite', cache_size=10, cache_revisions=True)
+        reader.load(self.testdir)
+        writer = DB(backend='SQLite')
+        writer.load(self.testdir)
+        s = writer.add_job({'a': 1})
+        assert reader.get_by_id(s)['state'] != RUNNING
+        assert reader.get_by_id(s) == reader.cache.get(s)[0]
+        # written by another process
+        writer.modify_state_of(s, RUNNING)
+        assert reader.get_by_id(s)['state'] == RUNNING
+        writer.job_update(s, {'tag': 'x'})
+        assert reader.get_by_id(s)['tag'] == 'x'
+        writer.delete({'summary': s})
+        assert reader.get_by_id(s) is None
+        s = writer.add_job({'a': 1}, tag='y')
+        assert reader.get_by_id(s)['tag'] == 'y'
+        writer.modify_state_of(s, SUCCESS)
+        assert reader.get_by_id(s)['state'] == SUCCESS
+
+    def test_unsupported(self):
+        try:
+            DB(backend='Blitz', cache_size=10, cache_revisions=True)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Blitz does not record revisions')
+
+
+def test_lru_threads():
+    # the LRU of the field accessors is shared by the threads of AsyncDB
+    cache = LRU(maxsize=8)
+
+    def use(k):
+        for i in range(2000):
+            key = (k + i) % 32
+            cache[key] = i
+            cache.get((key + 1) % 32)
+            cache.pop((key + 2) % 32)
+    threads = [threading.Thread(target=use, args=(k,)) for k in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache) <= 8
+    fields = ['a.b{}'.format(i) for i in range(2000)]
+    pool = ThreadPool(8)
+    try:
+        accessors = pool.map(compile_field, fields * 4)
+    finally:
+        pool.close()
+        pool.join()
+    assert [a.field for a in accessors] == fields * 4
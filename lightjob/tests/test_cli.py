@@ -0,0 +1,78 @@
+import os
+import json
+import shutil
+from tempfile import mkdtemp
+
+from click.testing import CliRunner
+
+from lightjob.cli import main, load_db
+from lightjob.db import RUNNING, SUCCESS
+from lightjob.utils import json_default
+
+
+class TestDumpLoad(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+        self.src = self.create('src')
+        self.dst = self.create('dst')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def create(self, name):
+        folder = os.path.join(self.testdir, name)
+        os.mkdir(folder)
+        with open(os.path.join(folder, '.lightjobrc'), 'w') as fd:
+            json.dump({'backend': 'SQLite'}, fd)
+        return folder
+
+    def invoke(self, *args):
+        result = CliRunner().invoke(main, list(args))
+        assert result.exit_code == 0, result.output
+        return result
+
+    def jobs(self, folder, **kw):
+        db = load_db(folder)
+        # the datetimes of the lives are compared as written in the dumps
+        jobs = json.loads(json.dumps(list(db.jobs_with(**kw)), default=json_default))
+        db.close()
+        return {j['summary']: j for j in jobs}
+
+    def test_dump_load(self):
+        db = load_db(self.src)
+        ids = [db.add_job({'i': i}, where='a' if i % 2 else 'b', tag={'n': i}) for i in range(8)]
+        db.modify_states([(s, SUCCESS, None) for s in ids[:4]])
+        db.modify_states([(s, RUNNING, None) for s in ids[4:6]])
+        db.close()
+        filename = os.path.join(self.testdir, 'dump.jsonl')
+        self.invoke('dump', '--format', 'jsonl', '--state', SUCCESS, '--where', 'a',
+                    '--filename', filename, '--db-folder', self.src)
+        with open(filename) as fd:
+            assert len(fd.readlines()) == 2
+        self.invoke('load', filename, '--db-folder', self.dst)
+        expected = self.jobs(self.src, state=SUCCESS, where='a')
+        loaded = self.jobs(self.dst)
+        assert sorted(loaded) == sorted(expected) == sorted([ids[1], ids[3]])
+        for s, j in expected.items():
+            for key in ('content', 'state', 'life', 'where', 'tag'):
+                assert loaded[s][key] == j[key]
+            assert [l['state'] for l in j['life']] == ['available', SUCCESS]
+
+        # the jobs already in the db are skipped
+        db = load_db(self.dst)
+        db.job_update(ids[1], {'tag': 'kept'})
+        db.close()
+        self.invoke('dump', '--format', 'jsonl', '--filename', filename, '--db-folder', self.src)
+        self.invoke('load', filename, '--db-folder', self.dst)
+        loaded = self.jobs(self.dst)
+        assert sorted(loaded) == sorted(ids)
+        assert loaded[ids[1]]['tag'] == 'kept'
+        assert len(loaded[ids[1]]['life']) == 2
+        assert loaded[ids[5]]['state'] == RUNNING
+        assert loaded[ids[5]]['life'] == self.jobs(self.src)[ids[5]]['life']
+
+    def test_show_tail_limit(self):
+        result = CliRunner().invoke(main, ['show', '--tail', '2', '--limit', '1', '--db-folder', self.src])
+        assert result.exit_code == 2
+        assert '--tail cannot be combined' in result.output
@@ -1,10 +1,16 @@
+import os
+import time
 import shutil
 from tempfile import mkdtemp
 
+import numpy as np
+
 from lightjob.db import DB
 from lightjob.db import AVAILABLE, SUCCESS, RUNNING, ERROR
-from lightjob.databases import Blitz, Dataset, H5py
+from lightjob.db import HASHFILENAME
+from lightjob.databases import Blitz, Dataset, H5py, Memory, SQLite, Remote
 from lightjob.utils import summarize
+from lightjob.runner import Runner
 
 
 class BaseTest(object):
@@ -40,6 +46,15 @@ class BaseTest(object):
         assert len(life) == 5
         assert [l['state'] for l in life] == [AVAILABLE, RUNNING, ERROR, RUNNING, SUCCESS]
 
+    def test_modify_states(self):
+        s1 = self.db.add_job({'a': 1})
+        s2 = self.db.add_job({'a': 2})
+        self.db.modify_states([(s1, RUNNING, None), (s2, ERROR, None), (s1, SUCCESS, None)])
+        assert self.db.get_state_of(s1) == SUCCESS
+        assert self.db.get_state_of(s2) == ERROR
+        life = self.db.get_job_by_summary(s1)['life']
+        assert [l['state'] for l in life] == [AVAILABLE, RUNNING, SUCCESS]
+
     def test_exists(self):
         d = {'a': 1, 'b': 2}
         s = summarize(d)
@@ -56,12 +71,308 @@ class BaseTest(object):
         self.db.add_job(d, x=3, y=2)
         jobs = list(self.db.jobs_with(x=1))
         assert len(jobs) == 2
+        assert self.db.count(x=1) == 2
+        assert self.db.count(state=AVAILABLE) == 3
+        assert self.db.count() == 3
+
+    def test_get_filters(self):
+        self.db.add_job({'lr': 0.1, 'model': {'depth': 2, 'name': 'a'}}, where='x')
+        self.db.add_job({'lr': 0.01, 'model': {'depth': 5, 'name': 'b'}}, where='x')
+        self.db.add_job({'lr': 0.1, 'model': {'depth': 8, 'name': 'c'}}, where='y')
+
+        def names(d):
+            return sorted(j['content']['model']['name'] for j in self.db.get(d))
+        assert names({'content': {'lr': 0.1}}) == ['a', 'c']
+        assert names({'content.lr': 0.1, 'where': 'x'}) == ['a']
+        assert names({'content': {'model': {'depth': {'$gt': 2}}}}) == ['b', 'c']
+        assert names({'content.model.depth': {'$gte': 2, '$lt': 8}}) == ['a', 'b']
+        assert names({'content.model.name': {'$in': ['a', 'b']}}) == ['a', 'b']
+        assert names({'content.model.name': {'$ne': 'a'}}) == ['b', 'c']
+        assert names({'content.batch_size': {'$exists': False}}) == ['a', 'b', 'c']
+        assert names({'content.lr': 0.5}) == []
+        assert names({'nothere': 1}) == []
+
+    def test_get_values(self):
+        self.db.add_job({'acc': [0.5, 0.9, 0.7]})
+        self.db.add_job({'acc': [0.1]})
+        self.db.add_job({'loss': 1})
+        values = sorted(v['content.acc:max'] for v in self.db.get_values('content.acc:max'))
+        assert values == [0.1, 0.9]
+        j = self.db.get_job_by_summary(summarize({'acc': [0.5, 0.9, 0.7]}))
+        assert self.db.get_value(j, 'content.acc[-1]') == 0.7
+        assert self.db.get_value(j, 'content.loss', if_not_found=None) is None
+
+    def test_get_columns(self):
+        self.db.add_job({'acc': 0.5, 'model': 'a'}, where='x')
+        self.db.add_job({'acc': 0.9, 'model': 'b'}, where='x')
+        self.db.add_job({'model': 'c'}, where='x')
+        self.db.add_job({'acc': 0.1, 'model': 'd'}, where='y')
+        cols = self.db.get_columns(['content.acc', 'content.model'], where={'where': 'x'})
+        order = np.argsort(cols['content.model'])
+        assert cols['content.acc'].dtype.kind == 'f'
+        assert cols['content.model'].dtype == object
+        assert list(cols['content.model'][order]) == ['a', 'b', 'c']
+        acc = cols['content.acc'][order]
+        assert list(acc[0:2]) == [0.5, 0.9] and np.isnan(acc[2])
+        assert len(cols['summary']) == 3
+
+    def test_get_slice(self):
+        for i in range(5):
+            self.db.add_job({'i': i}, where='x')
+        self.db.add_job({'i': 5}, where='y')
+        all_ids = [j['summary'] for j in self.db.get({'where': 'x'})]
+        ids = [j['summary'] for j in self.db.get_slice({'where': 'x'}, offset=1, limit=2)]
+        assert ids == all_ids[1:3]
+        assert len(list(self.db.get_slice({'where': 'x'}, offset=3))) == 2
+        assert len(list(self.db.get_slice({}, limit=0))) == 0
+
+    def test_query(self):
+        self.db.add_job({'acc': 0.95, 'model': 'resnet', 'layers': [1, 2]})
+        self.db.add_job({'acc': 0.5, 'model': 'resnet', 'layers': [3]})
+        self.db.add_job({'acc': 0.99, 'model': 'vgg', 'layers': []})
+        self.db.add_job({'model': 'mlp'}, where='x')
+
+        def accs(expr, **kw):
+            return sorted((j['content'].get('acc') for j in self.db.query(expr, **kw)),
+                          key=lambda acc: -1 if acc is None else acc)
+        assert accs('content.acc > 0.9 and content.model == "resnet"') == [0.95]
+        assert accs("0.9 < content.acc and content.acc <= 0.99") == [0.95, 0.99]
+        assert accs("content.model in ['vgg', 'mlp'] and not content.acc") == [None]
+        assert accs('content.model != "resnet" or content.layers:len > 1') == [None, 0.95, 0.99]
+        assert accs('content.layers[0] == 3') == [0.5]
+        assert accs('content.acc == null', where='x') == [None]
+        try:
+            accs('content.acc >')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('invalid expression was accepted')
+
+    def test_query_uncomparable(self):
+        s1 = self.db.add_job({'acc': None, 'name': 'b'})
+        s2 = self.db.add_job({'acc': 0.9, 'name': None})
+        s3 = self.db.add_job({'name': 2})
+        self.db.add_job({'i': 4})
+
+        def ids(expr):
+            return sorted(j['summary'] for j in self.db.query(expr))
+        assert ids('content.acc > 0.5') == [s2]
+        assert ids('content.acc <= 0.9 and content.acc >= 0.1') == [s2]
+        assert ids('content.name > "a"') == [s1]
+        assert ids('content.name < 3') == [s3]
+        assert ids('content.acc == null and content.name > "a"') == [s1]
+        assert len(list(self.db.get_slice({'content.acc': {'$lt': 1}}, limit=1))) == 1
+        assert self.db.count(content={'acc': {'$gte': 0.9}}) == 1
+
+    def test_query_mixed_types(self):
+        s1 = self.db.add_job({'acc': 0.9, 'tags': 'a'})
+        s2 = self.db.add_job({'acc': 'high', 'tags': ['a', 'b']})
+        s3 = self.db.add_job({'acc': [1], 'tags': ['a']})
+        s4 = self.db.add_job({'acc': 0.2, 'tags': 'b'})
+
+        def ids(d):
+            return sorted(j['summary'] for j in self.db.get(d))
+        assert ids({'content.acc': {'$gt': 0.5}}) == [s1]
+        assert ids({'content.acc': {'$lte': 1}}) == sorted([s1, s4])
+        assert ids({'content.acc': {'$gt': 'a'}}) == [s2]
+        assert ids({'content.tags': 'a'}) == [s1]
+        assert ids({'content.tags': ['a']}) == [s3]
+        assert ids({'content.tags': {'$in': ['a', 'c']}}) == [s1]
+        assert ids({'content.tags': {'$ne': 'a'}}) == sorted([s2, s3, s4])
+        assert ids({'content.tags': {'$nin': ['b']}}) == sorted([s1, s2, s3])
+        assert self.db.count(content={'acc': {'$gt': 0.5}}) == 1
+        assert self.db.count(content={'tags': 'a'}) == 1
+
+    def test_hash_algorithm(self):
+        s = self.db.add_job({'a': np.float64(0.5), 'b': (1, 2)})
+        assert s == summarize({'a': 0.5, 'b': [1, 2]})
+        self.db.close()
+        os.remove(os.path.join(self.testdir, HASHFILENAME))
+        db = DB(backend=self.backend)
+        db.load(self.testdir)
+        assert db.hash_algorithm == 'md5'
+        db = DB(backend=self.backend, hash_algorithm='blake2b')
+        try:
+            db.load(self.testdir)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('the hash algorithm of a db was changed')
+        testdir = mkdtemp(suffix='lightjob')
+        try:
+            db = DB(backend=self.backend, hash_algorithm='blake2b')
+            db.load(testdir)
+            assert db.add_job({'a': 1}) == summarize({'a': 1}, algorithm='blake2b')
+            assert db.safe_add_jobs([{'a': 1}, {'a': 2}]) == 1
+            db.close()
+        finally:
+            shutil.rmtree(testdir)
 
     def test_safe_add(self):
         d = {'a': 1, 'b': 2}
         assert self.db.safe_add_job(d) == 1
         assert self.db.safe_add_job(d) == 0
 
+    def test_delete(self):
+        s1 = self.db.add_job({'a': 1})
+        s2 = self.db.add_job({'a': 2})
+        self.db.delete({'summary': s1})
+        assert self.db.get_job_by_summary(s1) is None
+        assert not self.db.job_exists({'a': 1})
+        assert [j['summary'] for j in self.db.all_jobs()] == [s2]
+        assert self.db.safe_add_job({'a': 1}) == 1
+        assert self.db.count() == 2
+
+    def test_claim_next(self):
+        self.db.add_job({'a': 1})
+        self.db.add_job({'a': 2})
+        j1 = self.db.claim_next(worker='w1')
+        j2 = self.db.claim_next(worker='w2')
+        assert self.db.claim_next() is None
+        assert self.db.claim_next() is None
+        assert j1['summary'] != j2['summary']
+        for j, worker in ((j1, 'w1'), (j2, 'w2')):
+            assert j['state'] == RUNNING
+            assert j['worker'] == worker
+            assert [l['state'] for l in j['life']] == [AVAILABLE, RUNNING]
+            assert self.db.get_state_of(j['summary']) == RUNNING
+
+    def test_lease(self):
+        s1 = self.db.add_job({'a': 1})
+        s2 = self.db.add_job({'a': 2})
+        self.db.add_job({'a': 3})
+        j1 = self.db.claim_next(worker='w1', lease=-1)
+        j2 = self.db.claim_next(worker='w2', lease=-1)
+        assert self.db.heartbeat(j2['summary'], lease=100)
+        assert not self.db.heartbeat('nothere')
+        assert self.db.reap() == [j1['summary']]
+        assert self.db.reap() == []
+        assert self.db.get_state_of(j1['summary']) == AVAILABLE
+        assert self.db.get_state_of(j2['summary']) == RUNNING
+        life = self.db.get_job_by_summary(j1['summary'])['life']
+        assert [l['state'] for l in life] == [AVAILABLE, RUNNING, AVAILABLE]
+        assert set([j1['summary'], j2['summary']]) <= set([s1, s2, self.db.summarize({'a': 3})])
+
+    def test_heartbeat_owner(self):
+        self.db.add_job({'a': 1})
+        s = self.db.claim_next(worker='w1', lease=-1)['summary']
+        assert self.db.heartbeat(s, lease=-1, worker='w1')
+        assert not self.db.heartbeat(s, lease=100, worker='w2')
+        # reaped and claimed again by another worker
+        assert self.db.reap() == [s]
+        assert not self.db.heartbeat(s, lease=100, worker='w1')
+        assert self.db.claim_next(worker='w2', lease=100)['summary'] == s
+        assert not self.db.heartbeat(s, lease=100, worker='w1')
+        assert self.db.heartbeat(s, lease=100, worker='w2')
+        assert self.db.heartbeat(s, lease=100)
+        self.db.modify_state_of(s, SUCCESS)
+        assert not self.db.heartbeat(s, lease=100, worker='w2')
+
+    def test_reap_finished(self):
+        s1 = self.db.add_job({'a': 1})
+        s2 = self.db.add_job({'a': 2})
+        self.db.claim_next(worker='w', lease=-1)
+        self.db.claim_next(worker='w', lease=-1)
+        # finished after its lease expired
+        self.db.modify_state_of(s1, SUCCESS)
+        assert self.db.reap() == [s2]
+        assert self.db.get_state_of(s1) == SUCCESS
+        assert [l['state'] for l in self.db.get_job_by_summary(s1)['life']] == [AVAILABLE, RUNNING, SUCCESS]
+        assert self.db.state_counts() == {SUCCESS: 1, AVAILABLE: 1}
+
+    def test_runner(self):
+        ids = [self.db.add_job({'i': i}) for i in range(10)]
+        counts = Runner(self.db, fail_on_multiples_of_3, workers=3, in_flight=2,
+                        mode='thread', worker='w').run()
+        assert counts == {SUCCESS: 6, ERROR: 4}
+        for i, s in enumerate(ids):
+            j = self.db.get_job_by_summary(s)
+            assert j['state'] == (ERROR if i % 3 == 0 else SUCCESS)
+            assert j['worker'] == 'w'
+            assert [l['state'] for l in j['life']][0:2] == [AVAILABLE, RUNNING]
+
+    def test_runner_lost_jobs(self):
+        ids = [self.db.add_job({'i': i}) for i in range(2)]
+        # the jobs are reaped and claimed by another worker while they run
+        self.db.heartbeat = lambda s, **kw: False
+        counts = Runner(self.db, sleep, workers=2, mode='thread', worker='w',
+                        lease=100, heartbeat=0.01).run()
+        assert counts == {SUCCESS: 0, ERROR: 0}
+        assert all(self.db.get_state_of(s) == RUNNING for s in ids)
+
+    def test_batch(self):
+        s = self.db.add_job({'a': 1})
+        with self.db.batch():
+            with self.db.transaction():
+                self.db.job_update(s, {'tag': 'x'})
+            self.db.modify_state_of(s, RUNNING)
+            assert self.db.in_batch
+        assert not self.db.in_batch
+        j = self.db.get_by_id(s)
+        assert j['tag'] == 'x'
+        assert j['state'] == RUNNING
+        try:
+            with self.db.batch():
+                self.db.job_update(s, {'tag': 'y'})
+                self.db.add_job({'a': 2})
+                raise ValueError()
+        except ValueError:
+            pass
+        assert not self.db.in_batch
+        if not isinstance(self.db, (H5py, Remote)):  # no rollback
+            assert self.db.get_by_id(s)['tag'] == 'x'
+            assert self.db.count() == 1
+
+    def test_state_counts(self):
+        ids = [self.db.add_job({'a': i}) for i in range(6)]
+        self.db.safe_add_jobs([{'a': i} for i in range(8)])
+        self.db.claim_next(worker='w')
+        self.db.modify_states([(ids[1], ERROR, None), (ids[2], SUCCESS, None), (ids[2], SUCCESS, None)])
+        self.db.job_update(ids[3], {'state': ERROR})
+        self.db.delete({'summary': ids[4]})
+        backend = getattr(self, 'served_backend', None) or self.backend
+        if backend not in (Dataset, SQLite):
+            # the other backends replace a job inserted again
+            job = self.db.get_job_by_summary(ids[5])
+            job['state'] = SUCCESS
+            self.db.insert_list([job, job])
+        expected = {}
+        for state in [j['state'] for j in self.db.all_jobs()]:
+            expected[state] = expected.get(state, 0) + 1
+        assert self.db.state_counts() == expected
+        assert sum(expected.values()) == 7
+        for state in (AVAILABLE, RUNNING, SUCCESS, ERROR, 'nothing'):
+            assert self.db.count(state=state) == expected.get(state, 0)
+        try:
+            with self.db.batch():
+                self.db.add_job({'a': 100})
+                raise ValueError()
+        except ValueError:
+            pass
+        assert self.db.rebuild_state_counts() == self.db.state_counts()
+        assert sum(self.db.state_counts().values()) == self.db.count()
+
+    def test_safe_add_jobs(self):
+        assert self.db.safe_add_job({'a': 0}) == 1
+        contents = [{'a': i} for i in range(5)] + [{'a': 1}]
+        assert self.db.safe_add_jobs(contents, batch_size=2, x=1) == 4
+        assert self.db.safe_add_jobs(contents, batch_size=2) == 0
+        jobs = list(self.db.all_jobs())
+        assert len(jobs) == 5
+        j = self.db.get_job_by_summary(summarize({'a': 3}))
+        assert j['state'] == AVAILABLE
+        assert j['x'] == 1
+        assert [l['state'] for l in j['life']] == [AVAILABLE]
+
+
+def fail_on_multiples_of_3(content):
+    if content['i'] % 3 == 0:
+        raise ValueError(content['i'])
+
+
+def sleep(content):
+    time.sleep(0.1)
+
 
 def with_backend(cls, backend):
     class C(cls):
@@ -74,6 +385,8 @@ def with_backend(cls, backend):
 TestBlitz = with_backend(BaseTest, backend=Blitz)
 TestDataset = with_backend(BaseTest, backend=Dataset)
 TestH5py = with_backend(BaseTest, backend=H5py)
+TestMemory = with_backend(BaseTest, backend=Memory)
+TestSQLite = with_backend(BaseTest, backend=SQLite)
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,80 @@
+import json
+import shutil
+from tempfile import mkdtemp
+
+import dataset
+from sqlalchemy.exc import IntegrityError
+
+from lightjob.db import DB
+from lightjob.db import AVAILABLE, RUNNING, SUCCESS
+
+LIFE = [{'state': AVAILABLE, 'dt': '2020-01-01T00:00:00'},
+        {'state': RUNNING, 'dt': '2020-01-02T00:00:00'}]
+
+
+class TestDatasetMigrations(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def create_old(self, ids):
+        # layout of the older versions : the life is stored with
+        # the job in 'table', without any index
+        db = dataset.connect('sqlite:///{}/db'.format(self.testdir))
+        for id_ in ids:
+            db['table'].insert({
+                'summary': id_, 'state': RUNNING,
+                'content': json.dumps({'id': id_}), 'life': json.dumps(LIFE)})
+        db.engine.dispose()
+
+    def load(self):
+        db = DB(backend='Dataset')
+        db.load(self.testdir)
+        return db
+
+    def test_migrate_life(self):
+        self.create_old(['a', 'b'])
+        db = self.load()
+        assert db.get_by_id('a')['life'] == LIFE
+        assert [j['life'] for j in db.get({})] == [LIFE, LIFE]
+        assert db.get_by_id('a')['content'] == {'id': 'a'}
+        db.modify_states([('a', SUCCESS, None)])
+        life = db.get_by_id('a')['life']
+        assert life[:2] == LIFE
+        assert [l['state'] for l in life] == [AVAILABLE, RUNNING, SUCCESS]
+        assert db.get_by_id('b')['life'] == LIFE
+        # the life is moved once
+        db = self.load()
+        assert len(db.get_by_id('a')['life']) == 3
+
+    def indexes(self, db):
+        rows = db.db.query("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'table'")
+        return {row['name']: row['sql'] for row in rows}
+
+    def test_create_indexes(self):
+        self.create_old(['a', 'b'])
+        db = self.load()
+        indexes = self.indexes(db)
+        assert indexes['ix_table_summary'].startswith('CREATE UNIQUE INDEX')
+        assert indexes['ix_table_state'].startswith('CREATE INDEX')
+        db.add_job({'i': 1})
+        try:
+            db.add_job({'i': 1})
+        except IntegrityError:
+            pass
+        else:
+            assert False, 'add_job inserted a duplicate'
+        assert db.count() == 3
+
+    def test_create_indexes_with_duplicates(self):
+        self.create_old(['a', 'a', 'b'])
+        db = self.load()
+        # the duplicates are kept, the index on the ids is not unique
+        assert self.indexes(db)['ix_table_summary'].startswith('CREATE INDEX')
+        assert db.count() == 3
+        assert db.get_by_id('a')['summary'] == 'a'
+        assert db.safe_add_job({'i': 1}) == 1
+        assert db.safe_add_job({'i': 1}) == 0
@@ -0,0 +1,53 @@
+import os
+import json
+import shutil
+from tempfile import mkdtemp
+
+import h5py
+
+from lightjob.db import DB
+from lightjob.db import AVAILABLE, RUNNING, SUCCESS
+
+LIFE = [{'state': AVAILABLE, 'dt': '2020-01-01T00:00:00'},
+        {'state': RUNNING, 'dt': '2020-01-02T00:00:00'}]
+
+
+class TestH5pyMigrations(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def create_old(self, ids):
+        # layout of the older versions : each job is an attribute
+        # of the file, with its life
+        with h5py.File(os.path.join(self.testdir, 'db.hdf5'), 'w') as f:
+            for id_ in ids:
+                f.attrs[id_] = json.dumps({
+                    'summary': id_, 'state': RUNNING,
+                    'content': {'id': id_}, 'life': LIFE})
+
+    def load(self):
+        db = DB(backend='H5py')
+        db.load(self.testdir)
+        return db
+
+    def test_migrate_life(self):
+        self.create_old(['a', 'b'])
+        db = self.load()
+        assert db.get_by_id('a')['life'] == LIFE
+        assert [j['life'] for j in db.get({})] == [LIFE, LIFE]
+        assert db.get_by_id('a')['content'] == {'id': 'a'}
+        assert db.state_counts() == {RUNNING: 2}
+        db.modify_states([('a', SUCCESS, None)])
+        life = db.get_by_id('a')['life']
+        assert life[:2] == LIFE
+        assert [l['state'] for l in life] == [AVAILABLE, RUNNING, SUCCESS]
+        assert db.get_by_id('b')['life'] == LIFE
+        db.close()
+        # the life is moved once
+        db = self.load()
+        assert len(db.get_by_id('a')['life']) == 3
+        db.close()
@@ -0,0 +1,24 @@
+import sys
+import json
+import subprocess
+
+# modules which make the imports slow, only the ones
+# of the backend of the db should be imported
+HEAVY = ('blitzdb', 'dataset', 'sqlalchemy', 'h5py', 'numpy', 'dateutil', 'tabulate')
+
+
+def imported_after(code):
+    """the heavy modules imported by `code`, run in a new interpreter"""
+    code += '\nimport sys, json\nprint(json.dumps([m for m in {!r} if m in sys.modules]))'.format(HEAVY)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return set(json.loads(out.decode('utf-8').splitlines()[-1]))
+
+
+def test_import_cli():
+    assert imported_after('import lightjob.cli') == set()
+
+
+def test_import_backend():
+    imported = imported_after('from lightjob.db import DB\nDB(backend="Blitz")')
+    assert 'blitzdb' in imported
+    assert not imported & {'dataset', 'h5py', 'numpy'}
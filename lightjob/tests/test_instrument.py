@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+import asyncio
+import threading
+from tempfile import mkdtemp
+
+from lightjob.db import DB
+from lightjob.db import SOCKETFILENAME
+from lightjob.db import SUCCESS
+from lightjob.databases import Blitz, Dataset, H5py, Memory, SQLite
+from lightjob.server import Server
+from lightjob.instrument import BUCKETS, Stats, load, merge, quantile, reset, timed, timed_serializer, to_prometheus
+from lightjob.tests.test_common import with_backend
+
+
+class BaseInstrumentTest(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+        self.db = DB(backend=self.backend, instrument=True)
+        self.db.load(self.testdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_stats(self):
+        db = self.db
+        ids = [db.add_job({'a': i}) for i in range(3)]
+        db.safe_add_jobs([{'a': i} for i in range(5)])
+        assert db.get_by_id(ids[0])['content'] == {'a': 0}
+        assert len(list(db.get({}))) == 5
+        db.modify_state_of(ids[0], SUCCESS)
+        db.delete({'summary': ids[1]})
+        stats = db.stats()
+        ops = stats['operations']
+        for name in ('insert', 'get_by_id', 'get', 'modify_state_of', 'modify_states', 'update_states',
+                     'delete', 'summarize', 'summarize_many'):
+            assert ops[name]['count'] >= 1, name
+            assert sum(ops[name]['histogram']) == ops[name]['count']
+            assert len(ops[name]['histogram']) == len(BUCKETS) + 1
+        assert ops['insert']['count'] == 3
+        assert ops['summarize']['count'] == 3
+        assert stats['commits'] >= 3
+        if self.backend is not Blitz:
+            assert stats['serialized_bytes'] > 0
+        # saved in the db folder when the db is closed
+        db.close()
+        assert load(self.testdir) == stats
+        assert load(self.testdir) == merge([stats])
+        reset(self.testdir)
+        assert load(self.testdir)['commits'] == 0
+
+
+TestInstrumentBlitz = with_backend(BaseInstrumentTest, backend=Blitz)
+TestInstrumentDataset = with_backend(BaseInstrumentTest, backend=Dataset)
+TestInstrumentH5py = with_backend(BaseInstrumentTest, backend=H5py)
+TestInstrumentMemory = with_backend(BaseInstrumentTest, backend=Memory)
+TestInstrumentSQLite = with_backend(BaseInstrumentTest, backend=SQLite)
+
+
+class TestInstrument(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_disabled(self):
+        db = DB(backend='Memory')
+        db.load(self.testdir)
+        # nothing is wrapped
+        assert 'get' not in vars(db)
+        try:
+            db.stats()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('the db is not instrumented')
+        db.close()
+        assert not os.path.exists(os.path.join(self.testdir, 'stats'))
+
+    def test_errors(self):
+        stats = Stats()
+
+        def fail():
+            raise KeyError('a')
+        fn = timed(stats, 'fail', fail)
+        try:
+            fn()
+        except KeyError:
+            pass
+        assert stats.operations['fail']['count'] == 1
+        assert stats.operations['fail']['errors'] == 1
+
+    def test_serialized_bytes(self):
+        stats = Stats()
+        fn = timed_serializer(stats, lambda d: {k: json.dumps(v, ensure_ascii=False) for k, v in d.items()})
+        fn({'a': u'\u00e9t\u00e9', 'b': [1]})
+        # '"été"' is 7 bytes in utf-8, '[1]' 3 bytes
+        assert stats.serialized_bytes == 10
+        assert stats.serialize_calls == 1
+
+    def test_prometheus(self):
+        db = DB(backend='Memory', instrument=True)
+        db.load(self.testdir)
+        db.add_job({'a': 1})
+        stats = db.stats()
+        text = to_prometheus(stats)
+        assert '# TYPE lightjob_operation_seconds histogram' in text
+        assert 'lightjob_operation_seconds_bucket{operation="insert",le="+Inf"} 1' in text
+        assert 'lightjob_operation_seconds_count{operation="insert"} 1' in text
+        assert 'lightjob_commits_total {}'.format(stats['commits']) in text
+        assert quantile(stats['operations']['insert'], 0.5) in BUCKETS
+        db.close()
+
+    def test_served(self):
+        served = DB(backend='Memory', instrument=True)
+        served.load(self.testdir)
+        server = Server(served, os.path.join(self.testdir, SOCKETFILENAME))
+        ready = threading.Event()
+        thread = threading.Thread(target=asyncio.run, args=(server.serve(ready),))
+        thread.start()
+        ready.wait()
+        try:
+            db = DB(backend='Remote')
+            db.load(self.testdir)
+            db.add_job({'a': 1})
+            assert db.stats()['commits'] >= 1
+            db.close()
+        finally:
+            server.stop()
+            thread.join()
@@ -0,0 +1,87 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+from lightjob.db import DB
+from lightjob.db import AVAILABLE, RUNNING, SUCCESS
+from lightjob.databases.memory import WALFILENAME, SNAPSHOTFILENAME
+
+
+class TestMemoryPersistence(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def load(self, **kw):
+        db = DB(backend='Memory', **kw)
+        db.load(self.testdir)
+        return db
+
+    def fill(self, db):
+        ids = [db.add_job({'i': i}) for i in range(5)]
+        db.modify_states([(ids[0], RUNNING, None), (ids[1], SUCCESS, None)])
+        db.job_update(ids[2], {'tag': 'x'})
+        db.claim_next(worker='w')
+        db.delete({'summary': ids[4]})
+        return ids
+
+    def check(self, db, ids):
+        assert db.count() == 4
+        assert db.get_state_of(ids[0]) == RUNNING
+        assert db.get_state_of(ids[1]) == SUCCESS
+        assert db.get_by_id(ids[2])['tag'] == 'x'
+        assert [j['summary'] for j in db.jobs_with(worker='w')] == [ids[2]]
+        assert [l['state'] for l in db.get_by_id(ids[2])['life']] == [AVAILABLE, RUNNING]
+        assert [j['summary'] for j in db.jobs_with_state(AVAILABLE)] == [ids[3]]
+        assert not db.job_exists_by_summary(ids[4])
+
+    def test_replay(self):
+        db = self.load(fsync='always')
+        ids = self.fill(db)
+        self.check(db, ids)
+        db.close()
+        self.check(self.load(), ids)
+
+    def test_snapshot(self):
+        db = self.load(snapshot_every=3)
+        ids = self.fill(db)
+        assert db.generation > 0
+        db.close()
+        db = self.load()
+        self.check(db, ids)
+        db.snapshot()
+        db.close()
+        # a log older than the snapshot is ignored
+        with open(os.path.join(self.testdir, WALFILENAME), 'w') as fd:
+            fd.write('{"generation": 0}\n{"op": "delete", "ids": %s}\n' % str(ids).replace("'", '"'))
+        self.check(self.load(), ids)
+        assert os.path.exists(os.path.join(self.testdir, SNAPSHOTFILENAME))
+
+    def test_truncated_record(self):
+        db = self.load()
+        ids = self.fill(db)
+        db.close()
+        filename = os.path.join(self.testdir, WALFILENAME)
+        size = os.path.getsize(filename)
+        with open(filename, 'a') as fd:
+            fd.write('{"op": "delete", "ids": ["')
+        db = self.load()
+        self.check(db, ids)
+        assert os.path.getsize(filename) == size
+        s = db.add_job({'i': 5})
+        db.close()
+        assert self.load().job_exists_by_summary(s)
+
+    def test_lock(self):
+        db = self.load()
+        try:
+            self.load()
+        except IOError:
+            pass
+        else:
+            raise AssertionError('the db was opened twice')
+        db.close()
+        self.load()
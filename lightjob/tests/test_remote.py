@@ -0,0 +1,100 @@
+import os
+import shutil
+import asyncio
+import threading
+from tempfile import mkdtemp
+
+from lightjob.db import DB
+from lightjob.db import SOCKETFILENAME
+from lightjob.databases import Blitz, Dataset, H5py, Memory, SQLite, Remote
+from lightjob.server import Server
+from lightjob.tests.test_common import BaseTest
+
+
+class BaseRemoteTest(BaseTest):
+    """the tests of the backends, on a db served by the backend"""
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+        served = DB(backend=self.served_backend)
+        served.load(self.testdir)
+        self.server = Server(served, os.path.join(self.testdir, SOCKETFILENAME))
+        ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.server.serve(ready),))
+        self.thread.start()
+        ready.wait()
+        self.db = DB(backend=Remote)
+        self.db.load(self.testdir)
+
+    def tearDown(self):
+        self.db.close()
+        self.server.stop()
+        self.thread.join()
+        shutil.rmtree(self.testdir)
+
+    def test_hash_algorithm(self):
+        # the hash algorithm is the one of the served db
+        assert self.db.hash_algorithm == 'md5'
+
+    def test_clients(self):
+        other = DB(backend=Remote)
+        other.load(self.testdir)
+        s = self.db.add_job({'a': 1})
+        assert other.job_exists_by_summary(s)
+        assert other.claim_next(worker='w')['summary'] == s
+        assert self.db.claim_next() is None
+        assert self.db.count(state='running') == 1
+        other.close()
+
+    def test_cursors(self):
+        self.db.chunk_size = 2
+        for i in range(5):
+            self.db.add_job({'i': i})
+        assert next(self.db.get({}))['content'] == {'i': 0}
+        for j in self.db.get({}):
+            break
+        assert len(list(self.db.get({}))) == 5
+        assert len(self.server.cursors) == 0
+        self.server.max_cursors = 2
+        cids = [self.db.call('open_cursor', {}) for _ in range(3)]
+        assert list(self.server.cursors.keys()) == cids[1:]
+        try:
+            self.db.call('next', cids[0], 2)
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('the least recently used cursor is dropped')
+        assert len(self.db.call('next', cids[1], 2)) == 2
+        self.server.cursor_timeout = 0
+        cid = self.db.call('open_cursor', {})
+        assert list(self.server.cursors.keys()) == [cid]
+
+    def test_index(self):
+        s1 = self.db.add_job({'a': 1})
+        s2 = self.db.add_job({'a': 2})
+        assert self.db.count(state='available') == 2
+        index = self.server.index
+        self.db.job_update(s1, {'state': 'running', 'tag': 'x'})
+        assert self.db.state_counts() == {'available': 1, 'running': 1}
+        self.db.delete({'summary': s2})
+        assert self.db.state_counts() == {'running': 1}
+        self.db.delete({'tag': 'x'})
+        assert self.db.state_counts() == {}
+        assert not self.db.job_exists_by_summary(s1)
+        # updated in place, not rebuilt
+        assert self.server.index is index
+
+
+def with_server(backend):
+    class C(BaseRemoteTest):
+        pass
+    C.__name__ = 'TestRemote' + backend.__name__
+    C.served_backend = backend
+    return C
+
+
+TestRemoteBlitz = with_server(Blitz)
+TestRemoteDataset = with_server(Dataset)
+TestRemoteH5py = with_server(H5py)
+TestRemoteMemory = with_server(Memory)
+TestRemoteSQLite = with_server(SQLite)
@@ -0,0 +1,85 @@
+import shutil
+from tempfile import mkdtemp
+from multiprocessing import Pool
+
+from lightjob.db import DB
+from lightjob.db import RUNNING
+from lightjob.databases import sqlite
+
+
+def claim_all(testdir):
+    db = DB(backend='SQLite', timeout=60)
+    db.load(testdir)
+    claimed = []
+    while True:
+        j = db.claim_next(worker='w')
+        if j is None:
+            break
+        claimed.append(j['summary'])
+    db.close()
+    return claimed
+
+
+class TestSQLiteWriters(object):
+
+    def setUp(self):
+        self.testdir = mkdtemp(suffix='lightjob')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_concurrent_claims(self):
+        db = DB(backend='SQLite')
+        db.load(self.testdir)
+        db.safe_add_jobs([{'i': i} for i in range(200)])
+        pool = Pool(4)
+        try:
+            claimed = sum(pool.map(claim_all, [self.testdir] * 4), [])
+        finally:
+            pool.close()
+            pool.join()
+        assert len(claimed) == 200
+        assert len(set(claimed)) == 200
+        assert db.count(state=RUNNING) == 200
+        assert all(len(j['life']) == 2 for j in db.all_jobs())
+
+    def test_meta_fields(self):
+        db = DB(backend='SQLite')
+        db.load(self.testdir)
+        s = db.add_job({'a': {'b': 1}}, tag='x', meta={'n': 2})
+        assert db.get_by_id(s)['tag'] == 'x'
+        assert [j['summary'] for j in db.jobs_with(tag='x')] == [s]
+        assert [j['summary'] for j in db.get({'meta.n': 2})] == [s]
+        assert [j['summary'] for j in db.get({'content': {'a': {'b': 1}}})] == [s]
+        assert db.count(tag='y') == 0
+
+    def test_state_counts_migration(self):
+        db = DB(backend='SQLite')
+        db.load(self.testdir)
+        db.safe_add_jobs([{'i': i} for i in range(5)])
+        db.claim_next()
+        # db created before the counters
+        db.conn.execute('DROP TABLE state_counts')
+        db.close()
+        db = DB(backend='SQLite')
+        db.load(self.testdir)
+        assert db.state_counts() == {'available': 4, 'running': 1}
+        # counters out of sync are repaired by a rebuild
+        db.conn.execute("UPDATE state_counts SET n = 10 WHERE state = 'running'")
+        assert db.count(state=RUNNING) == 10
+        assert db.rebuild_state_counts() == {'available': 4, 'running': 1}
+
+    def test_sqlite_version(self):
+        min_version = sqlite.MIN_SQLITE_VERSION
+        sqlite.MIN_SQLITE_VERSION = (99, 0, 0)
+        try:
+            for backend in ('SQLite', 'Dataset'):
+                db = DB(backend=backend)
+                try:
+                    db.load(self.testdir)
+                except RuntimeError as e:
+                    assert 'sqlite 99.0.0 or later' in str(e)
+                else:
+                    assert False
+        finally:
+            sqlite.MIN_SQLITE_VERSION = min_version
@@ -1,8 +1,22 @@
 import os
+import copy
 import json
 import hashlib
-import collections
+import threading
 import six
+from itertools import islice
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 
 def mkdir_path(path):
@@ -50,19 +64,178 @@ def get_parent_directory(path):
     return os.path.dirname(os.path.normpath(path))
 
 
-def summarize(d):
+def parse_address(address):
+    """(host, port) for an address 'host:port', otherwise the path of a unix socket"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or 'localhost', int(port)
+    return address
+
+
+def chunks(iterable, size):
+    """
+    split an iterable into lists of at most `size` elements
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@contextmanager
+def file_lock(filename):
+    """
+    context manager holding an exclusive lock on `filename`
+    (created if it does not exist) so that several processes
+    working on the same db folder can serialize their writes.
+    on platforms without `fcntl` the lock is a no-op.
+    """
+    with open(filename, 'a') as fd:
+        if fcntl is not None:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+
+
+def _canonical_default(obj):
+    # numpy scalars and arrays, without importing numpy
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+# a single encoder is reused, json.dumps builds a new one
+# at each call when it is given options.
+_CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True, default=_canonical_default)
+
+
+def canonical_json(d):
+    """
+    json encoding of `d` which does not depend on the ordering of
+    the keys of the dicts. tuples are encoded like lists,
+    numpy scalars and arrays like the python numbers and lists
+    they hold. it is the same as json.dumps(d, sort_keys=True) for
+    the values json.dumps can encode.
+    """
+    return _CANONICAL_ENCODER.encode(d)
+
+
+def _blake2b():
+    return hashlib.blake2b(digest_size=16)
+
+
+HASHES = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': _blake2b,
+}
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    HASHES['xxhash'] = xxhash.xxh3_128
+
+DEFAULT_HASH = 'md5'
+
+
+def summarize(d, algorithm=DEFAULT_HASH):
     """
     hash a dict making sure the ordering of the content of the dict
-    does not affect the hash. it is implemented by ordering the dict keys.
+    does not affect the hash. it is implemented by ordering the dict keys
+    (see `canonical_json`).
+
+    Parameters
+    ----------
+
+    d : dict
+        content to hash
+    algorithm : str[default='md5']
+        name of the hash function, one of the keys of HASHES.
+        'xxhash' is available if the package xxhash is installed.
     """
-    s = json.dumps(d, sort_keys=True)
-    m = hashlib.md5()
-    m.update(six.b(s))
+    try:
+        m = HASHES[algorithm]()
+    except KeyError:
+        raise ValueError('unknown hash algorithm : {}, available : {}'.format(
+            algorithm, ', '.join(sorted(HASHES.keys()))))
+    m.update(canonical_json(d).encode('utf-8'))
     return m.hexdigest()
 
+
+def summarize_many(contents, algorithm=DEFAULT_HASH, processes=None, chunksize=64):
+    """
+    hash a list of contents with `summarize`.
+
+    Parameters
+    ----------
+
+    contents : list of dicts
+    algorithm : str[default='md5']
+        name of the hash function
+    processes : int, optional
+        if given and greater than 1, the contents are hashed
+        by a pool of `processes` processes, which is worth it
+        only for very large contents.
+    chunksize : int[default=64]
+        number of contents sent at once to a process of the pool
+
+    Returns
+    -------
+
+    list of str
+    """
+    if not processes or processes <= 1:
+        return [summarize(d, algorithm=algorithm) for d in contents]
+    from functools import partial
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    try:
+        return pool.map(partial(summarize, algorithm=algorithm), contents, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def json_default(obj):
+    """
+    `default` function for json.dump(s) to encode jobs:
+    datetimes are encoded in iso format and documents
+    of blitzdb by their attributes.
+    """
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    elif hasattr(obj, 'attributes'):
+        return obj.attributes
+    else:
+        raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
 # http://stackoverflow.com/a/3233356
 
 
+def copy_job(obj):
+    """
+    deep copy of a job, faster than copy.deepcopy for
+    the dicts and lists decoded from json.
+    """
+    if isinstance(obj, dict):
+        return {k: copy_job(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [copy_job(v) for v in obj]
+    if isinstance(obj, (six.string_types, six.integer_types, float, bool)) or obj is None:
+        return obj
+    return copy.deepcopy(obj)
+
+
 def recur_update(d, u):
     """
     update a dictionary `d` with another dictionary `u`
@@ -82,7 +255,7 @@ def recur_update(d, u):
     dict, the modified `d`
     """
     for k, v in u.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, Mapping):
             r = recur_update(d.get(k, {}), v)
             d[k] = r
         else:
@@ -122,33 +295,118 @@ def dict_format(d, field, agg=AGG, if_not_found='raise_exception', **kw):
         if 'raise_exception', then raises exception when the field is not found
         otherwise use the value of if_not_found, e.g if_not_found can be `np.nan`.
     """
-    val = d
-    field_comps = field.split('.')
-    found = True
-    for comp in field_comps:
-        if ':' in comp:
-            comp, agg_name = comp.split(':', 2)
-            agg_ = agg[agg_name]
-        elif '[' in comp and ']' in comp:
-            first, last = comp.index('['), comp.index(']')
-            idx = int(comp[first + 1:last])
-            comp = comp[0:first]
-            agg_ = lambda x:x[idx]
-        else:
-            agg_ = lambda x: x
-        if not val or (val and comp not in val):
-            found = False
-            break
-        else:
+    return compile_field(field, agg=agg)(d, if_not_found=if_not_found)
+
+
+class FieldAccessor(object):
+    """
+    a field path (see `dict_format` for the syntax) parsed once,
+    which can then be applied to many dicts.
+
+    Parameters
+    ----------
+
+    field : str
+        the path of the field
+    agg : dict, optional
+        aggregation functions to use, default is AGG
+    """
+
+    def __init__(self, field, agg=AGG):
+        self.field = field
+        self.steps = []
+        for comp in field.split('.'):
+            if ':' in comp:
+                comp, agg_name = comp.split(':', 2)
+                post = agg[agg_name]
+            elif '[' in comp and ']' in comp:
+                first, last = comp.index('['), comp.index(']')
+                post = _item_getter(int(comp[first + 1:last]))
+                comp = comp[0:first]
+            else:
+                post = None
+            self.steps.append((comp, post))
+
+    def __call__(self, d, if_not_found='raise_exception'):
+        val = d
+        for comp, post in self.steps:
+            if not val or comp not in val:
+                if if_not_found == 'raise_exception':
+                    raise ValueError('field {} does not exist'.format(self.field))
+                return if_not_found
             val = val[comp]
-            val = agg_(val)
-    if found:
+            if post is not None:
+                val = post(val)
         return val
-    else:
-        if if_not_found == 'raise_exception':
-            raise ValueError('field {} does not exist'.format(field))
-        else:
-            return if_not_found
+
+    def __repr__(self):
+        return 'FieldAccessor({!r})'.format(self.field)
+
+
+def _item_getter(idx):
+    return lambda x: x[idx]
+
+
+class LRU(object):
+    """
+    a dict with at most `maxsize` keys, the least recently
+    used keys are removed first.
+    it can be shared by threads (e.g. the workers of AsyncDB
+    and the runner), each operation holds a lock.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+FIELDS = LRU(maxsize=1024)
+
+
+def compile_field(field, agg=AGG):
+    """
+    return the `FieldAccessor` of `field`.
+    the accessors using the default aggregations AGG are
+    cached in the LRU `FIELDS`.
+    """
+    if agg is not AGG:
+        return FieldAccessor(field, agg=agg)
+    accessor = FIELDS.get(field)
+    if accessor is None:
+        accessor = FieldAccessor(field)
+        FIELDS[field] = accessor
+    return accessor
 
 
 def match(d, d_ref):
@@ -187,7 +445,7 @@ def flatten_dict(l):
     """
     d = {}
     for k, v in l.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, Mapping):
             d.update(flatten_dict(v))
         else:
             d[k] = v
@@ -21,7 +21,7 @@ setup(
                  'Operating System :: Unix',
                  'Operating System :: MacOS'],
     platforms='any',
-    packages=['lightjob'],
+    packages=['lightjob', 'lightjob.databases', 'lightjob.benchmarks'],
     requires=['blitzdb', 'click', 'dataset'],
     py_modules=['lightjob'],
     entry_points='''